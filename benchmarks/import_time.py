@@ -0,0 +1,92 @@
+"""
+Import-time benchmark for the answer modules.
+
+Each module is imported in a fresh interpreter, first on its own and then followed by warmup(),
+so the gap between the two columns is the work that is now deferred until first use. With --ref,
+the same modules are also imported from a git worktree of that revision (e.g. the eager baseline
+before the lazy getters), with the untracked vector stores and .env linked in, for a before/after.
+Run from the repository root: python -m benchmarks.import_time --ref 15bb6a2
+"""
+import sys
+import math
+import shutil
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+MODULES = ["labs.rag_app.answer", "pro_implementation.answer", "labs.evaluation.eval"]
+REF_WORKTREE = ROOT / ".import_time_ref"  # inside the repository, so load_dotenv finds the same .env
+# Untracked files the modules open at import (eagerly, before the lazy getters)
+DATA_PATHS = [".env", "preprocessed_db", "labs/vector_db_openai_embeddings", "labs/vector_db_local_embeddings", "labs/vector_db_small_to_big"]
+
+TIMER = """
+import time
+start = time.perf_counter()
+import importlib
+module = importlib.import_module("{module}")
+{after}
+print(time.perf_counter() - start)
+"""
+
+
+def time_in_subprocess(module: str, warmup: bool, cwd: Path = ROOT) -> float:
+    """Seconds to import module (and run its warmup()) in a fresh interpreter; nan if it fails there."""
+    after = "getattr(module, 'warmup', lambda: None)()" if warmup else ""
+    code = TIMER.format(module=module, after=after)
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        return math.nan
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def median_time(module: str, repeats: int, warmup: bool = False, cwd: Path = ROOT) -> float:
+    return statistics.median(time_in_subprocess(module, warmup, cwd) for _ in range(repeats))
+
+
+def add_worktree(ref: str) -> Path:
+    """A detached worktree of ref at REF_WORKTREE, with DATA_PATHS linked from this checkout."""
+    remove_worktree()
+    subprocess.run(["git", "worktree", "add", "--detach", str(REF_WORKTREE), ref], cwd=ROOT, check=True, capture_output=True)
+    for path in DATA_PATHS:
+        if (ROOT / path).exists() and not (REF_WORKTREE / path).exists():
+            (REF_WORKTREE / path).symlink_to(ROOT / path)
+    return REF_WORKTREE
+
+
+def remove_worktree():
+    if REF_WORKTREE.exists():
+        subprocess.run(["git", "worktree", "remove", "--force", str(REF_WORKTREE)], cwd=ROOT, capture_output=True)
+        shutil.rmtree(REF_WORKTREE, ignore_errors=True)
+    subprocess.run(["git", "worktree", "prune"], cwd=ROOT, capture_output=True)
+
+
+def benchmark(modules: list[str], repeats: int, warmup: bool, ref: str | None = None):
+    columns = ["import s"] + (["import+warmup s"] if warmup else [])
+    if ref:
+        columns.append(f"{ref} import s")
+    print(f"{'module':<30}" + "".join(f"{column:>18}" for column in columns))
+    worktree = add_worktree(ref) if ref else None
+    try:
+        for module in modules:
+            times = [median_time(module, repeats)]
+            if warmup:
+                times.append(median_time(module, repeats, warmup=True))
+            if worktree:
+                times.append(median_time(module, repeats, cwd=worktree))
+            # nan means the import failed, e.g. the module doesn't exist at ref
+            print(f"{module:<30}" + "".join(f"{t:>18.3f}" for t in times))
+    finally:
+        if worktree:
+            remove_worktree()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold import time of the answer modules")
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--repeats", type=int, default=5, help="Fresh interpreters per measurement; the median is reported")
+    parser.add_argument("--warmup", action="store_true", help="Also time import followed by warmup() (needs the vector stores)")
+    parser.add_argument("--ref", help="Also time the imports at this git revision, e.g. the eager baseline")
+    args = parser.parse_args()
+    benchmark(args.modules, args.repeats, args.warmup, args.ref)
@@ -0,0 +1,272 @@
+"""
+Load generator for answer_question.
+
+Replays a captured query log (QUERY_LOG from the chat app) or the evaluation questions against
+the rag_app or pro answer module, against a running server (python -m pro_implementation.serve) over
+HTTP, or against an offline stand-in that only sleeps, so the harness itself can be checked without providers.
+
+Open loop (--rate): requests arrive on a Poisson schedule, or at the log's own timestamps with
+--replay-timing, whether or not earlier ones have finished; latency is measured from the scheduled
+arrival, so a backlog shows up in the numbers. Closed loop (--concurrency): that many users each
+send their next question as soon as the previous answer arrives.
+Run from the repository root: python -m benchmarks.loadgen --backend fake --rate 5 --requests 200
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import statistics
+from itertools import cycle, islice
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel
+
+BACKENDS = ["fake", "rag_app", "pro", "http"]
+MAX_IN_FLIGHT = 256
+
+
+class Query(BaseModel):
+    """One request to replay: the question, the history to send with it, and its offset in the log."""
+    question: str
+    history: list[dict]
+    offset: float = 0.0
+
+
+class Report(BaseModel):
+    mode: str
+    requests: int
+    errors: int
+    error_rate: float
+    duration: float
+    throughput: float
+    latency_ms: dict[str, float]
+
+
+def history_of(length: int, questions: list[str]) -> list[dict]:
+    """A stand-in conversation of the given length, built from earlier questions, for logs that only keep its length."""
+    history = []
+    for question in islice(cycle(questions or ["..."]), (length + 1) // 2):
+        history.append({"role": "user", "content": question})
+        history.append({"role": "assistant", "content": "I can help with that."})
+    return history[:length]
+
+
+def load_queries(log: str | None) -> list[Query]:
+    if log:
+        from common import querylog
+
+        records = querylog.load(log)
+        questions = [record.question for record in records]
+        start = records[0].timestamp if records else 0.0
+        return [Query(question=r.question, history=history_of(r.history_length, questions), offset=r.timestamp - start) for r in records]
+    from labs.evaluation.test import load_tests
+
+    return [Query(question=test.question, history=[]) for test in load_tests()]
+
+
+def repeat(queries: list[Query], count: int) -> list[Query]:
+    """
+    count queries, cycling through queries; each cycle's offsets are shifted past the previous cycle
+    by its span plus the mean gap, so replayed timestamps keep increasing.
+    """
+    if not queries:
+        return []
+    span = queries[-1].offset - queries[0].offset
+    period = span + span / (len(queries) - 1) if len(queries) > 1 else 0.0
+    return [
+        query.model_copy(update={"offset": query.offset + (i // len(queries)) * period})
+        for i, query in enumerate(islice(cycle(queries), count))
+    ]
+
+
+def fake_backend(latency: float, error_rate: float, seed: int):
+    """Sleeps for a lognormal time with the given median and fails at error_rate; no providers needed."""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def answer_question(question, history=[]):
+        with lock:
+            delay = rng.lognormvariate(0, 0.5) * latency
+            fail = rng.random() < error_rate
+        time.sleep(delay)
+        if fail:
+            raise RuntimeError("simulated provider error")
+        return "answer", []
+
+    return answer_question
+
+
+def http_backend(url: str):
+    """POSTs each question to a server's /answer endpoint."""
+    from urllib.request import Request, urlopen
+
+    def answer_question(question, history=[]):
+        body = json.dumps({"question": question, "history": history}).encode("utf-8")
+        request = Request(f"{url.rstrip('/')}/answer", data=body, headers={"Content-Type": "application/json"})
+        with urlopen(request, timeout=120) as response:
+            reply = json.loads(response.read())
+        return reply["answer"], reply["sources"]
+
+    return answer_question
+
+
+def get_backend(name: str, fake_latency: float, fake_error_rate: float, seed: int, url: str):
+    if name == "fake":
+        return fake_backend(fake_latency, fake_error_rate, seed)
+    if name == "http":
+        return http_backend(url)
+    if name == "rag_app":
+        from labs.rag_app.answer import answer_question, warmup
+    else:
+        from pro_implementation.answer import answer_question, warmup
+    warmup()
+    return answer_question
+
+
+def run_open_loop(answer_question, queries: list[Query], rate: float, replay_timing: bool, speedup: float, seed: int):
+    """Submit each query at its arrival time; returns (latencies, errors, duration)."""
+    rng = random.Random(seed)
+    arrivals = []
+    now = 0.0
+    for query in queries:
+        if replay_timing:
+            now = query.offset / speedup
+        else:
+            now += rng.expovariate(rate)
+        arrivals.append(now)
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def send(query: Query, scheduled: float):
+        try:
+            answer_question(query.question, query.history)
+            failed = None
+        except Exception as e:
+            failed = e
+        with lock:
+            latencies.append(time.perf_counter() - scheduled)
+            if failed:
+                errors.append(failed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as pool:
+        for query, arrival in zip(queries, arrivals):
+            scheduled = start + arrival
+            if (wait := scheduled - time.perf_counter()) > 0:
+                time.sleep(wait)
+            pool.submit(send, query, scheduled)
+    return latencies, errors, time.perf_counter() - start
+
+
+def run_closed_loop(answer_question, queries: list[Query], concurrency: int):
+    """concurrency users each send the next query when the previous answer arrives; returns (latencies, errors, duration)."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    pending = iter(queries)
+
+    def user():
+        while True:
+            with lock:
+                query = next(pending, None)
+            if query is None:
+                return
+            sent = time.perf_counter()
+            try:
+                answer_question(query.question, query.history)
+                failed = None
+            except Exception as e:
+                failed = e
+            with lock:
+                latencies.append(time.perf_counter() - sent)
+                if failed:
+                    errors.append(failed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - start
+
+
+def make_report(mode: str, latencies: list[float], errors: list, duration: float) -> Report:
+    ordered = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return 1000 * ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] if ordered else 0.0
+
+    return Report(
+        mode=mode,
+        requests=len(latencies),
+        errors=len(errors),
+        error_rate=len(errors) / len(latencies) if latencies else 0.0,
+        duration=duration,
+        throughput=(len(latencies) - len(errors)) / duration if duration else 0.0,
+        latency_ms={
+            "mean": 1000 * statistics.mean(ordered) if ordered else 0.0,
+            "p50": percentile(50),
+            "p90": percentile(90),
+            "p95": percentile(95),
+            "p99": percentile(99),
+            "max": 1000 * ordered[-1] if ordered else 0.0,
+        },
+    )
+
+
+def print_report(report: Report, errors: list):
+    print(f"\n{report.mode}: {report.requests} requests in {report.duration:.1f}s")
+    print(f"Throughput: {report.throughput:.2f} answers/s; errors: {report.errors} ({report.error_rate:.1%})")
+    print("Latency ms: " + "  ".join(f"{name} {value:,.0f}" for name, value in report.latency_ms.items()))
+    if errors:
+        kinds = {}
+        for error in errors:
+            kinds[type(error).__name__] = kinds.get(type(error).__name__, 0) + 1
+        print("Errors by type: " + ", ".join(f"{name} {count}" for name, count in kinds.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay questions against answer_question at a target rate or concurrency")
+    parser.add_argument("--backend", choices=BACKENDS, default="fake")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Server to send requests to, with --backend http")
+    parser.add_argument("--log", help="Query log captured with QUERY_LOG; defaults to the evaluation questions")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--rate", type=float, help="Open loop: mean arrivals per second (Poisson)")
+    mode.add_argument("--replay-timing", action="store_true", help="Open loop: arrive at the log's own timestamps")
+    mode.add_argument("--concurrency", type=int, help="Closed loop: number of simultaneous users")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Compress the log's timing by this factor (with --replay-timing)")
+    parser.add_argument("--requests", type=int, help="Number of requests; cycles through the questions (default: each once)")
+    parser.add_argument("--shuffle", action="store_true", help="Shuffle the questions before replaying")
+    parser.add_argument("--fake-latency", type=float, default=1.0, help="Median seconds per answer for the fake backend")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0, help="Fraction of fake answers that fail")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    if args.replay_timing and args.shuffle:
+        parser.error("--shuffle would reorder the log's timestamps; it can't be used with --replay-timing")
+
+    queries = load_queries(args.log)
+    if args.shuffle:
+        random.Random(args.seed).shuffle(queries)
+    if args.requests:
+        queries = repeat(queries, args.requests)
+    answer_question = get_backend(args.backend, args.fake_latency, args.fake_error_rate, args.seed, args.url)
+
+    if args.concurrency:
+        latencies, errors, duration = run_closed_loop(answer_question, queries, args.concurrency)
+        label = f"Closed loop, {args.concurrency} users"
+    else:
+        latencies, errors, duration = run_open_loop(answer_question, queries, args.rate or 1.0, args.replay_timing, args.speedup, args.seed)
+        label = "Open loop, log timing" if args.replay_timing else f"Open loop, {args.rate}/s"
+    print_report(make_report(label, latencies, errors, duration), errors)
+
+    if args.backend in ("rag_app", "pro"):
+        from common import usage
+
+        module = sys.modules[answer_question.__module__]
+        flights = module.flights.stats()
+        print(f"Coalesced: {flights.coalesced} of {flights.requests} requests ({flights.coalesced_rate:.1%}), largest flight {flights.largest_flight}")
+        if hasattr(module, "plan_counts"):
+            print("Retrieval plans: " + ", ".join(f"{name} {count}" for name, count in sorted(module.plan_counts().items())))
+        usage.print_summary()
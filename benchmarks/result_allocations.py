@@ -0,0 +1,112 @@
+"""
+Allocation benchmark for retrieval results: one pydantic object per chunk versus common.resultset.
+
+Both sides run the pro pipeline's handling of one request on synthetic hits shaped like Chroma's:
+two searches of RETRIEVAL_K, merged, plus ENTITY_K entity chunks, reordered by a rerank and cut
+to FINAL_K. The "objects" side is the previous code (a Result per chunk, list-based merge_chunks,
+rerank rebuilding the list by index); the "columnar" side keeps a ResultSet until the final top-k
+and only then builds Result objects. Reported per request: peak and retained memory under
+tracemalloc, and time with tracemalloc off.
+Run from the repository root: python -m benchmarks.result_allocations
+"""
+import time
+import random
+import argparse
+import statistics
+import tracemalloc
+from pydantic import BaseModel
+from common.resultset import ResultSet
+
+RETRIEVAL_K = 20
+ENTITY_K = 10
+FINAL_K = 10
+
+
+class Result(BaseModel):
+    page_content: str
+    metadata: dict
+
+
+def make_hits(rng: random.Random, count: int, overlap: list[tuple] | None = None, chunk_chars: int = 1500) -> list[tuple]:
+    """(distance, document, metadata) tuples, sorted by distance; starts with the overlap hits, as two searches share some."""
+    hits = list(overlap or [])
+    while len(hits) < count:
+        source = f"knowledge-base/products/product_{rng.randrange(40)}.md"
+        start = rng.randrange(10_000)
+        text = "".join(rng.choices("abcdefghij klmnop\n", k=chunk_chars))
+        hits.append((rng.random(), text, {"source": source, "type": "products", "start": start, "end": start + chunk_chars}))
+    return sorted(hits, key=lambda hit: hit[0])
+
+
+def objects(first, second, entity, order):
+    def to_chunks(hits):
+        return [Result(page_content=document, metadata=metadata) for _, document, metadata in hits]
+
+    def merge_chunks(chunks, reranked):
+        merged = chunks[:]
+        existing = [chunk.page_content for chunk in chunks]
+        for chunk in reranked:
+            if chunk.page_content not in existing:
+                merged.append(chunk)
+        return merged
+
+    chunks = merge_chunks(to_chunks(first), to_chunks(second))
+    chunks = merge_chunks(chunks, to_chunks(entity))
+    reranked = [chunks[i] for i in order if i < len(chunks)]
+    return reranked[:FINAL_K]
+
+
+def columnar(first, second, entity, order):
+    chunks = ResultSet.from_hits(first).merge(ResultSet.from_hits(second))
+    chunks = chunks.merge(ResultSet.from_hits(entity))
+    reranked = chunks.take(i for i in order if i < len(chunks))
+    return reranked[:FINAL_K].to_list(Result)
+
+
+def measure(pipeline, requests: list[tuple]) -> dict[str, float]:
+    tracemalloc.start()
+    peaks, retained = [], []
+    for request in requests:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        kept = pipeline(*request)
+        current, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+        retained.append(current - before)
+        del kept
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for request in requests:
+        pipeline(*request)
+    elapsed = time.perf_counter() - start
+    return {
+        "peak_kb": statistics.mean(peaks) / 1024,
+        "retained_kb": statistics.mean(retained) / 1024,
+        "us": 1e6 * elapsed / len(requests),
+    }
+
+
+def run(requests: int, seed: int):
+    rng = random.Random(seed)
+    workload = []
+    for _ in range(requests):
+        first = make_hits(rng, RETRIEVAL_K)
+        second = make_hits(rng, RETRIEVAL_K, overlap=rng.sample(first, RETRIEVAL_K // 2))
+        entity = make_hits(rng, ENTITY_K, overlap=rng.sample(first, 2))
+        order = rng.sample(range(2 * RETRIEVAL_K + ENTITY_K), 2 * RETRIEVAL_K + ENTITY_K)
+        workload.append((first, second, entity, order))
+
+    print(f"{requests} requests: 2 x {RETRIEVAL_K} hits + {ENTITY_K} entity chunks, cut to {FINAL_K}")
+    print(f"{'pipeline':<12}{'peak KB':>10}{'retained KB':>13}{'us/request':>12}")
+    for name, pipeline in [("objects", objects), ("columnar", columnar)]:
+        result = measure(pipeline, workload)
+        print(f"{name:<12}{result['peak_kb']:>10.1f}{result['retained_kb']:>13.1f}{result['us']:>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare allocations of per-chunk objects and columnar result sets")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    run(args.requests, args.seed)
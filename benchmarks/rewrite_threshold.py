@@ -0,0 +1,57 @@
+"""
+Check REWRITE_MAX_DISTANCE in pro_implementation/answer.py against the evaluation questions.
+
+Runs the first-pass search of the pro pipeline for every test question (no history, as a first turn)
+and reports the distance of the nearest hit, split by whether that hit contains one of the test's
+keywords, together with the plan plan_query picks. A threshold below most relevant first hits
+sends first-turn questions down rewrite_low_confidence even though the first pass found what they
+needed; the suggested value keeps 95% of the relevant first hits on the direct path.
+Distances are squared L2 between unit vectors (2 - 2 * cosine similarity).
+Needs the pro vector store and an OpenAI key for the query embeddings.
+Run from the repository root: python -m benchmarks.rewrite_threshold
+"""
+import argparse
+import statistics
+from collections import Counter
+from labs.evaluation.test import load_tests
+from pro_implementation import answer
+
+QUANTILES = [0.1, 0.5, 0.9, 0.95]
+
+
+def quantiles(values: list[float]) -> str:
+    if len(values) < 2:
+        return "n/a"
+    cuts = statistics.quantiles(values, n=100)
+    return "  ".join(f"p{int(q * 100)} {cuts[int(q * 100) - 1]:.3f}" for q in QUANTILES)
+
+
+def run(limit: int | None):
+    tests = load_tests()[:limit]
+    relevant, irrelevant, plans = [], [], Counter()
+    for test in tests:
+        results = answer.search(test.question, answer.route(test.question))
+        plans[answer.plan_query(test.question, [], results).name] += 1
+        if not results:
+            continue
+        distance, document, _ = results[0]
+        hit = any(keyword.lower() in document.lower() for keyword in test.keywords)
+        (relevant if hit else irrelevant).append(distance)
+
+    threshold = answer.REWRITE_MAX_DISTANCE
+    print(f"{len(tests)} questions; REWRITE_MAX_DISTANCE = {threshold} (cosine {1 - threshold / 2:.2f})")
+    print(f"nearest hit relevant   ({len(relevant):>3}): {quantiles(relevant)}")
+    print(f"nearest hit irrelevant ({len(irrelevant):>3}): {quantiles(irrelevant)}")
+    above = sum(distance > threshold for distance in relevant)
+    print(f"Relevant first hits above the threshold: {above} of {len(relevant)}")
+    print("Plans: " + ", ".join(f"{name} {count}" for name, count in plans.most_common()))
+    if len(relevant) >= 2:
+        suggested = statistics.quantiles(relevant, n=100)[94]
+        print(f"Suggested REWRITE_MAX_DISTANCE: {suggested:.2f} (cosine {1 - suggested / 2:.2f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare first-pass distances of the test questions with REWRITE_MAX_DISTANCE")
+    parser.add_argument("--limit", type=int, help="Only the first N test questions")
+    args = parser.parse_args()
+    run(args.limit)
@@ -0,0 +1,86 @@
+"""
+Query latency and rebuild time versus shard count, on synthetic vectors.
+
+For each shard count the same random vectors are hashed across that many in-memory Chroma
+collections, then the same queries are run through the fan-out in common.sharding.
+Reported per shard count: time to build all shards, time to rebuild the largest single shard,
+p50/p95 query latency, and overlap of the top-k with the unsharded top-k.
+Run from the repository root: python -m benchmarks.shard_latency
+"""
+import time
+import argparse
+import statistics
+import numpy as np
+from common.sharding import ShardLayout, query_shards
+
+ADD_BATCH_SIZE = 5000
+
+
+def build(client, layout: ShardLayout, vectors: np.ndarray, sources: list[str]) -> tuple[dict, float, float]:
+    """Create the shard collections; returns them with total build time and the slowest single shard's time."""
+    assignments = {name: [] for name in layout.names()}
+    for i, source in enumerate(sources):
+        assignments[layout.shard_of({"source": source})].append(i)
+
+    collections = {}
+    shard_times = []
+    for name, indexes in assignments.items():
+        start = time.perf_counter()
+        collection = client.create_collection(name)
+        for offset in range(0, len(indexes), ADD_BATCH_SIZE):
+            batch = indexes[offset:offset + ADD_BATCH_SIZE]
+            collection.add(
+                ids=[str(i) for i in batch],
+                embeddings=vectors[batch].tolist(),
+                documents=[f"chunk {i}" for i in batch],
+                metadatas=[{"source": sources[i]} for i in batch],
+            )
+        collections[name] = collection
+        shard_times.append(time.perf_counter() - start)
+    return collections, sum(shard_times), max(shard_times)
+
+
+def run(vectors: int, dimensions: int, shard_counts: list[int], queries: int, k: int, seed: int):
+    import chromadb
+
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((vectors, dimensions), dtype=np.float32)
+    # Several chunks per source, as in the real index, so a document's chunks share a shard
+    sources = [f"doc_{i // 10}.md" for i in range(vectors)]
+    probes = rng.standard_normal((queries, dimensions), dtype=np.float32).tolist()
+
+    baseline = None
+    print(f"{vectors:,} vectors x {dimensions} dims, {queries} queries, k={k}")
+    print(f"{'shards':>7}{'build s':>10}{'shard rebuild s':>17}{'p50 ms':>9}{'p95 ms':>9}{'overlap':>9}")
+    for count in shard_counts:
+        client = chromadb.EphemeralClient()
+        layout = ShardLayout(base=f"bench_{count}", count=count)
+        collections, build_time, rebuild_time = build(client, layout, data, sources)
+        shards = list(collections.values())
+
+        latencies = []
+        results = []
+        for probe in probes:
+            start = time.perf_counter()
+            hits = query_shards(shards, probe, k)
+            latencies.append(1000 * (time.perf_counter() - start))
+            results.append({metadata["source"] + document for _, document, metadata in hits})
+        if baseline is None:
+            baseline = results
+        overlap = statistics.mean(len(r & b) / k for r, b in zip(results, baseline))
+        p95 = statistics.quantiles(latencies, n=20)[-1]
+        print(f"{count:>7}{build_time:>10.1f}{rebuild_time:>17.1f}{statistics.median(latencies):>9.2f}{p95:>9.2f}{overlap:>9.2f}")
+        for name in collections:
+            client.delete_collection(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sharded fan-out query latency against shard count")
+    parser.add_argument("--vectors", type=int, default=50_000)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    run(args.vectors, args.dimensions, args.shards, args.queries, args.k, args.seed)
@@ -0,0 +1,186 @@
+"""
+Cross-request micro-batching for query embeddings.
+
+Concurrent callers each ask for one embedding; a background thread collects the requests that
+arrive within max_wait seconds (or until max_batch_size is reached), sends them as a single
+embedding call and hands each caller its own vector back.
+
+Each request carries its caller's context: the usage of the shared call is recorded against every
+caller's request id, with the tokens split in proportion to their texts, and the wait shows up as a
+span in the caller's trace. A caller stops waiting once its request deadline runs out, and the shared
+call runs under the tightest deadline of the callers it serves.
+"""
+import time
+import queue
+import threading
+import contextvars
+from concurrent.futures import Future
+from typing import Callable
+from pydantic import BaseModel
+from common import resilience, tracing, usage
+
+MAX_BATCH_SIZE = 64
+MAX_WAIT = 0.005
+
+
+class BatcherStats(BaseModel):
+    """Batch size and queueing delay added by the batcher."""
+    requests: int
+    batches: int
+    mean_batch_size: float
+    largest_batch: int
+    mean_queue_delay_ms: float
+    max_queue_delay_ms: float
+
+
+class _Pending:
+    """One caller's request, with the context it was made in and its deadline (time.monotonic)."""
+    __slots__ = ("text", "future", "enqueued", "expires", "context", "batch_size")
+
+    def __init__(self, text: str, expires: float):
+        self.text = text
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.expires = expires
+        self.context = contextvars.copy_context()
+        self.batch_size = 0
+
+
+def _split(total: int, weights: list[int]) -> list[int]:
+    """total split in proportion to weights, in whole numbers that add up to total."""
+    whole = sum(weights)
+    shares = [total * weight // whole for weight in weights]
+    by_remainder = sorted(range(len(weights)), key=lambda i: total * weights[i] % whole, reverse=True)
+    for i in by_remainder[: total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+def _attribute(records: list[usage.Usage], batch: list[_Pending]):
+    """
+    Record each call of a batch against every caller, in the caller's context, with its share of the
+    tokens and latency; the call itself is counted once, on the first caller's record.
+    """
+    weights = [len(pending.text) or 1 for pending in batch]
+    for record in records:
+        prompt_tokens = _split(record.prompt_tokens, weights)
+        completion_tokens = _split(record.completion_tokens, weights)
+        for i, pending in enumerate(batch):
+            latency = record.latency * weights[i] / sum(weights)
+            pending.context.run(
+                usage.record, record.stage, record.model, prompt_tokens[i], completion_tokens[i], latency, calls=int(i == 0)
+            )
+
+
+class EmbeddingBatcher:
+    """
+    Args:
+        embed: Embeds a list of texts, returning one vector per text in the same order.
+        max_batch_size: Most texts sent in one embedding call.
+        max_wait: Longest a request waits for others to join its batch, in seconds.
+    """
+
+    def __init__(self, embed: Callable[[list[str]], list[list[float]]], max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT):
+        self._embed = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: queue.Queue[_Pending] = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._requests = 0
+        self._batches = 0
+        self._largest_batch = 0
+        self._total_delay = 0.0
+        self._max_delay = 0.0
+
+    def embed(self, text: str) -> list[float]:
+        """
+        Embed one text, sharing the embedding call with any concurrent callers.
+        Raises DeadlineExceeded if the enclosing request deadline runs out first.
+        """
+        self._ensure_started()
+        wait = resilience.remaining()
+        pending = _Pending(text, time.monotonic() + wait)
+        with tracing.span("batched_embedding") as span:
+            self._queue.put(pending)
+            try:
+                vector = pending.future.result(timeout=None if wait == float("inf") else wait)
+            except TimeoutError:
+                raise resilience.DeadlineExceeded("No time left for the query embedding") from None
+            span.set(batch_size=pending.batch_size)
+        return vector
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> list[_Pending]:
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Requests that queued up during the previous call are taken without waiting
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._dispatch(batch)
+            except Exception as e:
+                # Whatever went wrong, the callers still waiting get the error and the thread lives on
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+
+    def _dispatch(self, batch: list[_Pending]):
+        dispatched = time.monotonic()
+        # Callers whose deadline has passed have stopped waiting; don't spend a call on them
+        batch = [pending for pending in batch if pending.expires > dispatched]
+        if not batch:
+            return
+        # Identical questions in the same window are embedded once
+        texts = list(dict.fromkeys(pending.text for pending in batch))
+        with resilience.deadline(min(pending.expires for pending in batch) - dispatched), usage.capture() as records:
+            embedded = self._embed(texts)
+        try:
+            if len(embedded) != len(texts):
+                raise ValueError(f"Embedding call returned {len(embedded)} vectors for {len(texts)} texts")
+            vectors = dict(zip(texts, embedded))
+            for pending in batch:
+                pending.batch_size = len(batch)
+                pending.future.set_result(vectors[pending.text])
+        finally:
+            _attribute(records, batch)
+
+        delays = [dispatched - pending.enqueued for pending in batch]
+        with self._lock:
+            self._requests += len(batch)
+            self._batches += 1
+            self._largest_batch = max(self._largest_batch, len(batch))
+            self._total_delay += sum(delays)
+            self._max_delay = max(self._max_delay, max(delays))
+
+    def stats(self) -> BatcherStats:
+        with self._lock:
+            return BatcherStats(
+                requests=self._requests,
+                batches=self._batches,
+                mean_batch_size=self._requests / self._batches if self._batches else 0.0,
+                largest_batch=self._largest_batch,
+                mean_queue_delay_ms=1000 * self._total_delay / self._requests if self._requests else 0.0,
+                max_queue_delay_ms=1000 * self._max_delay,
+            )
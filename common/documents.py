@@ -0,0 +1,184 @@
+"""
+Small-to-big retrieval: index small units, answer with their parent sections.
+
+At ingest, each document is split into markdown sections (the parents) and each section into
+short passages of a few sentences (the units that get embedded). Every unit records the byte
+offsets of itself and of its parent in the source. A copy of the source documents is written
+next to the vector store, and at prompt time the answer modules memory-map it and replace each
+hit with its parent section, once per section. Units and stored documents both carry a digest of
+the document text, so offsets from one version of a document are never read against another.
+"""
+import os
+import re
+import json
+import mmap
+import hashlib
+from pathlib import Path
+from itertools import accumulate
+from pydantic import BaseModel
+
+SMALL_CHUNK_SIZE = 300  # characters per passage; a single longer sentence stays whole
+HEADING = re.compile(r"^#{1,6} ", re.MULTILINE)
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+class Unit(BaseModel):
+    """A passage to embed, with byte offsets of itself and its parent section in the source."""
+    text: str
+    start: int
+    end: int
+    parent_start: int
+    parent_end: int
+    digest: str
+
+    def offsets(self) -> dict:
+        return {"start": self.start, "end": self.end, "parent_start": self.parent_start, "parent_end": self.parent_end, "digest": self.digest}
+
+
+def docstore_path(db_name: str) -> Path:
+    """Where the copy of the source documents for a vector store lives."""
+    return Path(f"{db_name}_documents")
+
+
+def document_digest(text: str) -> str:
+    """Short SHA-256 of a document's text, recorded with its offsets."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _byte_offsets(text: str) -> list[int]:
+    """Byte offset in the UTF-8 encoding of each character position of text (plus the end)."""
+    return list(accumulate((len(char.encode("utf-8")) for char in text), initial=0))
+
+
+def section_spans(text: str) -> list[tuple[int, int]]:
+    """Character spans of the markdown sections of text; anything before the first heading is a section too."""
+    starts = [match.start() for match in HEADING.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    ends = starts[1:] + [len(text)]
+    return [(start, end) for start, end in zip(starts, ends) if text[start:end].strip()]
+
+
+def passage_spans(text: str, start: int, end: int, max_chars: int = SMALL_CHUNK_SIZE) -> list[tuple[int, int]]:
+    """Character spans of consecutive sentences within text[start:end], grouped up to max_chars."""
+    sentences = []
+    position = start
+    for boundary in SENTENCE_END.finditer(text, start, end):
+        if text[position:boundary.start()].strip():
+            sentences.append((position, boundary.start()))
+        position = boundary.end()
+    if text[position:end].strip():
+        sentences.append((position, end))
+
+    passages = []
+    for sentence_start, sentence_end in sentences:
+        if passages and sentence_end - passages[-1][0] <= max_chars:
+            passages[-1] = (passages[-1][0], sentence_end)
+        else:
+            passages.append((sentence_start, sentence_end))
+    return passages
+
+
+def split_small_to_big(text: str, max_chars: int = SMALL_CHUNK_SIZE) -> list[Unit]:
+    """Split a document into passages, each pointing at its parent section."""
+    to_bytes = _byte_offsets(text)
+    digest = document_digest(text)
+    units = []
+    for section_start, section_end in section_spans(text):
+        for start, end in passage_spans(text, section_start, section_end, max_chars):
+            units.append(Unit(
+                text=text[start:end],
+                start=to_bytes[start],
+                end=to_bytes[end],
+                parent_start=to_bytes[section_start],
+                parent_end=to_bytes[section_end],
+                digest=digest,
+            ))
+    return units
+
+
+def locate(text: str, passage: str) -> dict:
+    """
+    Offsets of a passage quoted from text, with every section it touches as the parent.
+    Empty if the passage isn't found verbatim.
+    """
+    index = text.find(passage.strip())
+    if not passage.strip() or index == -1:
+        return {}
+    start, end = index, index + len(passage.strip())
+    sections = [(s, e) for s, e in section_spans(text) if s < end and e > start] or [(start, end)]
+    to_bytes = _byte_offsets(text)
+    return {
+        "start": to_bytes[start],
+        "end": to_bytes[end],
+        "parent_start": to_bytes[sections[0][0]],
+        "parent_end": to_bytes[sections[-1][1]],
+        "digest": document_digest(text),
+    }
+
+
+class DocumentStore:
+    """Read-only, memory-mapped copy of the source documents, addressed by source and byte offsets."""
+
+    def __init__(self, path: Path):
+        with open(path / "index.json", "r", encoding="utf-8") as f:
+            self.index: dict[str, list] = json.load(f)  # source -> [position, length, digest]
+        self._file = open(path / "documents.bin", "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.index else b""
+
+    @staticmethod
+    def write(path: Path, documents: dict[str, str]):
+        """
+        Write documents (source -> text) as one concatenated file plus an index of where each starts.
+        Both files are written aside and renamed into place, so stores already open keep their mapping.
+        """
+        path.mkdir(parents=True, exist_ok=True)
+        index = {}
+        position = 0
+        with open(path / "documents.bin.tmp", "wb") as f:
+            for source, text in documents.items():
+                data = text.encode("utf-8")
+                index[source] = [position, len(data), document_digest(text)]
+                f.write(data)
+                position += len(data)
+        with open(path / "index.json.tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(path / "documents.bin.tmp", path / "documents.bin")
+        os.replace(path / "index.json.tmp", path / "index.json")
+
+    def read(self, source: str, start: int = 0, end: int | None = None) -> str:
+        base, length = self.index[source][:2]
+        end = length if end is None else min(end, length)
+        return self._map[base + start : base + end].decode("utf-8", errors="replace")
+
+    def parent(self, metadata: dict) -> str | None:
+        """
+        The parent section of a chunk, or None if the chunk has no offsets, its source isn't stored, or
+        the stored text is a different version of the document than the one the offsets point into.
+        """
+        if "parent_start" not in metadata or metadata.get("source") not in self.index:
+            return None
+        stored = self.index[metadata["source"]]
+        if "digest" in metadata and len(stored) > 2 and stored[2] != metadata["digest"]:
+            return None
+        return self.read(metadata["source"], metadata["parent_start"], metadata["parent_end"])
+
+
+def expand_to_parents(chunks: list, store: DocumentStore) -> list:
+    """
+    Replace each ranked chunk with its parent section, keeping the rank of the first hit in each
+    section and dropping later hits in the same one. Chunks without offsets are kept as they are.
+    """
+    expanded = []
+    seen = set()
+    for chunk in chunks:
+        text = store.parent(chunk.metadata)
+        if text is None:
+            expanded.append(chunk)
+            continue
+        key = (chunk.metadata["source"], chunk.metadata["parent_start"], chunk.metadata["parent_end"])
+        if key in seen:
+            continue
+        seen.add(key)
+        expanded.append(type(chunk)(page_content=text, metadata=chunk.metadata))
+    return expanded
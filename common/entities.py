@@ -0,0 +1,181 @@
+"""
+Entity index over the knowledge base: a zero-latency, non-vector pre-retrieval stage.
+
+Every employee, product, contract party and company page is indexed under its full name and
+aliases (surname, name without middle initial, party name without its legal suffix, ...).
+Lookup runs one Aho-Corasick pass over the question, keeps whole-word, leftmost-longest matches,
+and reports every document an alias could refer to, so shared surnames such as Chen are
+ambiguous matches rather than silently overwritten ones.
+"""
+import re
+from pathlib import Path
+from functools import cache
+from collections import deque
+from pydantic import BaseModel
+
+KNOWLEDGE_BASE_PATH = Path(__file__).parent.parent / "knowledge-base"
+
+CONTRACT_PATTERN = re.compile(r"^Contract with (?P<party>.+?) for (?P<product>.+)$")
+LEGAL_SUFFIXES = (" Inc.", " Co.", " Inc", " Co", " LLC")
+
+# Company pages have no name of their own, so they are found through topic keywords
+COMPANY_ALIASES = {
+    "about": ["founded", "founder", "history of insurellm"],
+    "careers": ["careers", "jobs", "hiring", "open positions"],
+    "culture": ["culture", "values", "vision statement", "mission statement"],
+    "overview": ["offices", "headquarters", "how many employees"],
+}
+
+
+class Entity(BaseModel):
+    """A knowledge-base document and the names it can be referred to by."""
+    name: str
+    doc_type: str
+    source: str
+    aliases: list[str]
+
+
+class EntityMatch(BaseModel):
+    """One alias found in a text, with every entity it may refer to."""
+    alias: str
+    start: int
+    end: int
+    entities: list[Entity]
+
+    @property
+    def ambiguous(self) -> bool:
+        return len(self.entities) > 1
+
+
+class Automaton:
+    """Aho-Corasick automaton over lowercase patterns; finds every occurrence of every pattern in one pass."""
+
+    def __init__(self):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.output: list[list[str]] = [[]]
+
+    def add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        if pattern not in self.output[state]:
+            self.output[state].append(pattern)
+
+    def build(self):
+        """Compute failure links breadth first; call once after all patterns are added."""
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, child in self.goto[state].items():
+                pending.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text: str):
+        """Yield (start, end, pattern) for every occurrence in text."""
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                yield index + 1 - len(pattern), index + 1, pattern
+
+
+def _strip_suffix(name: str) -> str:
+    for suffix in LEGAL_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def _employee_aliases(name: str) -> list[str]:
+    parts = name.split()
+    aliases = [name, parts[-1]]
+    if len(parts) > 2:
+        # "Jordan K. Bishop" is also "Jordan Bishop"
+        aliases.append(f"{parts[0]} {parts[-1]}")
+    return aliases
+
+
+def load_entities(knowledge_base_path: Path = KNOWLEDGE_BASE_PATH) -> list[Entity]:
+    """One Entity per document in the four knowledge-base folders."""
+    entities = []
+    for file in sorted(knowledge_base_path.rglob("*.md")):
+        doc_type = file.parent.name
+        name = file.stem
+        if doc_type == "employees":
+            aliases = _employee_aliases(name)
+        elif doc_type == "contracts" and (match := CONTRACT_PATTERN.match(name)):
+            party = match["party"]
+            name = party
+            aliases = [party, _strip_suffix(party)]
+        elif doc_type == "company":
+            aliases = COMPANY_ALIASES.get(name, [])
+        else:
+            aliases = [name]
+        entities.append(Entity(name=name, doc_type=doc_type, source=file.as_posix(), aliases=list(dict.fromkeys(aliases))))
+    return entities
+
+
+class EntityIndex:
+    """Maps aliases to entities and finds them in text with a single automaton pass."""
+
+    def __init__(self, entities: list[Entity]):
+        self.entities = entities
+        self.by_alias: dict[str, list[Entity]] = {}
+        self.automaton = Automaton()
+        for entity in entities:
+            for alias in entity.aliases:
+                key = alias.lower()
+                self.by_alias.setdefault(key, []).append(entity)
+                self.automaton.add(key)
+        self.automaton.build()
+        self._texts: dict[str, str] = {}
+
+    @classmethod
+    def build(cls, knowledge_base_path: Path = KNOWLEDGE_BASE_PATH) -> "EntityIndex":
+        return cls(load_entities(knowledge_base_path))
+
+    def lookup(self, text: str) -> list[EntityMatch]:
+        """Whole-word alias matches in text, leftmost-longest, in order of appearance."""
+        lowered = text.lower()
+        candidates = []
+        for start, end, alias in self.automaton.search(lowered):
+            before = lowered[start - 1] if start > 0 else " "
+            after = lowered[end] if end < len(lowered) else " "
+            if not before.isalnum() and not after.isalnum():
+                candidates.append((start, end, alias))
+
+        matches = []
+        last_end = 0
+        for start, end, alias in sorted(candidates, key=lambda c: (c[0], c[0] - c[1])):
+            if start >= last_end:
+                matches.append(EntityMatch(alias=alias, start=start, end=end, entities=self.by_alias[alias]))
+                last_end = end
+        return matches
+
+    def sources(self, text: str) -> list[str]:
+        """Distinct source paths of every entity mentioned in text, in order of first mention."""
+        return list(dict.fromkeys(entity.source for match in self.lookup(text) for entity in match.entities))
+
+    def text(self, source: str) -> str:
+        """Contents of a source document, read once and kept."""
+        if source not in self._texts:
+            with open(source, "r", encoding="utf-8") as f:
+                self._texts[source] = f.read()
+        return self._texts[source]
+
+
+@cache
+def get_entity_index(knowledge_base_path: Path = KNOWLEDGE_BASE_PATH) -> EntityIndex:
+    return EntityIndex.build(knowledge_base_path)
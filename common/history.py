@@ -0,0 +1,136 @@
+"""
+Token-budgeted conversation history.
+
+Prompts get the most recent messages that fit in a token budget, optionally preceded by a rolling
+summary of the older turns. The summary is extended incrementally and cached per conversation,
+so each new turn only summarizes the messages that just fell out of the window. Given a
+SharedCache, the summaries are kept there instead, so every server process can extend them.
+Retrieval queries get the current question plus prior user turns, with older turns given a
+geometrically smaller share of the query budget.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable
+from common import usage
+
+HISTORY_TOKEN_BUDGET = 1500
+QUERY_TOKEN_BUDGET = 200
+RECENCY_DECAY = 0.5
+MIN_TURN_TOKENS = 8
+MAX_CONVERSATIONS = 1024
+
+SUMMARY_PROMPT = """
+You keep a running summary of a conversation between a user and an assistant representing the company Insurellm.
+Update the summary with the new messages. Keep every name, product, number and date that was mentioned.
+Reply only with the updated summary, in under 150 words.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+"""
+
+
+def count_tokens(text: str) -> int:
+    return usage.count_tokens([text], usage.PROMPT_ENCODING)
+
+
+def format_messages(messages: list[dict]) -> str:
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+def _fingerprint(messages: list[dict]) -> str:
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(message["role"].encode())
+        digest.update(b"\0")
+        digest.update(message["content"].encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class HistoryManager:
+    """
+    Args:
+        budget: Token budget for the history messages sent with each prompt.
+        summarize: Optional callable taking (current summary, newly dropped messages) and
+                   returning the updated summary. Without it, older turns are simply dropped.
+        shared: Optional common.sharedcache.SharedCache to keep the summaries in, across processes.
+    """
+
+    def __init__(self, budget: int = HISTORY_TOKEN_BUDGET, summarize: Callable[[str, list[dict]], str] | None = None, shared=None):
+        self.budget = budget
+        self.summarize = summarize
+        self.shared = shared
+        # conversation key -> (number of messages summarized, fingerprint of those messages, summary)
+        self._summaries: OrderedDict[str, tuple[int, str, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def window(self, history: list[dict]) -> list[dict]:
+        """The most recent messages that fit in the budget, preceded by a summary of the rest if enabled."""
+        kept = []
+        used = 0
+        for message in reversed(history):
+            tokens = count_tokens(message["content"])
+            if used + tokens > self.budget:
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+
+        older = history[: len(history) - len(kept)]
+        if not older or self.summarize is None:
+            return kept
+        try:
+            summary = self.summary(older)
+        except Exception:
+            # If the summary can't be made in time, the older turns are dropped for this prompt
+            return kept
+        return [{"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}] + kept
+
+    def summary(self, older: list[dict]) -> str:
+        """Rolling summary of older messages, reusing the cached summary of any prefix already summarized."""
+        key = _fingerprint(older[:1])
+        count, fingerprint, summary = self._load(key)
+        if count > len(older) or _fingerprint(older[:count]) != fingerprint:
+            count, summary = 0, ""
+
+        if count < len(older):
+            summary = self.summarize(summary, older[count:])
+            self._save(key, (len(older), _fingerprint(older), summary))
+        return summary
+
+    def _load(self, key: str) -> tuple[int, str, str]:
+        if self.shared is not None:
+            return tuple(self.shared.get(f"summary:{key}") or (0, "", ""))
+        with self._lock:
+            return self._summaries.get(key, (0, "", ""))
+
+    def _save(self, key: str, entry: tuple[int, str, str]):
+        if self.shared is not None:
+            self.shared.set(f"summary:{key}", entry)
+            return
+        with self._lock:
+            self._summaries[key] = entry
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > MAX_CONVERSATIONS:
+                self._summaries.popitem(last=False)
+
+    def retrieval_query(self, question: str, history: list[dict], budget: int = QUERY_TOKEN_BUDGET, decay: float = RECENCY_DECAY) -> str:
+        """
+        Build the retrieval query from the question and prior user turns.
+        The most recent turn gets the largest share of what is left of the budget after the question,
+        and each older turn gets `decay` times the share of the one after it.
+        """
+        remaining = budget - count_tokens(question)
+        prior = []
+        share = remaining * (1 - decay)
+        for message in reversed([m for m in history if m["role"] == "user"]):
+            if share < MIN_TURN_TOKENS:
+                break
+            prior.append(usage.truncate_tokens(message["content"], int(share)))
+            share *= decay
+        prior.reverse()
+        return "\n".join(prior + [question])
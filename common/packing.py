@@ -0,0 +1,160 @@
+"""
+Token-budgeted context packing for RAG prompts.
+
+Retrieved chunks overlap by design, so the same sentences reach the prompt several times.
+pack_context merges overlapping chunks from the same source into one block, drops lines that
+were already packed, and fills the token budget in rank order.
+"""
+import re
+import threading
+from collections import deque
+from pydantic import BaseModel
+from common import usage
+
+CONTEXT_TOKEN_BUDGET = 4000
+MIN_OVERLAP_CHARS = 40
+MIN_DEDUP_CHARS = 30
+MIN_BLOCK_TOKENS = 50
+MAX_STATS = 10_000
+
+
+class ContextBlock(BaseModel):
+    """One or more merged chunks from a single source."""
+    source: str
+    text: str
+
+
+class PackStats(BaseModel):
+    """Prompt-size statistics for one packed context."""
+    request_id: str | None = None
+    chunks: int
+    blocks: int
+    merged_chunks: int
+    duplicate_lines: int
+    tokens_before: int
+    tokens_after: int
+
+
+_stats: deque[PackStats] = deque(maxlen=MAX_STATS)
+_lock = threading.Lock()
+
+
+def _normalize(line: str) -> str:
+    return re.sub(r"\s+", " ", line).strip().lower()
+
+
+def _overlap(first: str, second: str) -> int:
+    """Length of the longest suffix of first that is a prefix of second, if at least MIN_OVERLAP_CHARS."""
+    if len(first) < MIN_OVERLAP_CHARS or len(second) < MIN_OVERLAP_CHARS:
+        return 0
+    probe = second[:MIN_OVERLAP_CHARS]
+    start = max(0, len(first) - len(second))
+    while (index := first.find(probe, start)) != -1:
+        if second.startswith(first[index:]):
+            return len(first) - index
+        start = index + 1
+    return 0
+
+
+def _merge(blocks: list[list[str]], source: str, text: str) -> bool:
+    """Merge text into an existing block for source if it overlaps or is contained in it."""
+    for block in blocks:
+        if block[0] != source:
+            continue
+        existing = block[1]
+        if text in existing:
+            return True
+        if existing in text:
+            block[1] = text
+            return True
+        if overlap := _overlap(existing, text):
+            block[1] = existing + text[overlap:]
+            return True
+        if overlap := _overlap(text, existing):
+            block[1] = text + existing[overlap:]
+            return True
+    return False
+
+
+def _drop_seen_lines(text: str, seen: set[str]) -> tuple[str, int]:
+    """Remove lines already packed elsewhere; short lines such as headings and separators are always kept."""
+    kept = []
+    dropped = 0
+    for line in text.splitlines():
+        key = _normalize(line)
+        if len(key) >= MIN_DEDUP_CHARS:
+            if key in seen:
+                dropped += 1
+                continue
+            seen.add(key)
+        kept.append(line)
+    return "\n".join(kept).strip(), dropped
+
+
+def pack_context(chunks: list, budget: int = CONTEXT_TOKEN_BUDGET) -> tuple[list[ContextBlock], PackStats]:
+    """
+    Pack ranked chunks (anything with page_content and a metadata["source"]) into context blocks.
+
+    Chunks from the same source that overlap are merged into one block, which keeps the rank
+    of its best chunk. Lines already packed in a higher-ranked block are dropped. Blocks are
+    then added in rank order until the budget runs out; the first block that doesn't fit is
+    truncated to what's left.
+    """
+    blocks: list[list[str]] = []
+    for chunk in chunks:
+        source = chunk.metadata.get("source", "")
+        if not _merge(blocks, source, chunk.page_content):
+            blocks.append([source, chunk.page_content])
+
+    seen = set()
+    packed = []
+    used = 0
+    duplicate_lines = 0
+    for source, text in blocks:
+        text, dropped = _drop_seen_lines(text, seen)
+        duplicate_lines += dropped
+        if not text:
+            continue
+        tokens = usage.count_tokens([text], usage.PROMPT_ENCODING)
+        if used + tokens > budget:
+            remaining = budget - used
+            if remaining >= MIN_BLOCK_TOKENS:
+                packed.append(ContextBlock(source=source, text=usage.truncate_tokens(text, remaining)))
+                used = budget
+            break
+        packed.append(ContextBlock(source=source, text=text))
+        used += tokens
+
+    stats = PackStats(
+        request_id=usage.current_request_id(),
+        chunks=len(chunks),
+        blocks=len(packed),
+        merged_chunks=len(chunks) - len(blocks),
+        duplicate_lines=duplicate_lines,
+        tokens_before=usage.count_tokens([chunk.page_content for chunk in chunks], usage.PROMPT_ENCODING),
+        tokens_after=used,
+    )
+    with _lock:
+        _stats.append(stats)
+    return packed, stats
+
+
+def recent_stats() -> list[PackStats]:
+    """Stats for the most recent MAX_STATS packed contexts."""
+    with _lock:
+        return list(_stats)
+
+
+def stats_summary() -> dict[str, float]:
+    """Average prompt context size before and after packing over the recent contexts."""
+    stats = recent_stats()
+    if not stats:
+        return {}
+    before = sum(s.tokens_before for s in stats) / len(stats)
+    after = sum(s.tokens_after for s in stats) / len(stats)
+    return {
+        "contexts": len(stats),
+        "mean_tokens_before": before,
+        "mean_tokens_after": after,
+        "reduction": 1 - after / before if before else 0.0,
+    }
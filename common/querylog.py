@@ -0,0 +1,38 @@
+"""
+Opt-in capture of chat traffic for sizing and load replay.
+
+When QUERY_LOG is set, the chat handler appends one JSON line per question with its timestamp and
+the length of the conversation history. benchmarks/loadgen.py replays these logs.
+"""
+import os
+import time
+import threading
+from pathlib import Path
+from pydantic import BaseModel
+
+QUERY_LOG = os.getenv("QUERY_LOG")
+
+_lock = threading.Lock()
+
+
+class QueryRecord(BaseModel):
+    """One question as it reached the chat handler."""
+    timestamp: float
+    question: str
+    history_length: int
+
+
+def capture(question: str, history_length: int, path: str | None = QUERY_LOG):
+    """Append a question to the query log; does nothing unless QUERY_LOG (or path) is set."""
+    if not path:
+        return
+    line = QueryRecord(timestamp=time.time(), question=question, history_length=history_length).model_dump_json()
+    with _lock, open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+def load(path: str | Path) -> list[QueryRecord]:
+    """Captured questions in timestamp order."""
+    with open(path, "r", encoding="utf-8") as f:
+        records = [QueryRecord.model_validate_json(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record.timestamp)
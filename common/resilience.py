@@ -0,0 +1,163 @@
+"""
+Deadlines, circuit breakers and fallback models for LLM calls.
+
+A request runs inside `deadline(seconds)`. Each stage call gets a timeout that is the smaller of
+its own limit and what is left of the request deadline, is retried a bounded number of times
+within that, and moves on to the next model in its list when a model keeps failing. Each model
+endpoint has a circuit breaker, so a provider that is down is skipped straight away instead of
+timing out on every request. Callers decide how to degrade when a stage still fails.
+"""
+import time
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from common import usage
+
+FAILURE_THRESHOLD = 5  # consecutive failures before a breaker opens
+RESET_TIMEOUT = 30.0  # seconds an open breaker waits before letting a trial call through
+ATTEMPTS = 2  # tries per model within a stage
+BACKOFF = 0.5  # seconds before the second try, doubled after each further failure
+
+
+class DeadlineExceeded(Exception):
+    """The request deadline ran out before the stage could run."""
+
+
+class CircuitOpen(Exception):
+    """Every model for the stage has an open circuit breaker."""
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Bound every stage call made inside the block by an overall deadline."""
+    token = _deadline.set(Deadline(seconds))
+    try:
+        yield _deadline.get()
+    finally:
+        _deadline.reset(token)
+
+
+def remaining(default: float = float("inf")) -> float:
+    """Seconds left on the enclosing deadline, or default outside one."""
+    current = _deadline.get()
+    return current.remaining() if current else default
+
+
+class CircuitBreaker:
+    """Closed until FAILURE_THRESHOLD consecutive failures; then open for RESET_TIMEOUT, then one trial call."""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = None  # thread running the half-open trial call
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and self._trial is None:
+                self._trial = threading.get_ident()
+                return True
+            return False
+
+    def release(self):
+        """Give back a trial this thread took but never ran, so the next caller can try instead."""
+        with self._lock:
+            if self._trial == threading.get_ident():
+                self._trial = None
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = None
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+_events = Counter()
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        return _breakers.setdefault(model, CircuitBreaker())
+
+
+def note(event: str):
+    """Count a degradation event, e.g. "rerank skipped" or "answer fallback"."""
+    with _breakers_lock:
+        _events[event] += 1
+
+
+def events() -> dict[str, int]:
+    with _breakers_lock:
+        return dict(_events)
+
+
+def completion(stage: str, models: list[str], timeout: float, attempts: int = ATTEMPTS, **kwargs):
+    """
+    usage.completion for the first model in models that answers within the stage timeout.
+    Each model gets up to `attempts` tries, all bounded by the enclosing deadline.
+    Raises DeadlineExceeded, CircuitOpen, or the last model error if every model fails.
+    """
+    error = None
+    for index, model in enumerate(models):
+        breaker = get_breaker(model)
+        delay = BACKOFF
+        for attempt in range(attempts):
+            limit = min(timeout, remaining())
+            if limit <= 0:  # checked before allow(), so running out of time never holds a half-open trial
+                raise DeadlineExceeded(f"No time left for {stage}")
+            if not breaker.allow():
+                if attempt == 0:
+                    note(f"{stage} circuit open: {model}")
+                break
+            try:
+                response = usage.completion(stage, model=model, timeout=limit, **kwargs)
+            except Exception as e:
+                breaker.failure()
+                error = e
+                if attempt + 1 < attempts and min(timeout, remaining()) > delay:
+                    time.sleep(delay)
+                    delay *= 2
+                    continue
+                break
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.success()
+            if index > 0:
+                note(f"{stage} fallback: {model}")
+            return response
+    if error is None:
+        raise CircuitOpen(f"Every model for {stage} has an open circuit: {', '.join(models)}")
+    raise error
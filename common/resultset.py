@@ -0,0 +1,55 @@
+"""
+Columnar retrieval results.
+
+A ResultSet keeps one list per column (distances, texts, metadata) instead of one object per chunk.
+The texts and metadata dicts are the ones the vector store returned, referenced rather than copied,
+so slicing, reordering by a rerank and merging two searches only build new lists of references.
+The answer modules work on result sets between the vector store and the final top-k, and convert
+to Result or LangChain Document objects only where those leave the pipeline.
+"""
+from typing import Iterable
+
+
+class ResultSet:
+    """Ranked retrieval results as parallel columns; distance is None for rows that didn't come from a similarity search."""
+    __slots__ = ("distances", "texts", "metadatas")
+
+    def __init__(self, distances: list | None = None, texts: list[str] | None = None, metadatas: list[dict] | None = None):
+        self.texts = texts if texts is not None else []
+        self.metadatas = metadatas if metadatas is not None else [{} for _ in self.texts]
+        self.distances = distances if distances is not None else [None] * len(self.texts)
+
+    @classmethod
+    def from_hits(cls, hits: Iterable[tuple[float, str, dict]]) -> "ResultSet":
+        """From the (distance, document, metadata) tuples of common.sharding.query_shards."""
+        columns = tuple(zip(*hits))
+        if not columns:
+            return cls()
+        distances, texts, metadatas = columns
+        return cls(list(distances), list(texts), list(metadatas))
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, rows: slice) -> "ResultSet":
+        return ResultSet(self.distances[rows], self.texts[rows], self.metadatas[rows])
+
+    def take(self, rows: Iterable[int]) -> "ResultSet":
+        """The given rows, in the given order (e.g. a rerank's order)."""
+        rows = list(rows)
+        return ResultSet([self.distances[i] for i in rows], [self.texts[i] for i in rows], [self.metadatas[i] for i in rows])
+
+    def merge(self, other: "ResultSet") -> "ResultSet":
+        """These rows followed by the rows of other whose text isn't already here."""
+        seen = set(self.texts)
+        rows = []
+        for i, text in enumerate(other.texts):
+            if text not in seen:
+                seen.add(text)
+                rows.append(i)
+        merged = other.take(rows)
+        return ResultSet(self.distances + merged.distances, self.texts + merged.texts, self.metadatas + merged.metadatas)
+
+    def to_list(self, cls) -> list:
+        """One cls(page_content=..., metadata=...) per row, e.g. Result or langchain Document."""
+        return [cls(page_content=text, metadata=metadata) for text, metadata in zip(self.texts, self.metadatas)]
@@ -0,0 +1,116 @@
+"""
+Query routing by document type.
+
+Predicts which knowledge-base folders (company, contracts, employees, products) a question is
+about, from the entities it names and from keyword rules, so retrieval can search only those
+types. When the evidence is weak or spread over every type, the route is unfiltered. A type the
+question names outright ("the company", "our contracts") is always searched when the route is filtered.
+"""
+import re
+from pathlib import Path
+from functools import cache
+from pydantic import BaseModel
+from common.entities import EntityIndex, get_entity_index, KNOWLEDGE_BASE_PATH
+
+DOC_TYPES = ["company", "contracts", "employees", "products"]
+
+ENTITY_WEIGHT = 2.0  # split between the types of an ambiguous match
+KEYWORD_WEIGHT = 1.0
+MIN_EVIDENCE = 2.0  # below this total score the route is unfiltered
+INCLUDE_RATIO = 0.3  # types scoring at least this fraction of the top type are searched too
+MIN_CONFIDENCE = 0.75  # share of the evidence the selected types must cover
+
+TYPE_KEYWORDS = {
+    "company": ["company", "overview", "about insurellm", "founded", "founder", "headquarters", "office", "offices", "culture", "values", "mission", "vision", "careers", "history"],
+    "contracts": ["contract", "contracts", "client", "clients", "signed", "agreement", "subscribe", "subscribed", "licenses", "renewal", "sla", "uptime", "contract value", "policies"],
+    "employees": ["employee", "employees", "salary", "job title", "joined", "hired", "engineer", "manager", "designer", "analyst", "executive", "award", "performance", "promotion", "ceo", "cto", "who is"],
+    "products": ["product", "products", "feature", "features", "pricing", "tier", "tiers", "launch", "roadmap", "version", "platform"],
+}
+
+# Words that name a document type itself; a question using one never has that type filtered out
+TYPE_NAMES = {
+    "company": ["company", "insurellm as a company", "business", "organisation", "organization"],
+    "contracts": ["contract", "contracts"],
+    "employees": ["employee", "employees", "staff"],
+    "products": ["product", "products"],
+}
+
+
+class Route(BaseModel):
+    """Document types to search, with the evidence behind the choice. Empty doc_types means search everything."""
+    doc_types: list[str]
+    confidence: float
+    scores: dict[str, float]
+
+    @property
+    def filtered(self) -> bool:
+        return bool(self.doc_types)
+
+    def where(self, field: str = "type") -> dict | None:
+        """Chroma where filter on the given metadata field, or None for an unfiltered search."""
+        if not self.doc_types:
+            return None
+        if len(self.doc_types) == 1:
+            return {field: self.doc_types[0]}
+        return {field: {"$in": self.doc_types}}
+
+
+def _keyword_pattern(keywords: list[str]) -> re.Pattern:
+    alternatives = "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alternatives})\b", re.IGNORECASE)
+
+
+class QueryRouter:
+    """Scores each document type from entity matches and keyword rules, compiled once."""
+
+    def __init__(self, entity_index: EntityIndex, type_keywords: dict[str, list[str]] = TYPE_KEYWORDS, type_names: dict[str, list[str]] = TYPE_NAMES):
+        self.entity_index = entity_index
+        self.patterns = {doc_type: _keyword_pattern(keywords) for doc_type, keywords in type_keywords.items()}
+        self.name_patterns = {doc_type: _keyword_pattern(names) for doc_type, names in type_names.items()}
+
+    def named(self, question: str) -> list[str]:
+        """The document types the question names outright."""
+        return [doc_type for doc_type, pattern in self.name_patterns.items() if pattern.search(question)]
+
+    def scores(self, question: str) -> dict[str, float]:
+        scores = dict.fromkeys(DOC_TYPES, 0.0)
+        for match in self.entity_index.lookup(question):
+            types = {entity.doc_type for entity in match.entities}
+            for doc_type in types:
+                scores[doc_type] = scores.get(doc_type, 0.0) + ENTITY_WEIGHT / len(types)
+        for doc_type, pattern in self.patterns.items():
+            scores[doc_type] += KEYWORD_WEIGHT * len(pattern.findall(question))
+        return scores
+
+    def route(self, question: str) -> Route:
+        scores = self.scores(question)
+        total = sum(scores.values())
+        if total < MIN_EVIDENCE:
+            return Route(doc_types=[], confidence=0.0, scores=scores)
+        top = max(scores.values())
+        named = self.named(question)
+        selected = [doc_type for doc_type, score in scores.items() if score >= INCLUDE_RATIO * top or doc_type in named]
+        confidence = sum(scores[doc_type] for doc_type in selected) / total
+        if confidence < MIN_CONFIDENCE or len(selected) == len(scores):
+            return Route(doc_types=[], confidence=confidence, scores=scores)
+        return Route(doc_types=selected, confidence=confidence, scores=scores)
+
+
+@cache
+def get_router(knowledge_base_path: Path = KNOWLEDGE_BASE_PATH) -> QueryRouter:
+    return QueryRouter(get_entity_index(knowledge_base_path))
+
+
+if __name__ == "__main__":
+    import json
+
+    tests_path = Path(__file__).parent.parent / "labs" / "evaluation" / "tests.jsonl"
+    router = get_router()
+    routed = 0
+    with open(tests_path, "r", encoding="utf-8") as f:
+        for line in f:
+            question = json.loads(line)["question"]
+            route = router.route(question)
+            routed += route.filtered
+            print(f"{', '.join(route.doc_types) or '(all)':<30} {route.confidence:.2f}  {question}")
+    print(f"\nFiltered routes: {routed}")
@@ -0,0 +1,95 @@
+"""
+Sharded Chroma collections with a parallel fan-out query.
+
+Ingest partitions documents across several collections, either one per document type or by a
+hash of the source, and records the layout in the vector store directory. Whole documents land
+in one shard, so a shard can be rebuilt on its own. Queries go to every shard concurrently and
+the per-shard top-k lists, each already sorted by distance, are merged with a heap.
+"""
+import json
+import heapq
+import hashlib
+from itertools import islice
+from pathlib import Path
+from functools import cache
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel
+from common.routing import DOC_TYPES
+
+LAYOUT_FILE = "shards.json"
+MAX_FANOUT_THREADS = 16
+
+
+class ShardLayout(BaseModel):
+    """How a collection is split: by "type" (one shard per document type) or by "hash" of the source into count shards."""
+    base: str
+    by: str = "hash"
+    count: int = 1
+    type_field: str = "type"
+
+    def names(self) -> list[str]:
+        if self.by == "type":
+            return [f"{self.base}_{doc_type}" for doc_type in DOC_TYPES]
+        if self.count == 1:
+            return [self.base]
+        return [f"{self.base}_shard_{i}" for i in range(self.count)]
+
+    def shard_of(self, metadata: dict) -> str:
+        """The shard a chunk or document belongs to, from its metadata."""
+        if self.by == "type":
+            return f"{self.base}_{metadata[self.type_field]}"
+        if self.count == 1:
+            return self.base
+        digest = hashlib.md5(metadata["source"].encode("utf-8")).digest()
+        return f"{self.base}_shard_{int.from_bytes(digest[:8], 'big') % self.count}"
+
+    def select(self, where: dict | None) -> list[str]:
+        """Shards that can hold results for a where filter; only a type layout can skip any."""
+        if self.by != "type" or not where or self.type_field not in where:
+            return self.names()
+        condition = where[self.type_field]
+        doc_types = condition["$in"] if isinstance(condition, dict) else [condition]
+        return [f"{self.base}_{doc_type}" for doc_type in doc_types]
+
+    def save(self, db_name: str):
+        path = Path(db_name)
+        path.mkdir(parents=True, exist_ok=True)
+        (path / LAYOUT_FILE).write_text(self.model_dump_json(), encoding="utf-8")
+
+    @classmethod
+    def load(cls, db_name: str, base: str, type_field: str = "type") -> "ShardLayout":
+        """The layout saved by ingest, or a single unsharded collection if there is none."""
+        path = Path(db_name) / LAYOUT_FILE
+        if path.exists():
+            return cls(**json.loads(path.read_text(encoding="utf-8")))
+        return cls(base=base, type_field=type_field)
+
+
+@cache
+def get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=MAX_FANOUT_THREADS, thread_name_prefix="shard-query")
+
+
+def merge_top_k(results: list[list[tuple]], k: int) -> list[tuple]:
+    """Merge per-shard lists of (distance, ...) tuples, each sorted by distance, keeping the k nearest."""
+    return list(islice(heapq.merge(*results, key=lambda result: result[0]), k))
+
+
+def _query(collection, embeddings: list[list[float]], n_results: int, where: dict | None) -> list[list[tuple]]:
+    results = collection.query(query_embeddings=embeddings, n_results=n_results, where=where, include=["documents", "metadatas", "distances"])
+    return [list(zip(*columns)) for columns in zip(results["distances"], results["documents"], results["metadatas"])]
+
+
+def query_shards_many(collections: list, embeddings: list[list[float]], n_results: int, where: dict | None = None) -> list[list[tuple[float, str, dict]]]:
+    """One multi-query call per shard, run concurrently; returns the n_results nearest (distance, document, metadata) per embedding."""
+    if len(collections) == 1:
+        return _query(collections[0], embeddings, n_results, where)
+    futures = [get_executor().submit(_query, collection, embeddings, n_results, where) for collection in collections]
+    per_shard = [future.result() for future in futures]
+    return [merge_top_k([shard[i] for shard in per_shard], n_results) for i in range(len(embeddings))]
+
+
+def query_shards(collections: list, embedding: list[float], n_results: int, where: dict | None = None) -> list[tuple[float, str, dict]]:
+    """Query raw chromadb collections concurrently; returns the n_results nearest (distance, document, metadata)."""
+    return query_shards_many(collections, [embedding], n_results, where)[0]
+
@@ -0,0 +1,103 @@
+"""
+A small key-value cache in a local SQLite file, shared by every process on the box.
+
+Pre-forked server workers each have their own memory, so an in-process cache warmed by one worker
+does nothing for the others. Values are stored as JSON, except bytes, which are stored as they are
+(e.g. float32 embedding vectors, which as JSON would take five times the space and a parse on every
+hit). The database runs in WAL mode so readers
+don't block the writer, and each process (and thread) opens its own connection, since SQLite
+connections must not cross a fork. Once the cache holds more than max_entries, the least recently
+written entries are dropped.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+MAX_ENTRIES = 20_000  # about 250 MB of 3072-dimension float32 embeddings
+PRUNE_EVERY = 1000  # writes between size checks
+MAX_KEYS_PER_QUERY = 900  # below SQLite's limit on bound parameters (999 before 3.32)
+
+
+def _encode(value) -> bytes | str:
+    return value if isinstance(value, bytes) else json.dumps(value)
+
+
+def _decode(stored: bytes | str):
+    return stored if isinstance(stored, bytes) else json.loads(stored)
+
+
+class SharedCache:
+    def __init__(self, path: str | Path, max_entries: int = MAX_ENTRIES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, written REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_written ON cache (written)")
+
+    def _connect(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection, self._local.pid = connection, pid
+        return self._local.connection
+
+    def get(self, key: str):
+        """The cached value, or None."""
+        row = self._connect().execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        return _decode(row[0]) if row else None
+
+    def get_many(self, keys: list[str]) -> dict:
+        """The cached values of those keys that are present."""
+        connection = self._connect()
+        values = {}
+        for i in range(0, len(keys), MAX_KEYS_PER_QUERY):
+            chunk = keys[i : i + MAX_KEYS_PER_QUERY]
+            placeholders = ",".join("?" * len(chunk))
+            rows = connection.execute(f"SELECT key, value FROM cache WHERE key IN ({placeholders})", chunk).fetchall()
+            values.update((key, _decode(value)) for key, value in rows)
+        return values
+
+    def set(self, key: str, value):
+        self.set_many({key: value})
+
+    def set_many(self, items: dict):
+        now = time.time()
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, written) VALUES (?, ?, ?)",
+                [(key, _encode(value), now) for key, value in items.items()],
+            )
+        self._writes += len(items)
+        if self._writes >= PRUNE_EVERY:
+            self._writes = 0
+            self.prune()
+
+    def prune(self):
+        with self._connect() as connection:
+            connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY written DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_shared_cache(path: str | None = None) -> SharedCache | None:
+    """The cache at path, by default the SHARED_CACHE environment variable; None when neither is set."""
+    path = path or os.getenv("SHARED_CACHE")
+    if not path:
+        return None
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = SharedCache(path)
+        return _caches[path]
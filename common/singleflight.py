@@ -0,0 +1,162 @@
+"""
+Single-flight coalescing of identical in-flight requests.
+
+When the same question arrives again while it is still being answered, the later callers don't
+start the pipeline themselves: they wait for the first caller's result (or error) and share it.
+Nothing is kept once the first call returns, so unlike a cache there is nothing to expire; it only
+flattens bursts of identical questions, which protects provider rate limits.
+"""
+import re
+import json
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Callable, Iterator
+from pydantic import BaseModel
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def question_key(question: str, history: list[dict] = []) -> str:
+    """The normalized question plus a fingerprint of the conversation it was asked in."""
+    normalized = _WHITESPACE.sub(" ", question).strip().rstrip("?!. ").casefold()
+    turns = json.dumps([[message["role"], message["content"]] for message in history], ensure_ascii=False)
+    return f"{normalized}\x00{hashlib.sha256(turns.encode('utf-8')).hexdigest()[:16]}"
+
+
+class FlightStats(BaseModel):
+    """How many requests ran the pipeline and how many shared another request's run."""
+    requests: int
+    executions: int
+    coalesced: int
+    coalesced_rate: float
+    largest_flight: int
+    in_flight: int
+
+
+class _Stream:
+    """Tokens produced so far by the leader of a streaming flight, for followers to replay and follow."""
+
+    def __init__(self):
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def publish(self, token=None, done: bool = False, error: Exception | None = None):
+        with self.condition:
+            if token is not None:
+                self.tokens.append(token)
+            self.done = self.done or done or error is not None
+            self.error = self.error or error
+            self.condition.notify_all()
+
+    def follow(self) -> Iterator:
+        position = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: position < len(self.tokens) or self.done)
+                tokens = self.tokens[position:]
+                done, error = self.done, self.error
+            yield from tokens
+            position += len(tokens)
+            if done and position == len(self.tokens):
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers with the same key share its outcome."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict[str, tuple[Future | _Stream, list[int]]] = {}
+        self._requests = 0
+        self._executions = 0
+        self._largest_flight = 0
+
+    def _join(self, key: str, new: Callable[[], Future | _Stream]) -> tuple[Future | _Stream, bool]:
+        """The flight for key and whether this caller leads it."""
+        with self._lock:
+            self._requests += 1
+            if key in self._flights:
+                flight, size = self._flights[key]
+                size[0] += 1
+                self._largest_flight = max(self._largest_flight, size[0])
+                return flight, False
+            flight = new()
+            self._flights[key] = (flight, [1])
+            self._executions += 1
+            self._largest_flight = max(self._largest_flight, 1)
+            return flight, True
+
+    def _land(self, key: str):
+        with self._lock:
+            del self._flights[key]
+
+    def do(self, key: str, fn: Callable, *args, **kwargs):
+        """fn(*args, **kwargs), unless a call with the same key is in flight, in which case its result (or error)."""
+        flight, leader = self._join(key, Future)
+        if not leader:
+            return flight.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            self._land(key)
+
+    def stream(self, key: str, fn: Callable[..., Iterator], *args, **kwargs) -> Iterator:
+        """
+        The tokens of fn(*args, **kwargs), a generator, shared the same way: callers that join a flight
+        get the tokens already produced and then each new one as the leader receives it.
+        If the leader stops reading early while others follow, it finishes the stream for them.
+        """
+        flight, leader = self._join(key, _Stream)
+        if not leader:
+            yield from flight.follow()
+            return
+        tokens = fn(*args, **kwargs)
+        finished = False
+        try:
+            for token in tokens:
+                flight.publish(token)
+                yield token
+            finished = True
+        except Exception as e:
+            flight.publish(error=e)
+            finished = True
+            raise
+        finally:
+            with self._lock:
+                followers = self._flights.pop(key)[1][0] > 1
+            if not finished and followers:
+                self._drain(tokens, flight)
+            elif not finished:
+                getattr(tokens, "close", lambda: None)()
+            flight.publish(done=True)
+
+    @staticmethod
+    def _drain(tokens: Iterator, flight: _Stream):
+        try:
+            for token in tokens:
+                flight.publish(token)
+        except Exception as e:
+            flight.publish(error=e)
+
+    def stats(self) -> FlightStats:
+        with self._lock:
+            coalesced = self._requests - self._executions
+            return FlightStats(
+                requests=self._requests,
+                executions=self._executions,
+                coalesced=coalesced,
+                coalesced_rate=coalesced / self._requests if self._requests else 0.0,
+                largest_flight=self._largest_flight,
+                in_flight=len(self._flights),
+            )
@@ -0,0 +1,378 @@
+"""
+Portable index snapshots for cold-starting serving nodes.
+
+A snapshot is a directory holding, for each collection of a vector store, the vectors as a raw
+float32 .npy array (with their squared norms), the documents as one UTF-8 blob plus an offsets array,
+the ids, and the metadata stored column by column (repeated strings such as source and type are
+dictionary-encoded). A manifest records the format version, the ingest manifest (embedding
+model, chunking, counts), the dimensions of each collection, the shard layout and a SHA-256 checksum of every file.
+
+A node can bulk-load a snapshot into Chroma with no re-embedding, or serve it directly: open_snapshot()
+memory-maps it and returns one collection-like object per shard, with query(), get() and count()
+shaped like chromadb's. Both refuse a snapshot built with a different embedding model.
+
+publish() exports each new version into its own directory under a root and then atomically points
+the root's CURRENT file at it, so a server given the root can swap to the new version between requests.
+
+    python -m common.snapshot export --db preprocessed_db --base docs --out snapshots/docs
+    python -m common.snapshot import --bundle snapshots/docs --db preprocessed_db
+    python -m common.snapshot verify --bundle snapshots/docs
+    python -m common.snapshot publish --db preprocessed_db --base docs --root snapshots/docs-live
+"""
+import os
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+from pydantic import BaseModel
+from common.documents import docstore_path
+from common.sharding import ShardLayout
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+INGEST_MANIFEST_FILE = "ingest.json"
+EXPORT_PAGE_SIZE = 1000
+CHECKSUM_BLOCK = 1 << 20
+CURRENT_FILE = "CURRENT"
+KEEP_PUBLISHED = 3  # versions kept under a publish root, so servers still reading an older one aren't cut off
+
+
+class IngestManifest(BaseModel):
+    """How a vector store was built; written by ingest next to the Chroma files."""
+    embedding_model: str
+    chunking: str
+    documents: int
+    chunks: int
+    created_at: float
+    version: int = 0  # bumped by every full or incremental ingest
+
+
+class CollectionInfo(BaseModel):
+    name: str
+    count: int
+    dimensions: int
+
+
+class SnapshotManifest(BaseModel):
+    format_version: int = FORMAT_VERSION
+    version: str
+    created_at: float
+    ingest: IngestManifest
+    layout: ShardLayout
+    collections: list[CollectionInfo]
+    files: dict[str, str]  # relative path -> sha256
+
+
+class EmbeddingModelMismatch(ValueError):
+    """The index was built with a different embedding model than the one queries are embedded with."""
+
+
+def write_ingest_manifest(db_name: str, manifest: IngestManifest):
+    path = Path(db_name)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / INGEST_MANIFEST_FILE).write_text(manifest.model_dump_json(indent=2), encoding="utf-8")
+
+
+def read_ingest_manifest(db_name: str) -> IngestManifest | None:
+    path = Path(db_name) / INGEST_MANIFEST_FILE
+    return IngestManifest.model_validate_json(path.read_text(encoding="utf-8")) if path.exists() else None
+
+
+def check_embedding_model(manifest: IngestManifest | None, embedding_model: str, where: str):
+    """Raise EmbeddingModelMismatch if the manifest names another model; indexes without a manifest pass."""
+    if manifest and manifest.embedding_model != embedding_model:
+        raise EmbeddingModelMismatch(
+            f"{where} was built with {manifest.embedding_model}, but queries are embedded with {embedding_model}"
+        )
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(CHECKSUM_BLOCK):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _encode_columns(metadatas: list[dict]) -> dict:
+    """Metadata as one entry per key; all-string columns are stored as a dictionary plus codes."""
+    columns = {}
+    for key in sorted({key for metadata in metadatas for key in metadata}):
+        values = [metadata.get(key) for metadata in metadatas]
+        if all(value is None or isinstance(value, str) for value in values):
+            dictionary = sorted({value for value in values if value is not None})
+            codes = {value: i for i, value in enumerate(dictionary)}
+            columns[key] = {"values": dictionary, "codes": [codes[v] if v is not None else -1 for v in values]}
+        else:
+            columns[key] = {"values": values}
+    return columns
+
+
+def _export_collection(collection, path: Path) -> CollectionInfo:
+    import numpy as np
+
+    count = collection.count()
+    dimensions = len(collection.get(limit=1, include=["embeddings"])["embeddings"][0]) if count else 0
+    path.mkdir(parents=True, exist_ok=True)
+    vectors = np.lib.format.open_memmap(path / "vectors.npy", mode="w+", dtype=np.float32, shape=(count, dimensions))
+    offsets = [0]
+    ids, metadatas = [], []
+    with open(path / "documents.bin", "wb") as documents:
+        for offset in range(0, count, EXPORT_PAGE_SIZE):
+            page = collection.get(offset=offset, limit=EXPORT_PAGE_SIZE, include=["embeddings", "documents", "metadatas"])
+            vectors[len(ids):len(ids) + len(page["ids"])] = page["embeddings"]
+            for document in page["documents"]:
+                data = document.encode("utf-8")
+                documents.write(data)
+                offsets.append(offsets[-1] + len(data))
+            ids.extend(page["ids"])
+            metadatas.extend(metadata or {} for metadata in page["metadatas"])
+    vectors.flush()
+    np.save(path / "norms.npy", np.einsum("ij,ij->i", vectors, vectors))
+    np.save(path / "offsets.npy", np.array(offsets, dtype=np.uint64))
+    (path / "ids.json").write_text(json.dumps(ids), encoding="utf-8")
+    (path / "metadata.json").write_text(json.dumps(_encode_columns(metadatas)), encoding="utf-8")
+    return CollectionInfo(name=collection.name, count=len(ids), dimensions=dimensions)
+
+
+def export(db_name: str, base: str, out: str | Path, type_field: str = "type") -> SnapshotManifest:
+    """Write every collection of a vector store, its ingest manifest and its document store to a snapshot."""
+    from chromadb import PersistentClient
+
+    out = Path(out)
+    ingest = read_ingest_manifest(db_name)
+    if ingest is None:
+        raise FileNotFoundError(f"No {INGEST_MANIFEST_FILE} in {db_name}; re-run ingest so the snapshot records its embedding model")
+    layout = ShardLayout.load(db_name, base, type_field)
+    chroma = PersistentClient(path=db_name)
+    collections = [_export_collection(chroma.get_collection(name), out / "collections" / name) for name in layout.names()]
+
+    store = docstore_path(db_name)
+    if store.exists():
+        shutil.copytree(store, out / "docstore", dirs_exist_ok=True)
+
+    files = {
+        path.relative_to(out).as_posix(): _sha256(path)
+        for path in sorted(out.rglob("*"))
+        if path.is_file() and path.name != MANIFEST_FILE
+    }
+    manifest = SnapshotManifest(
+        version=hashlib.sha256("".join(files.values()).encode()).hexdigest()[:12],
+        created_at=time.time(),
+        ingest=ingest,
+        layout=layout,
+        collections=collections,
+        files=files,
+    )
+    (out / MANIFEST_FILE).write_text(manifest.model_dump_json(indent=2), encoding="utf-8")
+    print(f"Snapshot {manifest.version}: {sum(c.count for c in collections):,} chunks in {len(collections)} collection(s) at {out}")
+    return manifest
+
+
+def publish(db_name: str, base: str, root: str | Path, type_field: str = "type", keep: int = KEEP_PUBLISHED) -> Path:
+    """Export a new version under root, then point root/CURRENT at it and remove all but the keep newest versions."""
+    root = Path(root)
+    ingest = read_ingest_manifest(db_name)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-v{ingest.version if ingest else 0}"
+    export(db_name, base, root / name, type_field)
+    (root / f"{CURRENT_FILE}.tmp").write_text(name, encoding="utf-8")
+    os.replace(root / f"{CURRENT_FILE}.tmp", root / CURRENT_FILE)
+    versions = sorted((path for path in root.iterdir() if (path / MANIFEST_FILE).exists()), key=lambda path: path.name)
+    for old in versions[:-keep]:
+        shutil.rmtree(old)
+    return root / name
+
+
+def resolve(bundle: str | Path) -> Path:
+    """The snapshot directory itself, or for a publish root the version its CURRENT file points at."""
+    bundle = Path(bundle)
+    current = bundle / CURRENT_FILE
+    return bundle / current.read_text(encoding="utf-8").strip() if current.exists() else bundle
+
+
+def read_manifest(bundle: str | Path) -> SnapshotManifest:
+    manifest = SnapshotManifest.model_validate_json((Path(bundle) / MANIFEST_FILE).read_text(encoding="utf-8"))
+    if manifest.format_version != FORMAT_VERSION:
+        raise ValueError(f"Snapshot format {manifest.format_version} is not supported (expected {FORMAT_VERSION})")
+    return manifest
+
+
+def verify(bundle: str | Path) -> SnapshotManifest:
+    """Check every file against the manifest checksums."""
+    bundle = Path(bundle)
+    manifest = read_manifest(bundle)
+    for name, checksum in manifest.files.items():
+        if _sha256(bundle / name) != checksum:
+            raise ValueError(f"Checksum mismatch for {name} in snapshot {bundle}")
+    return manifest
+
+
+class SnapshotCollection:
+    """One memory-mapped collection; query(), get() and count() return what chromadb's would."""
+
+    def __init__(self, path: Path, info: CollectionInfo):
+        import numpy as np
+
+        self.name = info.name
+        self.vectors = np.load(path / "vectors.npy", mmap_mode="r")
+        self.norms = np.load(path / "norms.npy", mmap_mode="r")
+        self.offsets = np.load(path / "offsets.npy", mmap_mode="r")
+        self.ids = json.loads((path / "ids.json").read_text(encoding="utf-8"))
+        self.columns = json.loads((path / "metadata.json").read_text(encoding="utf-8"))
+        self._file = open(path / "documents.bin", "rb")
+        self._documents = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b""
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def _document(self, row: int) -> str:
+        return self._documents[int(self.offsets[row]) : int(self.offsets[row + 1])].decode("utf-8")
+
+    def _metadata(self, row: int) -> dict:
+        metadata = {}
+        for key, column in self.columns.items():
+            if "codes" in column:
+                code = column["codes"][row]
+                if code >= 0:
+                    metadata[key] = column["values"][code]
+            elif column["values"][row] is not None:
+                metadata[key] = column["values"][row]
+        return metadata
+
+    def _matches(self, key: str, accepted: list):
+        import numpy as np
+
+        column = self.columns.get(key)
+        if column is None:
+            return np.zeros(self.count(), dtype=bool)
+        if "codes" in column:
+            codes = [i for i, value in enumerate(column["values"]) if value in accepted]
+            return np.isin(np.asarray(column["codes"]), codes)
+        return np.array([value in accepted for value in column["values"]], dtype=bool)
+
+    def _mask(self, where: dict | None):
+        """Rows matching a where filter of equality, $in and $and clauses; None means every row."""
+        if not where:
+            return None
+        mask = None
+        for key, condition in where.items():
+            if key == "$and":
+                clauses = [self._mask(clause) for clause in condition]
+            elif isinstance(condition, dict) and set(condition) == {"$in"}:
+                clauses = [self._matches(key, condition["$in"])]
+            elif not isinstance(condition, dict):
+                clauses = [self._matches(key, [condition])]
+            else:
+                raise ValueError(f"Unsupported where clause for a snapshot: {key}: {condition}")
+            for clause in clauses:
+                mask = clause if mask is None else mask & clause
+        return mask
+
+    def query(self, query_embeddings: list, n_results: int = 10, where: dict | None = None, include=None) -> dict:
+        """Exact nearest neighbours by squared L2 distance, Chroma's default space."""
+        import numpy as np
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        distances = self.norms[None, :] - 2 * (queries @ self.vectors.T) + np.einsum("ij,ij->i", queries, queries)[:, None]
+        mask = self._mask(where)
+        candidates = self.count() if mask is None else int(mask.sum())
+        if mask is not None:
+            distances = np.where(mask[None, :], distances, np.inf)
+        k = min(n_results, candidates)
+        results = {"ids": [], "distances": [], "documents": [], "metadatas": []}
+        for row_distances in distances:
+            top = np.argpartition(row_distances, k - 1)[:k] if k else np.array([], dtype=int)
+            top = top[np.argsort(row_distances[top])]
+            results["ids"].append([self.ids[row] for row in top])
+            results["distances"].append([float(row_distances[row]) for row in top])
+            results["documents"].append([self._document(row) for row in top])
+            results["metadatas"].append([self._metadata(row) for row in top])
+        return results
+
+    def get(self, where: dict | None = None, limit: int | None = None, include=None) -> dict:
+        import numpy as np
+
+        mask = self._mask(where)
+        rows = np.arange(self.count()) if mask is None else np.flatnonzero(mask)
+        rows = rows[:limit] if limit is not None else rows
+        return {
+            "ids": [self.ids[row] for row in rows],
+            "documents": [self._document(row) for row in rows],
+            "metadatas": [self._metadata(row) for row in rows],
+        }
+
+
+def open_snapshot(bundle: str | Path, embedding_model: str, check: bool = True) -> tuple[SnapshotManifest, dict[str, SnapshotCollection]]:
+    """Memory-map a snapshot (or a publish root's current version) for serving; checks the checksums (unless check=False) and the embedding model."""
+    bundle = resolve(bundle)
+    manifest = verify(bundle) if check else read_manifest(bundle)
+    check_embedding_model(manifest.ingest, embedding_model, f"Snapshot {bundle}")
+    collections = {info.name: SnapshotCollection(bundle / "collections" / info.name, info) for info in manifest.collections}
+    return manifest, collections
+
+
+def load_into_chroma(bundle: str | Path, db_name: str) -> SnapshotManifest:
+    """Bulk-load a verified snapshot into a Chroma directory, replacing its collections, layout and document store."""
+    import numpy as np
+    from chromadb import PersistentClient
+
+    bundle = Path(bundle)
+    manifest = verify(bundle)
+    chroma = PersistentClient(path=db_name)
+    existing = [c.name for c in chroma.list_collections()]
+    start = time.perf_counter()
+    for info in manifest.collections:
+        if info.name in existing:
+            chroma.delete_collection(info.name)
+        source = SnapshotCollection(bundle / "collections" / info.name, info)
+        collection = chroma.create_collection(info.name)
+        step = chroma.get_max_batch_size()
+        for offset in range(0, info.count, step):
+            rows = range(offset, min(offset + step, info.count))
+            collection.add(
+                ids=source.ids[offset : offset + step],
+                embeddings=np.asarray(source.vectors[offset : offset + step]),
+                documents=[source._document(row) for row in rows],
+                metadatas=[source._metadata(row) or None for row in rows],
+            )
+    manifest.layout.save(db_name)
+    write_ingest_manifest(db_name, manifest.ingest)
+    if (bundle / "docstore").exists():
+        shutil.copytree(bundle / "docstore", docstore_path(db_name), dirs_exist_ok=True)
+    total = sum(info.count for info in manifest.collections)
+    print(f"Loaded snapshot {manifest.version} ({total:,} chunks) into {db_name} in {time.perf_counter() - start:.1f}s")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export, import or verify a portable index snapshot")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="Write a vector store to a snapshot")
+    export_parser.add_argument("--db", required=True, help="Chroma directory, e.g. preprocessed_db")
+    export_parser.add_argument("--base", default="docs", help="Collection name (\"docs\" for pro_implementation, \"langchain\" for rag_app)")
+    export_parser.add_argument("--type-field", default="type", help="Document type metadata field (\"doc_type\" for rag_app)")
+    export_parser.add_argument("--out", required=True)
+    import_parser = commands.add_parser("import", help="Bulk-load a snapshot into a Chroma directory")
+    import_parser.add_argument("--bundle", required=True)
+    import_parser.add_argument("--db", required=True)
+    verify_parser = commands.add_parser("verify", help="Check a snapshot's checksums")
+    verify_parser.add_argument("--bundle", required=True)
+    publish_parser = commands.add_parser("publish", help="Export a new version under a root and make it current")
+    publish_parser.add_argument("--db", required=True)
+    publish_parser.add_argument("--base", default="docs")
+    publish_parser.add_argument("--type-field", default="type")
+    publish_parser.add_argument("--root", required=True)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.db, args.base, args.out, args.type_field)
+    elif args.command == "publish":
+        publish(args.db, args.base, args.root, args.type_field)
+    elif args.command == "import":
+        load_into_chroma(args.bundle, args.db)
+    else:
+        manifest = verify(args.bundle)
+        print(f"Snapshot {manifest.version} OK: {len(manifest.files)} files, embedding model {manifest.ingest.embedding_model}")
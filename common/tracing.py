@@ -0,0 +1,210 @@
+"""
+Lightweight tracing: nested spans with trace and span ids, attributes and timing.
+
+Tracing is off unless TRACE_LOG (JSONL, one finished span per line) or TRACE_CHROME (a Chrome
+trace-event file for chrome://tracing or Perfetto) is set, or enable() is called. When it is off,
+span() hands back a shared no-op and @traced calls straight through, so the hooks can stay in.
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from pydantic import BaseModel
+
+TRACE_LOG = os.getenv("TRACE_LOG")
+TRACE_CHROME = os.getenv("TRACE_CHROME")
+MAX_SPANS = 100_000  # finished spans kept in memory for the Chrome exporter
+
+
+class Span(BaseModel):
+    """One timed operation; parent_id is None for the root span of a trace."""
+    trace_id: str
+    span_id: str
+    parent_id: str | None = None
+    name: str
+    start: float  # seconds since the epoch
+    duration: float = 0.0
+    attributes: dict = {}
+    error: str | None = None
+    pid: int
+    thread_id: int
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+
+class _RemoteParent(_NoopSpan):
+    """Stands in for a span of another process, so spans started here become its children."""
+
+    def __init__(self, trace_id: str, span_id: str):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+_NOOP = _NoopSpan()
+_current = contextvars.ContextVar("current_span", default=None)
+_lock = threading.Lock()
+_finished: list[Span] = []
+_jsonl_path = TRACE_LOG
+_chrome_path = TRACE_CHROME
+_enabled = bool(TRACE_LOG or TRACE_CHROME)
+
+
+def _after_fork_in_child():
+    # A forked child starts with a copy of the parent's finished spans; they aren't its to ship back
+    global _lock
+    _lock = threading.Lock()
+    _finished.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def enable(jsonl: str | None = None, chrome: str | None = None):
+    """Turn tracing on from code, writing to either or both exporters."""
+    global _enabled, _jsonl_path, _chrome_path
+    _jsonl_path = jsonl or _jsonl_path
+    _chrome_path = chrome or _chrome_path
+    _enabled = bool(_jsonl_path or _chrome_path)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def _new_id() -> str:
+    return os.urandom(8).hex()
+
+
+def _finish(span: Span):
+    if _jsonl_path:
+        line = span.model_dump_json() + "\n"
+        with _lock, open(_jsonl_path, "a", encoding="utf-8") as f:
+            f.write(line)
+    if _chrome_path:
+        with _lock:
+            if len(_finished) < MAX_SPANS:
+                _finished.append(span)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time the block as a child of the current span, or as the root of a new trace."""
+    if not _enabled:
+        yield _NOOP
+        return
+    parent = _current.get()
+    current = Span(
+        trace_id=parent.trace_id if parent else _new_id(),
+        span_id=_new_id(),
+        parent_id=parent.span_id if parent else None,
+        name=name,
+        start=time.time(),
+        attributes=attributes,
+        pid=os.getpid(),
+        thread_id=threading.get_ident(),
+    )
+    token = _current.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current.reset(token)
+        _finish(current)
+
+
+def traced(fn=None, *, name: str | None = None):
+    """Decorator running each call of a function in a span named after it."""
+    def decorate(fn):
+        span_name = name or fn.__qualname__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with span(span_name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate(fn) if fn is not None else decorate
+
+
+def annotate(**attributes):
+    """Add attributes to the current span; does nothing when tracing is off or outside a span."""
+    if _enabled and (current := _current.get()):
+        current.set(**attributes)
+
+
+def current_parent() -> tuple[str, str] | None:
+    """(trace_id, span_id) of the current span, to hand to another process with continue_trace()."""
+    current = _current.get() if _enabled else None
+    return (current.trace_id, current.span_id) if current else None
+
+
+@contextmanager
+def continue_trace(parent: tuple[str, str] | None):
+    """Start the spans made inside the block as children of a span from current_parent() in another process."""
+    if not parent:
+        yield
+        return
+    token = _current.set(_RemoteParent(*parent))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def drain() -> list[Span]:
+    """Remove and return the finished spans; used to ship spans back from worker processes."""
+    with _lock:
+        spans = _finished[:]
+        _finished.clear()
+    return spans
+
+
+def extend(spans: list[Span]):
+    """Add spans finished elsewhere (e.g. in a worker process) for the Chrome exporter."""
+    with _lock:
+        _finished.extend(spans[: MAX_SPANS - len(_finished)])
+
+
+def write_chrome_trace(path: str | None = None):
+    """Write the finished spans as Chrome trace events ("X" complete events, microseconds)."""
+    path = path or _chrome_path
+    with _lock:
+        spans = _finished[:]
+    events = [
+        {
+            "name": s.name,
+            "cat": s.name.split(".")[0],
+            "ph": "X",
+            "ts": s.start * 1e6,
+            "dur": s.duration * 1e6,
+            "pid": s.pid,
+            "tid": s.thread_id,
+            "args": {**s.attributes, "trace_id": s.trace_id, "span_id": s.span_id, "parent_id": s.parent_id, "error": s.error},
+        }
+        for s in spans
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+@atexit.register
+def _write_on_exit():
+    if _chrome_path and _finished:
+        write_chrome_trace()
@@ -0,0 +1,278 @@
+"""
+Token, cost and latency accounting for every LLM and embedding call.
+
+Calls are recorded against a stage name (rewrite_query, rerank, answer, judge, ...) and,
+when made inside `request()`, against a request id. Totals are kept per stage for the
+life of the process; set USAGE_LOG to also append every call to a JSONL file.
+"""
+import os
+import time
+import uuid
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from pydantic import BaseModel
+
+USAGE_LOG = os.getenv("USAGE_LOG")
+MAX_RECORDS = 100_000
+
+# text-embedding-3-* and gpt-4.1 family tokenizers, used when a provider doesn't report usage
+# and when prompts are trimmed to a token budget
+EMBEDDING_ENCODING = "cl100k_base"
+PROMPT_ENCODING = "o200k_base"
+
+
+class Usage(BaseModel):
+    """One LLM or embedding call."""
+    stage: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+    cost: float = 0.0
+    request_id: str | None = None
+    timestamp: float
+    calls: int = 1  # 0 for the extra records of one call shared by several requests
+
+
+class StageTotals(BaseModel):
+    """Running totals for one stage."""
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+    cost: float = 0.0
+
+    def add(self, usage: Usage):
+        self.calls += usage.calls
+        self.prompt_tokens += usage.prompt_tokens
+        self.completion_tokens += usage.completion_tokens
+        self.latency += usage.latency
+        self.cost += usage.cost
+
+    def minus(self, other: "StageTotals") -> "StageTotals":
+        return StageTotals(
+            calls=self.calls - other.calls,
+            prompt_tokens=self.prompt_tokens - other.prompt_tokens,
+            completion_tokens=self.completion_tokens - other.completion_tokens,
+            latency=self.latency - other.latency,
+            cost=self.cost - other.cost,
+        )
+
+
+_lock = threading.Lock()
+_records: deque[Usage] = deque(maxlen=MAX_RECORDS)
+_totals: dict[str, StageTotals] = {}
+_request_id = contextvars.ContextVar("usage_request_id", default=None)
+_captured = contextvars.ContextVar("usage_captured", default=None)
+_encodings = {}
+
+
+def _after_fork_in_child():
+    # A forked worker would otherwise ship the parent's records back with its own from drain()
+    global _lock
+    _lock = threading.Lock()
+    _records.clear()
+    _totals.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+@contextmanager
+def request(request_id: str | None = None):
+    """Attribute every call made inside the block to one request id."""
+    request_id = request_id or uuid.uuid4().hex[:12]
+    token = _request_id.set(request_id)
+    try:
+        yield request_id
+    finally:
+        _request_id.reset(token)
+
+
+@contextmanager
+def capture():
+    """
+    Collect the calls made inside the block instead of recording them, so the caller can attribute
+    them itself, e.g. one shared call split among the requests it served.
+    """
+    records = []
+    token = _captured.set(records)
+    try:
+        yield records
+    finally:
+        _captured.reset(token)
+
+
+def _cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    try:
+        from litellm import cost_per_token
+
+        prompt_cost, completion_cost = cost_per_token(
+            model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+        )
+        return prompt_cost + completion_cost
+    except Exception:
+        # Local models and models missing from litellm's price list are counted as free
+        return 0.0
+
+
+def _add(usage: Usage):
+    with _lock:
+        _records.append(usage)
+        _totals.setdefault(usage.stage, StageTotals()).add(usage)
+
+
+def record(stage: str, model: str, prompt_tokens: int, completion_tokens: int = 0, latency: float = 0.0, calls: int = 1) -> Usage:
+    """Record one call and append it to the USAGE_LOG file if set."""
+    usage = Usage(
+        stage=stage,
+        model=model,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        latency=latency,
+        cost=_cost(model, prompt_tokens, completion_tokens),
+        request_id=_request_id.get(),
+        timestamp=time.time(),
+        calls=calls,
+    )
+    captured = _captured.get()
+    if captured is not None:
+        captured.append(usage)
+        return usage
+    _add(usage)
+    if USAGE_LOG:
+        with _lock, open(USAGE_LOG, "a", encoding="utf-8") as f:
+            f.write(usage.model_dump_json() + "\n")
+    return usage
+
+
+def get_encoding(name: str = EMBEDDING_ENCODING):
+    """Cached tiktoken encoding; tiktoken is only imported the first time a count is needed."""
+    if name not in _encodings:
+        import tiktoken
+
+        _encodings[name] = tiktoken.get_encoding(name)
+    return _encodings[name]
+
+
+def count_tokens(texts: list[str], encoding: str = EMBEDDING_ENCODING) -> int:
+    """Estimate tokens for calls whose provider doesn't report usage (e.g. LangChain embeddings)."""
+    return sum(len(get_encoding(encoding).encode(text)) for text in texts)
+
+
+def truncate_tokens(text: str, max_tokens: int, encoding: str = PROMPT_ENCODING) -> str:
+    """Keep the first max_tokens tokens of text."""
+    tokens = get_encoding(encoding).encode(text)
+    return text if len(tokens) <= max_tokens else get_encoding(encoding).decode(tokens[:max_tokens])
+
+
+def current_request_id() -> str | None:
+    """The id set by the enclosing request() block, if any."""
+    return _request_id.get()
+
+
+def completion(stage: str, **kwargs):
+    """litellm.completion, recording tokens and latency under stage."""
+    from litellm import completion as litellm_completion
+
+    start = time.perf_counter()
+    response = litellm_completion(**kwargs)
+    record(
+        stage,
+        kwargs["model"],
+        response.usage.prompt_tokens,
+        response.usage.completion_tokens,
+        time.perf_counter() - start,
+    )
+    return response
+
+
+def embeddings(stage: str, client, model: str, input: list[str]):
+    """client.embeddings.create for an OpenAI client, recording tokens and latency under stage."""
+    start = time.perf_counter()
+    response = client.embeddings.create(model=model, input=input)
+    record(stage, model, response.usage.prompt_tokens, latency=time.perf_counter() - start)
+    return response
+
+
+def invoke(stage: str, llm, messages):
+    """llm.invoke for a LangChain chat model, recording tokens and latency under stage."""
+    start = time.perf_counter()
+    response = llm.invoke(messages)
+    latency = time.perf_counter() - start
+    metadata = response.usage_metadata or {}
+    model = getattr(llm, "model_name", None) or type(llm).__name__
+    record(stage, model, metadata.get("input_tokens", 0), metadata.get("output_tokens", 0), latency)
+    return response
+
+
+def drain() -> list[Usage]:
+    """Remove and return the recorded calls; used to ship usage back from worker processes."""
+    with _lock:
+        records = list(_records)
+        _records.clear()
+        _totals.clear()
+    return records
+
+
+def extend(records: list[Usage]):
+    """Add calls recorded elsewhere (e.g. in a worker process) to this process's totals."""
+    for usage in records:
+        _add(usage)
+
+
+def mark() -> dict[str, StageTotals]:
+    """Snapshot the running totals; pass to summary() to get the usage of a run."""
+    with _lock:
+        return {stage: totals.model_copy() for stage, totals in _totals.items()}
+
+
+def summary(since: dict[str, StageTotals] | None = None) -> dict[str, StageTotals]:
+    """Totals per stage, optionally only counting calls made after a mark()."""
+    since = since or {}
+    with _lock:
+        return {
+            stage: totals.minus(since.get(stage, StageTotals()))
+            for stage, totals in _totals.items()
+            if totals.calls > since.get(stage, StageTotals()).calls
+        }
+
+
+def request_summary(request_id: str) -> dict[str, StageTotals]:
+    """Totals per stage for one request, from the most recent MAX_RECORDS calls."""
+    totals = {}
+    with _lock:
+        for usage in _records:
+            if usage.request_id == request_id:
+                totals.setdefault(usage.stage, StageTotals()).add(usage)
+    return totals
+
+
+def total(since: dict[str, StageTotals] | None = None) -> StageTotals:
+    """All stages added together."""
+    result = StageTotals()
+    for totals in summary(since).values():
+        result.calls += totals.calls
+        result.prompt_tokens += totals.prompt_tokens
+        result.completion_tokens += totals.completion_tokens
+        result.latency += totals.latency
+        result.cost += totals.cost
+    return result
+
+
+def print_summary(since: dict[str, StageTotals] | None = None, title: str = "Usage summary"):
+    stages = summary(since)
+    print(f"\n{title}")
+    print(f"{'stage':<20}{'calls':>8}{'prompt':>12}{'completion':>12}{'latency s':>12}{'cost $':>10}")
+    for stage, totals in stages.items():
+        print(
+            f"{stage:<20}{totals.calls:>8}{totals.prompt_tokens:>12,}{totals.completion_tokens:>12,}"
+            f"{totals.latency:>12.2f}{totals.cost:>10.4f}"
+        )
+    overall = total(since)
+    print(
+        f"{'total':<20}{overall.calls:>8}{overall.prompt_tokens:>12,}{overall.completion_tokens:>12,}"
+        f"{overall.latency:>12.2f}{overall.cost:>10.4f}"
+    )
@@ -0,0 +1,81 @@
+"""
+Polling watcher for a directory of documents.
+
+Each poll lists the tree and compares every file's mtime and size with the previous poll; only a
+file whose stat changed is hashed, and it only counts as changed if its SHA-256 differs, so touching
+or re-saving a file unchanged does nothing. Bursts of edits are debounced: after a change the watcher
+keeps polling until the tree has been quiet for `debounce` seconds, then reports everything that
+changed in the burst at once. Polling needs no extra dependency and also works on network and
+container bind mounts, where inotify events often don't arrive.
+"""
+import time
+import hashlib
+from pathlib import Path
+from typing import Iterator
+from pydantic import BaseModel
+
+POLL_INTERVAL = 1.0
+DEBOUNCE = 2.0
+
+
+class ChangeSet(BaseModel):
+    """Files added or modified, and files removed, since the last report."""
+    changed: list[Path]
+    deleted: list[Path]
+
+
+def _sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+class DirectoryWatcher:
+    """Reports changes to the files under root that match pattern; files present at creation are the baseline."""
+
+    def __init__(self, root: str | Path, pattern: str = "*.md"):
+        self.root = Path(root)
+        self.pattern = pattern
+        self._state: dict[Path, tuple[int, int, str]] = self._scan({})
+
+    def _scan(self, previous: dict[Path, tuple[int, int, str]]) -> dict[Path, tuple[int, int, str]]:
+        state = {}
+        for path in self.root.rglob(self.pattern):
+            try:
+                stat = path.stat()
+                known = previous.get(path)
+                if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+                    state[path] = known
+                else:
+                    state[path] = (stat.st_mtime_ns, stat.st_size, _sha256(path))
+            except FileNotFoundError:
+                continue  # removed while scanning; the next poll reports it
+        return state
+
+    def poll(self) -> ChangeSet:
+        """Changes since the previous poll."""
+        state = self._scan(self._state)
+        changed = [path for path, (_, _, digest) in state.items() if path not in self._state or self._state[path][2] != digest]
+        deleted = [path for path in self._state if path not in state]
+        self._state = state
+        return ChangeSet(changed=sorted(changed), deleted=sorted(deleted))
+
+    def forget(self, changes: ChangeSet):
+        """Report these changes again on the next poll, e.g. after handling them failed."""
+        for path in changes.changed:
+            self._state.pop(path, None)
+        for path in changes.deleted:
+            self._state[path] = (0, 0, "")
+
+    def watch(self, interval: float = POLL_INTERVAL, debounce: float = DEBOUNCE) -> Iterator[ChangeSet]:
+        """Poll forever, yielding one ChangeSet per burst of edits once the tree has been quiet for debounce seconds."""
+        changed, deleted = set(), set()
+        last_change = None
+        while True:
+            time.sleep(interval)
+            changes = self.poll()
+            if changes.changed or changes.deleted:
+                changed = (changed | set(changes.changed)) - set(changes.deleted)
+                deleted = (deleted | set(changes.deleted)) - set(changes.changed)
+                last_change = time.monotonic()
+            elif last_change is not None and time.monotonic() - last_change >= debounce:
+                yield ChangeSet(changed=sorted(changed), deleted=sorted(deleted))
+                changed, deleted, last_change = set(), set(), None
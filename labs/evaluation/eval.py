@@ -1,13 +1,18 @@
 import sys
 import math
-from pydantic import BaseModel, Field
-from litellm import completion
+from pydantic import BaseModel, Field, ValidationError
 from dotenv import load_dotenv
+from common import usage, tracing
 from labs.evaluation.test import TestQuestion, load_tests
 from labs.rag_app.answer import fetch_context, answer_question
 
 load_dotenv(override=True)
 
+JUDGE_MODEL = "gpt-4.1-nano"
+JUDGE_BATCH_SIZE = 5
+JUDGE_SYSTEM_PROMPT = "You are an expert evaluator assessing the quality of answers. Evaluate the generated answer by comparing it to the reference answer. Only give 5/5 scores for perfect answers."
+JUDGE_DIMENSIONS = ["accuracy", "completeness", "relevance"]
+
 
 #-------------------RETRIEVAL EVALUATION--------------------------
 
@@ -53,6 +58,7 @@ def calculate_ndcg(keyword: str, retrieved_docs: list, k: int = 10) -> float:
     return dcg / idcg if idcg > 0 else 0.0
 
 
+@tracing.traced
 def evaluate_retrieval(test: TestQuestion, k: int = 10) -> RetrievalEval:
     """
     Evaluate retrieval performance for a test question.
@@ -66,7 +72,21 @@ def evaluate_retrieval(test: TestQuestion, k: int = 10) -> RetrievalEval:
     """
     # Retrieve documents using shared answer module
     retrieved_docs = fetch_context(test.question)
+    return score_retrieval(test, retrieved_docs, k)
+
 
+def score_retrieval(test: TestQuestion, retrieved_docs: list, k: int = 10) -> RetrievalEval:
+    """
+    Score already retrieved documents against a test question's keywords.
+
+    Args:
+        test: TestQuestion object containing question and keywords
+        retrieved_docs: Documents in retrieval order (anything with a page_content attribute)
+        k: Cutoff used for nDCG (default 10)
+
+    Returns:
+        RetrievalEval object with MRR, nDCG, and keyword coverage metrics
+    """
     # Calculate MRR (average across all keywords)
     mrr_scores = [calculate_mrr(keyword, retrieved_docs) for keyword in test.keywords]
     avg_mrr = sum(mrr_scores) / len(mrr_scores) if mrr_scores else 0.0
@@ -117,9 +137,84 @@ def _get_judge_prompt(test: TestQuestion, generated_answer: str) -> str:
         Provide detailed feedback and scores from 1 (very poor) to 5 (ideal) for each dimension. If the answer is wrong, then the accuracy score must be 1.
         """
 
+class AnswerEvals(BaseModel):
+    """LLM-as-a-judge evaluation of a batch of answers."""
+    evals: list[AnswerEval] = Field(description="One evaluation per numbered item, in the same order as the items were given")
+
+
+def _get_batch_judge_prompt(items: list[tuple[TestQuestion, str]]) -> str:
+    prompt = f"""
+        You will evaluate {len(items)} generated answers independently of each other.
+        Each item has a question, a generated answer and a reference answer.
+        """
+    for number, (test, generated_answer) in enumerate(items, start=1):
+        prompt += f"""
+        # ITEM {number}
+
+        Question:
+        {test.question}
+
+        Generated Answer:
+        {generated_answer}
+
+        Reference Answer:
+        {test.reference_answer}
+        """
+    prompt += f"""
+        Please evaluate each generated answer on three dimensions:
+        1. Accuracy: How factually correct is it compared to the reference answer? Only give 5/5 scores for perfect answers.
+        2. Completeness: How thoroughly does it address all aspects of the question, covering all the information from the reference answer?
+        3. Relevance: How well does it directly answer the specific question asked, giving no additional information?
+
+        Provide detailed feedback and scores from 1 (very poor) to 5 (ideal) for each dimension. If an answer is wrong, then its accuracy score must be 1.
+        Reply with exactly {len(items)} evaluations, in item order.
+        """
+    return prompt
+
+
+@tracing.traced
+def judge_answer(test: TestQuestion, generated_answer: str) -> AnswerEval:
+    """Score a single generated answer with the LLM judge."""
+    judge_messages = [
+        {"role": "system", "content": JUDGE_SYSTEM_PROMPT},
+        {"role": "user", "content": _get_judge_prompt(test, generated_answer)},
+    ]
+
+    # Call LLM judge with structured outputs
+    judge_response = usage.completion("judge", model=JUDGE_MODEL, messages=judge_messages, response_format=AnswerEval)
+
+    return AnswerEval.model_validate_json(judge_response.choices[0].message.content)
+
+
+@tracing.traced
+def judge_answers(items: list[tuple[TestQuestion, str]]) -> list[AnswerEval]:
+    """
+    Score several (test, generated answer) pairs with one judge call.
+    Falls back to judging each item on its own if the batch reply can't be parsed
+    or doesn't contain one evaluation per item.
+    """
+    if len(items) == 1:
+        return [judge_answer(*items[0])]
+
+    judge_messages = [
+        {"role": "system", "content": JUDGE_SYSTEM_PROMPT},
+        {"role": "user", "content": _get_batch_judge_prompt(items)},
+    ]
+    judge_response = usage.completion("judge", model=JUDGE_MODEL, messages=judge_messages, response_format=AnswerEvals)
+    try:
+        evals = AnswerEvals.model_validate_json(judge_response.choices[0].message.content).evals
+        if len(evals) == len(items):
+            return evals
+        print(f"Batch judge returned {len(evals)} evaluations for {len(items)} items; judging individually")
+    except ValidationError as e:
+        print(f"Batch judge reply could not be parsed ({e.error_count()} errors); judging individually")
+    return [judge_answer(test, generated_answer) for test, generated_answer in items]
+
+
+@tracing.traced
 def evaluate_answer(test: TestQuestion) -> tuple[AnswerEval, str, list]:
     """
-    Evaluate answer quality using LLM-as-a-judge (async).
+    Evaluate answer quality using LLM-as-a-judge.
 
     Args:
         test: TestQuestion object containing question and reference answer
@@ -130,41 +225,121 @@ def evaluate_answer(test: TestQuestion) -> tuple[AnswerEval, str, list]:
     # Get RAG response using shared answer module
     generated_answer, retrieved_docs = answer_question(test.question)
 
-    # LLM judge prompt
-    judge_messages = [
-        {"role": "system", "content": "You are an expert evaluator assessing the quality of answers. Evaluate the generated answer by comparing it to the reference answer. Only give 5/5 scores for perfect answers."},
-        {"role": "user", "content": _get_judge_prompt(test, generated_answer)},
-    ]
+    answer_eval = judge_answer(test, generated_answer)
 
-    # Call LLM judge with structured outputs (async)
-    MODEL = "gpt-4.1-nano"
-    judge_response = completion(model=MODEL, messages=judge_messages, response_format=AnswerEval)
+    return answer_eval, generated_answer, retrieved_docs
 
-    answer_eval = AnswerEval.model_validate_json(judge_response.choices[0].message.content)
 
-    return answer_eval, generated_answer, retrieved_docs
+def evaluate_answers(tests: list[TestQuestion], batch_size: int = JUDGE_BATCH_SIZE):
+    """
+    Evaluate answers for many tests, judging them batch_size at a time.
+    Yields (test, AnswerEval, generated_answer, retrieved_docs) in test order.
+    """
+    for start in range(0, len(tests), batch_size):
+        batch = tests[start:start + batch_size]
+        with tracing.span("evaluate_answers.batch", tests=len(batch)):
+            answers = [answer_question(test.question) for test in batch]
+            evals = judge_answers([(test, generated_answer) for test, (generated_answer, _) in zip(batch, answers)])
+        for test, answer_eval, (generated_answer, retrieved_docs) in zip(batch, evals, answers):
+            yield test, answer_eval, generated_answer, retrieved_docs
 
-#-------------------EVALUATE UTILITY FUNCTIONS--------------------------
-def evaluate_all_retrieval():
-    """Evaluate all retrieval tests."""
-    tests = load_tests()
-    total_tests = len(tests)
-    for index, test in enumerate(tests):
-        result: RetrievalEval = evaluate_retrieval(test)
-        progress = (index + 1) / total_tests
-        yield test, result, progress
 
+@tracing.traced
+def calibrate_judge(tests: list[TestQuestion], batch_size: int = JUDGE_BATCH_SIZE) -> dict[str, dict[str, float]]:
+    """
+    Compare batch judge scores with single-item judge scores on the same generated answers.
+    Returns the mean signed difference (batch - single) and mean absolute difference per dimension.
+    """
+    items = [(test, answer_question(test.question)[0]) for test in tests]
+    single = [judge_answer(test, generated_answer) for test, generated_answer in items]
+    batched = []
+    for start in range(0, len(items), batch_size):
+        batched.extend(judge_answers(items[start:start + batch_size]))
+
+    calibration = {}
+    for dimension in JUDGE_DIMENSIONS:
+        diffs = [getattr(b, dimension) - getattr(s, dimension) for b, s in zip(batched, single)]
+        calibration[dimension] = {
+            "mean_difference": sum(diffs) / len(diffs),
+            "mean_absolute_difference": sum(abs(d) for d in diffs) / len(diffs),
+        }
+    return calibration
+
+#-------------------COMBINED EVALUATION--------------------------
+
+@tracing.traced
+def evaluate_test(test: TestQuestion, k: int = 10) -> tuple[RetrievalEval, AnswerEval, str, list]:
+    """
+    Evaluate retrieval and answer quality for a test question from a single retrieval.
 
-def evaluate_all_answers():
-    """Evaluate all answers to tests using batched async execution."""
-    tests = load_tests()
+    Returns:
+        Tuple of (RetrievalEval object, AnswerEval object, generated_answer string, retrieved_docs list)
+    """
+    retrieved_docs = fetch_context(test.question)
+    retrieval_eval = score_retrieval(test, retrieved_docs, k)
+    generated_answer, _ = answer_question(test.question, docs=retrieved_docs)
+    answer_eval = judge_answer(test, generated_answer)
+    return retrieval_eval, answer_eval, generated_answer, retrieved_docs
+
+
+def evaluate_tests(tests: list[TestQuestion], batch_size: int = JUDGE_BATCH_SIZE, k: int = 10):
+    """
+    Evaluate retrieval and answers for many tests, retrieving once per test and judging batch_size at a time.
+    Yields (test, RetrievalEval, AnswerEval, generated_answer, retrieved_docs) in test order;
+    retrieval is scored at k, as in evaluate_test.
+    """
+    for start in range(0, len(tests), batch_size):
+        batch = tests[start:start + batch_size]
+        with tracing.span("evaluate_tests.batch", tests=len(batch)):
+            retrieved = [fetch_context(test.question) for test in batch]
+            answers = [answer_question(test.question, docs=docs)[0] for test, docs in zip(batch, retrieved)]
+            evals = judge_answers(list(zip(batch, answers)))
+        for test, docs, generated_answer, answer_eval in zip(batch, retrieved, answers, evals):
+            yield test, score_retrieval(test, docs, k), answer_eval, generated_answer, docs
+
+#-------------------EVALUATE UTILITY FUNCTIONS--------------------------
+def evaluate_all_retrieval(tests: list[TestQuestion] | None = None):
+    """Evaluate all retrieval tests (or the given tests, in the given order)."""
+    tests = tests or load_tests()
+    total_tests = len(tests)
+    start = usage.mark()
+    # Also reported when the consumer stops early or is cancelled, which closes the generator
+    try:
+        for index, test in enumerate(tests):
+            result: RetrievalEval = evaluate_retrieval(test)
+            progress = (index + 1) / total_tests
+            yield test, result, progress
+    finally:
+        usage.print_summary(start, title="Retrieval evaluation usage")
+
+
+def evaluate_all_answers(tests: list[TestQuestion] | None = None, batch_size: int = JUDGE_BATCH_SIZE):
+    """Evaluate all answers to tests (or the given tests), scoring them with the batched judge."""
+    tests = tests or load_tests()
     total_tests = len(tests)
-    for index, test in enumerate(tests):
-        result: AnswerEval = evaluate_answer(test)[0]
-        progress = (index + 1) / total_tests
-        yield test, result, progress
+    start = usage.mark()
+    try:
+        for index, (test, result, _, _) in enumerate(evaluate_answers(tests, batch_size)):
+            progress = (index + 1) / total_tests
+            yield test, result, progress
+    finally:
+        usage.print_summary(start, title="Answer evaluation usage")
+
+
+def evaluate_all(tests: list[TestQuestion] | None = None, batch_size: int = JUDGE_BATCH_SIZE):
+    """Evaluate retrieval and answers for all tests (or the given tests) in a single pass."""
+    tests = tests or load_tests()
+    total_tests = len(tests)
+    start = usage.mark()
+    try:
+        for index, (test, retrieval_result, answer_result, _, _) in enumerate(evaluate_tests(tests, batch_size)):
+            progress = (index + 1) / total_tests
+            yield test, retrieval_result, answer_result, progress
+    finally:
+        usage.print_summary(start, title="Evaluation usage")
 
 
+@tracing.traced
 def run_specific_evaluation(test_number: int):
     """Run evaluation for a specific test"""
     tests = load_tests()
@@ -189,7 +364,8 @@ def run_specific_evaluation(test_number: int):
     print("Retrieval Evaluation")
     print(f"{'=' * 80}")
 
-    retrieval_result = evaluate_retrieval(test)
+    start = usage.mark()
+    retrieval_result, answer_result, generated_answer, retrieved_docs = evaluate_test(test)
 
     print(f"MRR: {retrieval_result.mrr:.4f}")
     print(f"nDCG: {retrieval_result.ndcg:.4f}")
@@ -201,8 +377,6 @@ def run_specific_evaluation(test_number: int):
     print("Answer Evaluation")
     print(f"{'=' * 80}")
 
-    answer_result, generated_answer, retrieved_docs = evaluate_answer(test)
-
     print(f"\nGenerated Answer:\n{generated_answer}")
     print(f"\nFeedback:\n{answer_result.feedback}")
     print("\nScores:")
@@ -210,6 +384,7 @@ def run_specific_evaluation(test_number: int):
     print(f"  Completeness: {answer_result.completeness:.2f}/5")
     print(f"  Relevance: {answer_result.relevance:.2f}/5")
     print(f"\n{'=' * 80}\n")
+    usage.print_summary(start)
 
 
 if __name__ == "__main__":
@@ -238,12 +413,16 @@ if __name__ == "__main__":
     
     
     print("Evaluating all retrieval tests...")
-    evaluate_all_retrieval()
     [print(f"RetrievalEval Result {result} - Progress: {progress:.2%}") for test, result, progress in evaluate_all_retrieval(tests)]
     
     print("Evaluating all answers to tests...")
-    evaluate_all_answers()
     [print(f"AnswerEval Result {result} - Progress: {progress:.2%}") for test, result, progress in evaluate_all_answers(tests)]
     
     print("Running specific evaluation for test ...")
     run_specific_evaluation(1)
+
+    print("Calibrating batch judge against single-item judge...")
+    for dimension, stats in calibrate_judge(tests[:2 * JUDGE_BATCH_SIZE]).items():
+        print(f"{dimension}: mean difference {stats['mean_difference']:+.2f}, mean absolute difference {stats['mean_absolute_difference']:.2f}")
+
+    usage.print_summary()
@@ -1,8 +1,13 @@
+import math
+import random
+import statistics
 import gradio as gr
 import pandas as pd
 from collections import defaultdict
+from contextlib import closing
 from dotenv import load_dotenv
-from eval import evaluate_all_retrieval, evaluate_all_answers
+from labs.evaluation.eval import evaluate_all_retrieval, evaluate_all_answers, evaluate_all
+from labs.evaluation.test import TestQuestion, load_tests
 
 load_dotenv(override=True)
 
@@ -18,6 +23,12 @@ COVERAGE_AMBER = 75.0
 ANSWER_GREEN = 4.5
 ANSWER_AMBER = 4.0
 
+# Early stopping - stop once the 95% confidence interval of the running mean is tight enough
+Z_95 = 1.96
+MIN_TESTS_BEFORE_STOPPING = 20
+MRR_RANGE = 1.0
+ACCURACY_RANGE = 4.0  # scores run from 1 to 5
+
 
 def get_color(value: float, metric_type: str) -> str:
     """Get color based on metric value and type."""
@@ -75,43 +86,73 @@ def format_metric_html(
     """
 
 
-def run_retrieval_evaluation(progress=gr.Progress()):
-    """Run retrieval evaluation and yield updates."""
+def confidence_half_width(values: list[float]) -> float:
+    """Half-width of the 95% confidence interval for the mean of values."""
+    if len(values) < 2:
+        return float("inf")
+    return Z_95 * statistics.stdev(values) / math.sqrt(len(values))
+
+
+def is_confident(values: list[float], ci_target: float, metric_range: float) -> bool:
+    """True once enough tests have run and the CI half-width is within ci_target percent of the metric range."""
+    return len(values) >= MIN_TESTS_BEFORE_STOPPING and confidence_half_width(values) <= ci_target / 100 * metric_range
+
+
+def evaluation_tests(early_stop: bool) -> list[TestQuestion]:
+    """Load the tests; shuffle them when stopping early so any prefix is a fair sample across categories."""
+    tests = load_tests()
+    if early_stop:
+        random.Random(42).shuffle(tests)
+    return tests
+
+
+def status_html(count: int, total: int, stopped_early: bool, half_width: float) -> str:
+    """Banner under the metrics showing whether the run is in progress, complete or stopped early."""
+    ci = f" (95% CI ±{half_width:.3f})" if math.isfinite(half_width) else ""
+    if stopped_early:
+        background, border, color, text = "#fff3cd", "#ffeeba", "#856404", f"⏹ Stopped early after {count}/{total} tests{ci}"
+    elif count == total:
+        background, border, color, text = "#d4edda", "#c3e6cb", "#155724", f"✓ Evaluation Complete: {count} tests"
+    else:
+        background, border, color, text = "#e7f1ff", "#b8daff", "#004085", f"⏳ Evaluated {count}/{total} tests{ci}"
+    return f"""
+        <div style="margin-top: 20px; padding: 10px; background-color: {background}; border-radius: 5px; text-align: center; border: 1px solid {border};">
+            <span style="font-size: 14px; color: {color}; font-weight: bold;">{text}</span>
+        </div>
+    """
+
+
+def retrieval_outputs(results: list, status: str) -> tuple[str, pd.DataFrame, pd.DataFrame]:
+    """Build the running metrics HTML, category chart data and per-test table from (test, RetrievalEval) pairs."""
     total_mrr = 0.0
     total_ndcg = 0.0
     total_coverage = 0.0
     category_mrr = defaultdict(list)
-    count = 0
+    count = len(results)
 
-    for test, result, prog_value in evaluate_all_retrieval():
-        count += 1
+    for test, result in results:
         total_mrr += result.mrr
         total_ndcg += result.ndcg
         total_coverage += result.keyword_coverage
 
         category_mrr[test.category].append(result.mrr)
 
-        # Update progress bar only
-        progress(prog_value, desc=f"Evaluating test {count}...")
-
-    # Calculate final averages
+    # Calculate running averages
     avg_mrr = total_mrr / count
     avg_ndcg = total_ndcg / count
     avg_coverage = total_coverage / count
 
-    # Create final summary metrics HTML
+    # Create summary metrics HTML
     final_html = f"""
     <div style="padding: 0;">
         {format_metric_html("Mean Reciprocal Rank (MRR)", avg_mrr, "mrr")}
         {format_metric_html("Normalized DCG (nDCG)", avg_ndcg, "ndcg")}
         {format_metric_html("Keyword Coverage", avg_coverage, "coverage", is_percentage=True)}
-        <div style="margin-top: 20px; padding: 10px; background-color: #d4edda; border-radius: 5px; text-align: center; border: 1px solid #c3e6cb;">
-            <span style="font-size: 14px; color: #155724; font-weight: bold;">✓ Evaluation Complete: {count} tests</span>
-        </div>
+        {status}
     </div>
     """
 
-    # Create final bar chart data
+    # Create bar chart data
     category_data = []
     for category, mrr_scores in category_mrr.items():
         avg_cat_mrr = sum(mrr_scores) / len(mrr_scores)
@@ -119,46 +160,53 @@ def run_retrieval_evaluation(progress=gr.Progress()):
 
     df = pd.DataFrame(category_data)
 
-    return final_html, df
+    table = pd.DataFrame(
+        [
+            {
+                "Question": test.question,
+                "Category": test.category,
+                "MRR": round(result.mrr, 4),
+                "nDCG": round(result.ndcg, 4),
+                "Coverage": round(result.keyword_coverage, 1),
+            }
+            for test, result in results
+        ]
+    )
+
+    return final_html, df, table
 
 
-def run_answer_evaluation(progress=gr.Progress()):
-    """Run answer evaluation and yield updates (async)."""
+def answer_outputs(results: list, status: str) -> tuple[str, pd.DataFrame, pd.DataFrame]:
+    """Build the running metrics HTML, category chart data and per-test table from (test, AnswerEval) pairs."""
     total_accuracy = 0.0
     total_completeness = 0.0
     total_relevance = 0.0
     category_accuracy = defaultdict(list)
-    count = 0
+    count = len(results)
 
-    for test, result, prog_value in evaluate_all_answers():
-        count += 1
+    for test, result in results:
         total_accuracy += result.accuracy
         total_completeness += result.completeness
         total_relevance += result.relevance
 
         category_accuracy[test.category].append(result.accuracy)
 
-        # Update progress bar only
-        progress(prog_value, desc=f"Evaluating test {count}...")
-
-    # Calculate final averages
+    # Calculate running averages
     avg_accuracy = total_accuracy / count
     avg_completeness = total_completeness / count
     avg_relevance = total_relevance / count
 
-    # Create final summary metrics HTML
+    # Create summary metrics HTML
     final_html = f"""
     <div style="padding: 0;">
         {format_metric_html("Accuracy", avg_accuracy, "accuracy", score_format=True)}
         {format_metric_html("Completeness", avg_completeness, "completeness", score_format=True)}
         {format_metric_html("Relevance", avg_relevance, "relevance", score_format=True)}
-        <div style="margin-top: 20px; padding: 10px; background-color: #d4edda; border-radius: 5px; text-align: center; border: 1px solid #c3e6cb;">
-            <span style="font-size: 14px; color: #155724; font-weight: bold;">✓ Evaluation Complete: {count} tests</span>
-        </div>
+        {status}
     </div>
     """
 
-    # Create final bar chart data
+    # Create bar chart data
     category_data = []
     for category, accuracy_scores in category_accuracy.items():
         avg_cat_accuracy = sum(accuracy_scores) / len(accuracy_scores)
@@ -166,7 +214,83 @@ def run_answer_evaluation(progress=gr.Progress()):
 
     df = pd.DataFrame(category_data)
 
-    return final_html, df
+    table = pd.DataFrame(
+        [
+            {
+                "Question": test.question,
+                "Category": test.category,
+                "Accuracy": result.accuracy,
+                "Completeness": result.completeness,
+                "Relevance": result.relevance,
+                "Feedback": result.feedback,
+            }
+            for test, result in results
+        ]
+    )
+
+    return final_html, df, table
+
+
+def run_retrieval_evaluation(early_stop: bool = False, ci_target: float = 5.0, progress=gr.Progress()):
+    """Run retrieval evaluation and yield updates after every test."""
+    tests = evaluation_tests(early_stop)
+    results = []
+
+    # Closed on early stop or cancellation, so the run's usage summary is printed straight away
+    with closing(evaluate_all_retrieval(tests)) as evaluations:
+        for test, result, prog_value in evaluations:
+            results.append((test, result))
+            progress(prog_value, desc=f"Evaluating test {len(results)}...")
+
+            mrr_scores = [r.mrr for _, r in results]
+            stop = early_stop and is_confident(mrr_scores, ci_target, MRR_RANGE)
+            status = status_html(len(results), len(tests), stop and len(results) < len(tests), confidence_half_width(mrr_scores))
+            yield retrieval_outputs(results, status)
+            if stop:
+                break
+
+
+def run_answer_evaluation(early_stop: bool = False, ci_target: float = 5.0, progress=gr.Progress()):
+    """Run answer evaluation and yield updates as each test is judged."""
+    tests = evaluation_tests(early_stop)
+    results = []
+
+    with closing(evaluate_all_answers(tests)) as evaluations:
+        for test, result, prog_value in evaluations:
+            results.append((test, result))
+            progress(prog_value, desc=f"Evaluating test {len(results)}...")
+
+            accuracy_scores = [r.accuracy for _, r in results]
+            stop = early_stop and is_confident(accuracy_scores, ci_target, ACCURACY_RANGE)
+            status = status_html(len(results), len(tests), stop and len(results) < len(tests), confidence_half_width(accuracy_scores))
+            yield answer_outputs(results, status)
+            if stop:
+                break
+
+
+def run_full_evaluation(early_stop: bool = False, ci_target: float = 5.0, progress=gr.Progress()):
+    """Run retrieval and answer evaluation together, retrieving once per test and yielding updates as results arrive."""
+    tests = evaluation_tests(early_stop)
+    retrieval_results = []
+    answer_results = []
+
+    with closing(evaluate_all(tests)) as evaluations:
+        for test, retrieval_result, answer_result, prog_value in evaluations:
+            retrieval_results.append((test, retrieval_result))
+            answer_results.append((test, answer_result))
+            progress(prog_value, desc=f"Evaluating test {len(retrieval_results)}...")
+
+            mrr_scores = [r.mrr for _, r in retrieval_results]
+            accuracy_scores = [r.accuracy for _, r in answer_results]
+            # Both metrics have to be tight before the run stops
+            stop = early_stop and is_confident(mrr_scores, ci_target, MRR_RANGE) and is_confident(accuracy_scores, ci_target, ACCURACY_RANGE)
+            stopped_early = stop and len(retrieval_results) < len(tests)
+            yield (
+                *retrieval_outputs(retrieval_results, status_html(len(retrieval_results), len(tests), stopped_early, confidence_half_width(mrr_scores))),
+                *answer_outputs(answer_results, status_html(len(answer_results), len(tests), stopped_early, confidence_half_width(accuracy_scores))),
+            )
+            if stop:
+                break
 
 
 def main():
@@ -177,6 +301,20 @@ def main():
         gr.Markdown("# 📊 RAG Evaluation Dashboard")
         gr.Markdown("Evaluate retrieval and answer quality for the Insurellm RAG system")
 
+        with gr.Row():
+            both_button = gr.Button("Run Both Evaluations", variant="secondary", size="lg")
+            stop_button = gr.Button("Stop", variant="stop", size="lg")
+
+        with gr.Row():
+            early_stop = gr.Checkbox(
+                label="Stop early once the 95% confidence interval is tight enough (tests run in shuffled order)",
+                value=False,
+            )
+            ci_target = gr.Slider(
+                minimum=1, maximum=20, value=5, step=1,
+                label="Target CI half-width (% of the metric range)",
+            )
+
         # RETRIEVAL SECTION
         gr.Markdown("## 🔍 Retrieval Evaluation")
 
@@ -197,6 +335,8 @@ def main():
                     height=400,
                 )
 
+        retrieval_table = gr.Dataframe(label="Per-test retrieval results", wrap=True)
+
         # ANSWERING SECTION
         gr.Markdown("## 💬 Answer Evaluation")
 
@@ -217,17 +357,29 @@ def main():
                     height=400,
                 )
 
+        answer_table = gr.Dataframe(label="Per-test answer results", wrap=True)
+
         # Wire up the evaluations
-        retrieval_button.click(
+        retrieval_event = retrieval_button.click(
             fn=run_retrieval_evaluation,
-            outputs=[retrieval_metrics, retrieval_chart],
+            inputs=[early_stop, ci_target],
+            outputs=[retrieval_metrics, retrieval_chart, retrieval_table],
         )
 
-        answer_button.click(
+        answer_event = answer_button.click(
             fn=run_answer_evaluation,
-            outputs=[answer_metrics, answer_chart],
+            inputs=[early_stop, ci_target],
+            outputs=[answer_metrics, answer_chart, answer_table],
         )
 
+        both_event = both_button.click(
+            fn=run_full_evaluation,
+            inputs=[early_stop, ci_target],
+            outputs=[retrieval_metrics, retrieval_chart, retrieval_table, answer_metrics, answer_chart, answer_table],
+        )
+
+        stop_button.click(fn=None, cancels=[retrieval_event, answer_event, both_event])
+
     app.launch(inbrowser=True)
 
 
@@ -0,0 +1,188 @@
+import re
+import json
+import time
+import random
+import argparse
+import itertools
+from pathlib import Path
+from multiprocessing import Pool
+import pandas as pd
+import tiktoken
+from tqdm import tqdm
+from pydantic import BaseModel
+from dotenv import load_dotenv
+from langchain_chroma import Chroma
+from labs.evaluation.test import TestQuestion, load_tests
+from labs.evaluation.eval import score_retrieval
+from labs.rag_app.ingest import (
+    MODEL,
+    fetch_documents,
+    create_chunks,
+    make_embeddings,
+    create_vector_store_with_embeddings,
+)
+
+load_dotenv(override=True)
+
+SWEEP_DB_PATH = Path(__file__).parent.parent / "sweep_db"
+WORKERS = 4
+COMPLETE_MARKER = ".complete"  # written into an index directory once its build has finished, with its token count
+
+# Quality metrics are maximised, cost metrics are minimised when computing the Pareto front
+QUALITY_COLUMNS = ["mrr", "ndcg", "coverage"]
+COST_COLUMNS = ["latency_ms", "context_tokens"]
+
+tests: list[TestQuestion] = []
+
+
+class SweepConfig(BaseModel):
+    """One point of the parameter grid."""
+    embedding_model: str
+    chunk_size: int
+    chunk_overlap: int
+    retrieval_k: int
+
+    @property
+    def index_key(self) -> tuple[str, int, int]:
+        """Configurations with the same key share one vector store."""
+        return self.embedding_model, self.chunk_size, self.chunk_overlap
+
+    @property
+    def index_path(self) -> str:
+        slug = re.sub(r"[^A-Za-z0-9.-]+", "_", self.embedding_model)
+        return str(SWEEP_DB_PATH / f"{slug}-{self.chunk_size}-{self.chunk_overlap}")
+
+    @property
+    def index_complete(self) -> bool:
+        return (Path(self.index_path) / COMPLETE_MARKER).exists()
+
+    def recorded_tokens(self) -> int | None:
+        """Tokens embedded to build the index, as recorded in its completion marker (None for an older, empty one)."""
+        text = (Path(self.index_path) / COMPLETE_MARKER).read_text(encoding="utf-8").strip()
+        return json.loads(text)["tokens"] if text else None
+
+
+def make_grid(embedding_models, chunk_sizes, chunk_overlaps, retrieval_ks) -> list[SweepConfig]:
+    """Expand the parameter lists into configurations, skipping overlaps that don't fit the chunk size."""
+    grid = []
+    for model, size, overlap, k in itertools.product(embedding_models, chunk_sizes, chunk_overlaps, retrieval_ks):
+        if overlap >= size:
+            print(f"Skipping chunk_size={size} with chunk_overlap={overlap}: overlap must be smaller than the chunk size")
+            continue
+        grid.append(SweepConfig(embedding_model=model, chunk_size=size, chunk_overlap=overlap, retrieval_k=k))
+    return grid
+
+
+def build_indexes(grid: list[SweepConfig], rebuild: bool = False) -> dict[tuple, int]:
+    """
+    Build every distinct index variant needed by the grid exactly once.
+    Finished variants on disk are reused unless rebuild is set; one left half-built by an interrupted
+    run has no completion marker and is built again.
+    Returns the number of tokens embedded per index key, the same whether the index was built now or
+    reused, so the indexing cost doesn't depend on earlier runs.
+    """
+    encoding = tiktoken.encoding_for_model(MODEL)
+    documents = fetch_documents()
+    index_tokens = {}
+    for config in {config.index_key: config for config in grid}.values():
+        if config.index_complete and not rebuild:
+            print(f"Reusing index {config.index_path}")
+            tokens = config.recorded_tokens()
+            if tokens is None:
+                # Chunking is deterministic, so the chunks of the stored index can be counted again
+                chunks = create_chunks(documents, config.chunk_size, config.chunk_overlap)
+                tokens = sum(len(encoding.encode(chunk.page_content)) for chunk in chunks)
+            index_tokens[config.index_key] = tokens
+            continue
+        print(f"Building index {config.index_path}")
+        chunks = create_chunks(documents, config.chunk_size, config.chunk_overlap)
+        embeddings = make_embeddings(config.embedding_model)
+        (Path(config.index_path) / COMPLETE_MARKER).unlink(missing_ok=True)
+        create_vector_store_with_embeddings(chunks, embeddings, db_name=config.index_path)
+        tokens = sum(len(encoding.encode(chunk.page_content)) for chunk in chunks)
+        (Path(config.index_path) / COMPLETE_MARKER).write_text(json.dumps({"tokens": tokens}), encoding="utf-8")
+        index_tokens[config.index_key] = tokens
+    return index_tokens
+
+
+def init_worker(worker_tests: list[TestQuestion]):
+    global tests
+    tests = worker_tests
+
+
+def evaluate_config(config: SweepConfig) -> dict:
+    """Run every test question against one configuration; executed in a worker process."""
+    encoding = tiktoken.encoding_for_model(MODEL)
+    vectorstore = Chroma(persist_directory=config.index_path, embedding_function=make_embeddings(config.embedding_model))
+    mrr, ndcg, coverage, latency, context_tokens = [], [], [], [], []
+    for test in tests:
+        start = time.perf_counter()
+        docs = vectorstore.similarity_search(test.question, k=config.retrieval_k)
+        latency.append(time.perf_counter() - start)
+        result = score_retrieval(test, docs, k=config.retrieval_k)
+        mrr.append(result.mrr)
+        ndcg.append(result.ndcg)
+        coverage.append(result.keyword_coverage)
+        context_tokens.append(sum(len(encoding.encode(doc.page_content)) for doc in docs))
+    count = len(tests)
+    return {
+        **config.model_dump(),
+        "mrr": sum(mrr) / count,
+        "ndcg": sum(ndcg) / count,
+        "coverage": sum(coverage) / count,
+        "latency_ms": 1000 * sum(latency) / count,
+        "context_tokens": sum(context_tokens) / count,
+    }
+
+
+def pareto_front(df: pd.DataFrame) -> list[bool]:
+    """Flag the rows that no other row beats on every quality and cost column at once."""
+    rows = df[QUALITY_COLUMNS + COST_COLUMNS].to_dict("records")
+
+    def dominates(a, b):
+        no_worse = all(a[c] >= b[c] for c in QUALITY_COLUMNS) and all(a[c] <= b[c] for c in COST_COLUMNS)
+        better = any(a[c] > b[c] for c in QUALITY_COLUMNS) or any(a[c] < b[c] for c in COST_COLUMNS)
+        return no_worse and better
+
+    return [not any(dominates(other, row) for other in rows) for row in rows]
+
+
+def run_sweep(grid: list[SweepConfig], sample: int | None = None, workers: int = WORKERS, rebuild: bool = False) -> pd.DataFrame:
+    """Build the index variants, evaluate each configuration in parallel and return the results table."""
+    index_tokens = build_indexes(grid, rebuild)
+
+    sweep_tests = load_tests()
+    if sample and sample < len(sweep_tests):
+        # tests.jsonl is grouped by category, so sample rather than take the first N
+        sweep_tests = random.Random(42).sample(sweep_tests, sample)
+    print(f"Evaluating {len(grid)} configurations on {len(sweep_tests)} tests with {workers} workers")
+
+    results = []
+    with Pool(processes=workers, initializer=init_worker, initargs=(sweep_tests,)) as pool:
+        for result in tqdm(pool.imap_unordered(evaluate_config, grid), total=len(grid)):
+            results.append(result)
+
+    df = pd.DataFrame(results)
+    df["index_tokens"] = [index_tokens[(r["embedding_model"], r["chunk_size"], r["chunk_overlap"])] for r in results]
+    df["pareto"] = pareto_front(df)
+    return df.sort_values(["pareto", "mrr"], ascending=False).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep retrieval parameters for the rag_app pipeline")
+    parser.add_argument("--embedding-models", nargs="+", default=["text-embedding-3-large"])
+    parser.add_argument("--chunk-sizes", nargs="+", type=int, default=[500])
+    parser.add_argument("--chunk-overlaps", nargs="+", type=int, default=[200])
+    parser.add_argument("--retrieval-ks", nargs="+", type=int, default=[10])
+    parser.add_argument("--sample", type=int, default=None, help="Evaluate on a random sample of the tests")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild index variants that already exist on disk")
+    parser.add_argument("--output", default=None, help="Optional CSV path for the results table")
+    args = parser.parse_args()
+
+    grid = make_grid(args.embedding_models, args.chunk_sizes, args.chunk_overlaps, args.retrieval_ks)
+    df = run_sweep(grid, sample=args.sample, workers=args.workers, rebuild=args.rebuild)
+    print(df.to_string(float_format=lambda v: f"{v:.4f}"))
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print(f"Results written to {args.output}")
@@ -4,6 +4,7 @@ from dotenv import load_dotenv
 from pathlib import Path
 import gradio as gr
 from openai import OpenAI
+from common.entities import get_entity_index
 
 load_dotenv(override=True)
 openai_api_key = os.getenv('OPENAI_API_KEY')
@@ -49,11 +50,12 @@ def get_relevant_context_simple(message):
             relevant_context.append(knowledge[word])
     return relevant_context  
 
-# This is just a more pythonic way to write the above get_relevant_context_simple()
+# The simple version above only matches single words and keeps one document per surname.
+# This one uses the entity index: full names, aliases, contract parties and company topics from
+# all four knowledge-base folders, matched in a single pass, with shared surnames returning every match.
 def get_relevant_context(message):
-    text = ''.join(ch for ch in message if ch.isalpha() or ch.isspace())
-    words = text.lower().split()
-    return [knowledge[word] for word in words if word in knowledge]   
+    index = get_entity_index()
+    return [index.text(source) for source in index.sources(message)]
 
 def additional_context(message):
     relevant_context = get_relevant_context(message)
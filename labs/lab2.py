@@ -1,5 +1,6 @@
 import os
 import glob
+import hashlib
 import tiktoken
 import numpy as np
 from dotenv import load_dotenv
@@ -8,11 +9,18 @@ from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pathlib import Path
+from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 import plotly.graph_objects as go
 
 MODEL = "gpt-4.1-nano"
 db_name = "vector_db"
+EXPORT_PAGE_SIZE = 1000  # records or vectors fetched from Chroma per get() call
+PCA_COMPONENTS = 50  # dimensions kept before t-SNE / UMAP
+PROJECTION_METHOD = "tsne"  # "tsne", "pca" (randomized, near instant) or "umap" (needs umap-learn)
+PROJECTION_CACHE = Path(__file__).parent / "projection_cache"
+DOC_TYPE_COLORS = {'products': 'blue', 'employees': 'green', 'contracts': 'red', 'company': 'orange'}
 load_dotenv(override=True)
 openai_api_key = os.getenv('OPENAI_API_KEY')
 if openai_api_key:
@@ -91,22 +99,86 @@ def investigate_vector_store(vectorstore: Chroma):
     print(f"There are {count:,} vectors with {dimensions:,} dimensions in the vector store")
 
 
+def export_records(collection, page_size: int = EXPORT_PAGE_SIZE):
+    """Page through a Chroma collection for its ids, documents and metadatas, without the embeddings."""
+    ids, documents, metadatas = [], [], []
+    for offset in range(0, collection.count(), page_size):
+        page = collection.get(offset=offset, limit=page_size, include=["documents", "metadatas"])
+        ids.extend(page["ids"])
+        documents.extend(page["documents"])
+        metadatas.extend(page["metadatas"])
+    return ids, documents, metadatas
+
+
+def export_vectors(collection, ids: list[str], page_size: int = EXPORT_PAGE_SIZE) -> np.ndarray:
+    """The embeddings of ids, in that order, paged into a preallocated float32 array."""
+    if not ids:
+        return np.empty((0, 0), dtype=np.float32)
+    dimensions = len(collection.get(ids=ids[:1], include=["embeddings"])["embeddings"][0])
+    vectors = np.empty((len(ids), dimensions), dtype=np.float32)
+    rows = {id: row for row, id in enumerate(ids)}
+    for offset in range(0, len(ids), page_size):
+        page = collection.get(ids=ids[offset:offset + page_size], include=["embeddings"])
+        # get() by ids doesn't promise to keep their order, so each vector goes to its id's row
+        vectors[[rows[id] for id in page["ids"]]] = page["embeddings"]
+    return vectors
+
+
+def collection_version(collection, ids: list[str]) -> str:
+    """Changes whenever the collection is rebuilt or chunks are added or removed."""
+    digest = hashlib.sha256(str(collection.id).encode())
+    for id in ids:
+        digest.update(id.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def project(vectors: np.ndarray, n_components: int, method: str = PROJECTION_METHOD) -> np.ndarray:
+    """Reduce vectors to n_components dimensions, with a PCA step first so t-SNE / UMAP work on PCA_COMPONENTS dims."""
+    if method == "pca":
+        return PCA(n_components=n_components, svd_solver="randomized", random_state=42).fit_transform(vectors)
+    if vectors.shape[1] > PCA_COMPONENTS and len(vectors) > PCA_COMPONENTS:
+        vectors = PCA(n_components=PCA_COMPONENTS, svd_solver="randomized", random_state=42).fit_transform(vectors)
+    if method == "umap":
+        try:
+            from umap import UMAP
+        except ImportError as e:
+            raise ImportError("PROJECTION_METHOD 'umap' needs the umap-learn package") from e
+        return UMAP(n_components=n_components, random_state=42).fit_transform(vectors)
+    return TSNE(n_components=n_components, init="pca", random_state=42).fit_transform(vectors)
+
+
 class VisualizationData:
     def __init__(self, vectorstore: Chroma):
         self.vectorstore = vectorstore
         self.collection = vectorstore._collection
-        self.result = self.collection.get(include=['embeddings', 'documents', 'metadatas'])
-        self.vectors = np.array(self.result['embeddings'])
-        self.documents = self.result['documents']
-        self.metadatas = self.result['metadatas']
+        # The embeddings are the bulk of the collection; they are only read when a projection isn't cached
+        self.ids, self.documents, self.metadatas = export_records(self.collection)
+        self.version = collection_version(self.collection, self.ids)
         self.doc_types = [metadata['doc_type'] for metadata in self.metadatas]
-        self.colors = [['blue', 'green', 'red', 'orange'][['products', 'employees', 'contracts', 'company'].index(t)] for t in self.doc_types]
+        self.colors = [DOC_TYPE_COLORS[t] for t in self.doc_types]
+        self._vectors = None
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            self._vectors = export_vectors(self.collection, self.ids)
+        return self._vectors
+
+    def projection(self, n_components: int, method: str = PROJECTION_METHOD) -> np.ndarray:
+        """Projected vectors, computed once per collection version and method and then read from disk."""
+        path = PROJECTION_CACHE / f"{self.version}_{method}_{n_components}d.npy"
+        if path.exists():
+            return np.load(path)
+        reduced_vectors = project(self.vectors, n_components, method)
+        PROJECTION_CACHE.mkdir(parents=True, exist_ok=True)
+        np.save(path, reduced_vectors)
+        return reduced_vectors
 
 def visualize_2d(visualization_data: VisualizationData):
     # Reduce the dimensionality of the vectors to 2D using t-SNE
-    # (t-distributed stochastic neighbor embedding)
-    tsne = TSNE(n_components=2, random_state=42)
-    reduced_vectors = tsne.fit_transform(visualization_data.vectors)
+    # (t-distributed stochastic neighbor embedding), after a PCA step; cached per collection version
+    reduced_vectors = visualization_data.projection(2)
     # Create the 2D scatter plot
     fig = go.Figure(data=[go.Scatter(
         x=reduced_vectors[:, 0],
@@ -128,8 +200,7 @@ def visualize_2d(visualization_data: VisualizationData):
 
 
 def visualize_3d(visualization_data: VisualizationData):
-    tsne = TSNE(n_components=3, random_state=42)
-    reduced_vectors = tsne.fit_transform(visualization_data.vectors)
+    reduced_vectors = visualization_data.projection(3)
     # Create the 3D scatter plot
     fig = go.Figure(data=[go.Scatter3d(
         x=reduced_vectors[:, 0],
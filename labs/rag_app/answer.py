@@ -1,20 +1,51 @@
+from __future__ import annotations
+
+import time
+import threading
 from pathlib import Path
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_core.messages import SystemMessage, HumanMessage, convert_to_messages
-from langchain_core.documents import Document
+from functools import cache
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
+from common import usage, tracing
+from common.history import HistoryManager, SUMMARY_PROMPT, format_messages
+from common.packing import pack_context
+from common.batching import EmbeddingBatcher
+from common.entities import get_entity_index
+from common.routing import get_router
+from common.documents import DocumentStore, docstore_path, expand_to_parents
+from common.sharding import ShardLayout, query_shards
+from common.resultset import ResultSet
+from common.snapshot import check_embedding_model, read_ingest_manifest
+from common.singleflight import SingleFlight, question_key
+from common.sharedcache import get_shared_cache
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import Embeddings
+    from langchain_openai import ChatOpenAI
 
 load_dotenv(override=True)
 
 MODEL = "gpt-4.1-nano"
+# For an index built with ingest.py --local, use "all-MiniLM-L6-v2" and "vector_db_local_embeddings";
+# for ingest.py --small-to-big, use "vector_db_small_to_big"
+EMBEDDING_MODEL = "text-embedding-3-large"
 DB_NAME = str(Path(__file__).parent.parent / "vector_db_openai_embeddings")
+KNOWLEDGE_BASE_PATH = Path(__file__).parent.parent.parent / "knowledge-base"
+COLLECTION_NAME = "langchain"
 
 RETRIEVAL_K = 10
-
-retriever = None
-llm = None
+SUMMARIZE_HISTORY = True
+CONTEXT_TOKEN_BUDGET = 3000
+EMBED_BATCHING = True  # share query-embedding calls between concurrent requests
+# With no reranker here, entity hits go straight to the top of the context, so this is opt-in
+ENTITY_PRESEARCH = False
+ENTITY_K = 3
+ROUTE_QUERIES = True  # search only the document types the question is about, when the router is confident
+SMALL_TO_BIG = True  # expand hits that carry parent offsets to their whole section, if the index has a document store
+COALESCE_REQUESTS = True  # identical questions asked concurrently (with the same history) share one answer
+INDEX_CHECK_INTERVAL = 2.0  # seconds between checks for a rebuilt index (a new ingest manifest)
 
 SYSTEM_PROMPT = """
 You are a knowledgeable, friendly assistant representing the company Insurellm.
@@ -25,26 +56,159 @@ Context:
 {context}
 """
 
-embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-vectorstore:Chroma = Chroma(persist_directory=DB_NAME, embedding_function=embeddings)
-retriever = vectorstore.as_retriever()
-llm:ChatOpenAI = ChatOpenAI(temperature=0, model_name=MODEL)
+
+# The clients and the vector store are created on first use, so importing this module stays cheap
+@cache
+def get_embeddings() -> Embeddings:
+    if EMBEDDING_MODEL.startswith("text-embedding"):
+        from langchain_openai import OpenAIEmbeddings
+
+        return OpenAIEmbeddings(model=EMBEDDING_MODEL)
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+
+
+class Index:
+    """The layout, vector stores and document store of one build of DB_NAME, swapped as a whole when ingest.py rebuilds it."""
+
+    def __init__(self, version: float | None):
+        from langchain_chroma import Chroma
+
+        check_embedding_model(read_ingest_manifest(DB_NAME), EMBEDDING_MODEL, DB_NAME)
+        self.version = version
+        self.layout = ShardLayout.load(DB_NAME, COLLECTION_NAME, "doc_type")
+        # One vector store per shard collection, as laid out by ingest.py --shards / --shard-by
+        self.shards = {name: Chroma(collection_name=name, persist_directory=DB_NAME, embedding_function=get_embeddings()) for name in self.layout.names()}
+        path = docstore_path(DB_NAME)
+        self.document_store = DocumentStore(path) if path.exists() else None
+
+
+_index = None
+_index_checked = 0.0
+_index_lock = threading.Lock()
+
+
+def index_version() -> float | None:
+    """When the index in DB_NAME was built, from its ingest manifest; ingest.py writes a new one on every build."""
+    manifest = read_ingest_manifest(DB_NAME)
+    return manifest.created_at if manifest else None
+
+
+def get_index() -> Index:
+    """
+    The current index, checked for a rebuild every INDEX_CHECK_INTERVAL seconds. A rebuilt index is
+    opened in full before it replaces the old one; requests already holding the old one finish with it.
+    """
+    global _index, _index_checked
+    if _index is not None and time.monotonic() - _index_checked < INDEX_CHECK_INTERVAL:
+        return _index
+    with _index_lock:
+        if _index is None or time.monotonic() - _index_checked >= INDEX_CHECK_INTERVAL:
+            version = index_version()
+            if _index is None or version != _index.version:
+                if _index is not None:
+                    print(f"Index rebuilt at {version}; reloading")
+                    get_entity_index.cache_clear()
+                    get_router.cache_clear()
+                _index = Index(version)
+            _index_checked = time.monotonic()
+    return _index
+
+
+def get_layout() -> ShardLayout:
+    return get_index().layout
+
+
+def get_shards() -> dict[str, Chroma]:
+    return get_index().shards
+
+
+def embed_query(question: str) -> list[float]:
+    return get_batcher().embed(question) if EMBED_BATCHING else get_embeddings().embed_query(question)
 
 
+def get_document_store() -> DocumentStore | None:
+    return get_index().document_store
+
+
+@cache
+def get_llm() -> ChatOpenAI:
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(temperature=0, model_name=MODEL)
+
+
+@cache
+def get_batcher() -> EmbeddingBatcher:
+    return EmbeddingBatcher(get_embeddings().embed_documents)
+
+
+def warmup():
+    """Create the clients and open the vector store up front, e.g. before a server starts taking requests."""
+    get_llm()
+    shards = get_shards()
+    print(f"Vector store ready with {sum(s._collection.count() for s in shards.values())} documents in {len(shards)} collection(s)")
+
+
+def summarize_history(summary: str, messages: list[dict]) -> str:
+    """Fold messages that dropped out of the history window into the running conversation summary."""
+    from langchain_core.messages import HumanMessage
+
+    prompt = SUMMARY_PROMPT.format(summary=summary or "(none yet)", messages=format_messages(messages))
+    return usage.invoke("summarize_history", get_llm(), [HumanMessage(content=prompt)]).content
+
+
+history_manager = HistoryManager(summarize=summarize_history if SUMMARIZE_HISTORY else None, shared=get_shared_cache())
+flights = SingleFlight()
+
+
+def search(embedding: list[float], k: int, where: dict | None) -> ResultSet:
+    """
+    The k nearest chunks across the shard collections that can match where. The collections are
+    queried directly, so no Document is built until the context is final.
+    """
+    index = get_index()
+    collections = [index.shards[name]._collection for name in index.layout.select(where)]
+    return ResultSet.from_hits(query_shards(collections, embedding, k, where))
+
+
+@tracing.traced
+def merge_entity_docs(question: str, embedding: list[float], docs: ResultSet) -> ResultSet:
+    """Put the best chunks from documents named in the question first, then the vector results, without duplicates."""
+    sources = get_entity_index(KNOWLEDGE_BASE_PATH).sources(question)
+    if not sources:
+        return docs
+    return search(embedding, ENTITY_K, {"source": {"$in": sources}}).merge(docs)[:RETRIEVAL_K]
+
+
+@tracing.traced
 def fetch_context(question: str) -> list[Document]:
     """
     Retrieve relevant context documents for a question.
     """
-    return retriever.invoke(question, k=RETRIEVAL_K)
+    from langchain_core.documents import Document
+
+    start = time.perf_counter()
+    where = get_router(KNOWLEDGE_BASE_PATH).route(question).where("doc_type") if ROUTE_QUERIES else None
+    embedding = embed_query(question)
+    results = search(embedding, RETRIEVAL_K, where)
+    if ENTITY_PRESEARCH:
+        results = merge_entity_docs(question, embedding, results)
+    docs = results.to_list(Document)
+    if SMALL_TO_BIG and (store := get_document_store()):
+        docs = expand_to_parents(docs, store)
+    usage.record("retrieve", EMBEDDING_MODEL, usage.count_tokens([question]), latency=time.perf_counter() - start)
+    return docs
 
 def combined_question(question: str, history: list[dict] = []) -> str:
     """
-    Combine all the user's messages into a single string.
+    Combine the user's messages into a single retrieval query, within a token budget that favours recent turns.
     """
-    prior = "\n".join(m["content"] for m in history if m["role"] == "user")
-    return prior + "\n" + question
+    return history_manager.retrieval_query(question, history)
 
-def answer_question(question: str, history: list[dict] = []) -> tuple[str, list[Document]]:
+@tracing.traced
+def answer_question(question: str, history: list[dict] = [], docs: list[Document] | None = None) -> tuple[str, list[Document]]:
     """
     Answer the given question with RAG; return the answer and the context documents.
     Args:
@@ -52,15 +216,30 @@ def answer_question(question: str, history: list[dict] = []) -> tuple[str, list[
         history: List of previous conversation messages (from Gradio chatbot).
                  Each dict has "role" ("user" or "assistant") and "content" keys.
                  Used to provide context for better retrieval and conversation continuity.
+        docs: Context documents that were already retrieved for this question.
+              When given, retrieval is skipped and these are used as the context.
+    A question that is already being answered for the same history waits for that answer instead.
     """
-    combined = combined_question(question, history)
-    docs = fetch_context(combined)
-    context = "\n\n".join(doc.page_content for doc in docs)
-    system_prompt = SYSTEM_PROMPT.format(context=context)
-    messages = [SystemMessage(content=system_prompt)]
-    messages.extend(convert_to_messages(history))
-    messages.append(HumanMessage(content=question))
-    response = llm.invoke(messages)
+    if COALESCE_REQUESTS and docs is None:
+        return flights.do(question_key(question, history), _answer_question, question, history)
+    return _answer_question(question, history, docs)
+
+
+def _answer_question(question: str, history: list[dict], docs: list[Document] | None = None) -> tuple[str, list[Document]]:
+    from langchain_core.messages import SystemMessage, HumanMessage, convert_to_messages
+
+    with usage.request() as request_id:
+        tracing.annotate(request_id=request_id)
+        if docs is None:
+            combined = combined_question(question, history)
+            docs = fetch_context(combined)
+        blocks, _ = pack_context(docs, CONTEXT_TOKEN_BUDGET)
+        context = "\n\n".join(block.text for block in blocks)
+        system_prompt = SYSTEM_PROMPT.format(context=context)
+        messages = [SystemMessage(content=system_prompt)]
+        messages.extend(convert_to_messages(history_manager.window(history)))
+        messages.append(HumanMessage(content=question))
+        response = usage.invoke("answer", get_llm(), messages)
     return response.content, docs
 
 
@@ -1,6 +1,7 @@
 import gradio as gr
 from dotenv import load_dotenv
-from answer import answer_question
+from labs.rag_app.answer import answer_question, warmup
+from common import querylog
 
 load_dotenv(override=True)
 
@@ -23,12 +24,15 @@ def chat(history):
     """
     last_message = history[-1]["content"]  # Get the most recent user message
     prior = history[:-1]  # Get all previous messages for context
+    querylog.capture(last_message, len(prior))  # only when QUERY_LOG is set
     answer, context = answer_question(last_message, prior)
     history.append({"role": "assistant", "content": answer})
     return history, format_context(context)
 
 
 def main():
+    warmup()
+
     def put_message_in_chatbot(message, history):
         """
         Add user message to chat history.
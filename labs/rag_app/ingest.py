@@ -1,22 +1,42 @@
 import os
 import glob
+import time
+import uuid
+import argparse
 from pathlib import Path
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_openai import OpenAIEmbeddings
 from dotenv import load_dotenv
 from langchain_core.documents import Document
+from common import usage, tracing
+from common.documents import DocumentStore, docstore_path, split_small_to_big, SMALL_CHUNK_SIZE
+from common.sharding import ShardLayout
+from common.snapshot import IngestManifest, write_ingest_manifest
 
 MODEL = "gpt-4.1-nano"
+EMBEDDING_MODEL = "text-embedding-3-large"
 DB_NAME = str(Path(__file__).parent.parent / "vector_db_openai_embeddings")
 KNOWLEDGE_BASE = str(Path(__file__).parent.parent.parent / "knowledge-base")
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 200
+
+# Local embedding ingest: sentence-transformers on CPU, written straight into Chroma
+LOCAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+LOCAL_DB_NAME = str(Path(__file__).parent.parent / "vector_db_local_embeddings")
+COLLECTION_NAME = "langchain"  # the collection langchain_chroma opens by default
+ENCODE_BATCH_SIZE = 256
+ADD_BATCH_SIZE = 5000
+
+# Small-to-big ingest: sentence passages are embedded, and answer.py expands hits to their section
+SMALL_TO_BIG_DB_NAME = str(Path(__file__).parent.parent / "vector_db_small_to_big")
 print(KNOWLEDGE_BASE)
 load_dotenv(override=True)
 
 
 # Use Directory Loader to load all md file from knowledge base in a list of Document objects
+@tracing.traced
 def fetch_documents() -> list[Document]:
     folders = glob.glob(str(Path(KNOWLEDGE_BASE) / "*"))
     documents = []
@@ -32,19 +52,47 @@ def fetch_documents() -> list[Document]:
     return documents
 
 # Use RecursiveCharacterTextSplitter to split the documents into chunks of 500 characters with 200 character overlap
-def create_chunks(documents) -> list[Document]:
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=200)
+@tracing.traced
+def create_chunks(documents, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP) -> list[Document]:
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
     chunks = text_splitter.split_documents(documents)
     return chunks
 
+# Split each document into short passages that record byte offsets of themselves and their parent section
+@tracing.traced
+def create_small_chunks(documents, max_chars=SMALL_CHUNK_SIZE) -> list[Document]:
+    chunks = []
+    for doc in documents:
+        for unit in split_small_to_big(doc.page_content, max_chars):
+            chunks.append(Document(page_content=unit.text, metadata={**doc.metadata, **unit.offsets()}))
+    return chunks
+
+# Keep a copy of the documents next to the vector store, for answer.py to read parent sections from
+def write_document_store(documents, db_name):
+    DocumentStore.write(docstore_path(db_name), {doc.metadata["source"]: doc.page_content for doc in documents})
+
+# OpenAI model names start with "text-embedding"; anything else is a local sentence-transformers model
+def make_embeddings(model_name=EMBEDDING_MODEL):
+    if model_name.startswith("text-embedding"):
+        return OpenAIEmbeddings(model=model_name)
+    # Deferred: langchain_huggingface pulls in torch and transformers
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(model_name=model_name)
+
 # Create a vector store with the embeddings
-def create_vector_store_with_embeddings(chunks, embeddings):
-    if os.path.exists(DB_NAME):
-        Chroma(persist_directory=DB_NAME, embedding_function=embeddings).delete_collection()
+@tracing.traced
+def create_vector_store_with_embeddings(chunks, embeddings, db_name=DB_NAME):
+    if os.path.exists(db_name):
+        Chroma(persist_directory=db_name, embedding_function=embeddings).delete_collection()
 
+    start = time.perf_counter()
     vectorstore = Chroma.from_documents(
-        documents=chunks, embedding=embeddings, persist_directory=DB_NAME
+        documents=chunks, embedding=embeddings, persist_directory=db_name
     )
+    model = getattr(embeddings, "model", None) or getattr(embeddings, "model_name", None)
+    tokens = usage.count_tokens([chunk.page_content for chunk in chunks])
+    usage.record("create_embeddings", model, tokens, latency=time.perf_counter() - start)
 
     collection = vectorstore._collection
     count = collection.count()
@@ -53,20 +101,137 @@ def create_vector_store_with_embeddings(chunks, embeddings):
     sample_embedding = collection.get(limit=1, include=["embeddings"])["embeddings"][0]
     dimensions = len(sample_embedding)
     print(f"There are {count:,} vectors with {dimensions:,} dimensions in the vector store")
+    ShardLayout(base=COLLECTION_NAME, type_field="doc_type").save(db_name)
     return vectorstore
 
+# Split the chunks across several collections, one per document type or by hash of the source
+@tracing.traced
+def create_sharded_vector_store(chunks, embeddings, layout: ShardLayout, db_name=DB_NAME):
+    if os.path.exists(db_name):
+        previous = ShardLayout.load(db_name, COLLECTION_NAME, "doc_type")
+        for name in set(previous.names()) | set(layout.names()):
+            Chroma(collection_name=name, persist_directory=db_name, embedding_function=embeddings).delete_collection()
+
+    by_shard = {name: [] for name in layout.names()}
+    for chunk in chunks:
+        by_shard[layout.shard_of(chunk.metadata)].append(chunk)
+
+    start = time.perf_counter()
+    vectorstores = []
+    for name, shard_chunks in by_shard.items():
+        if shard_chunks:
+            vectorstores.append(Chroma.from_documents(documents=shard_chunks, embedding=embeddings, persist_directory=db_name, collection_name=name))
+            print(f"Collection {name} created with {len(shard_chunks):,} chunks")
+    model = getattr(embeddings, "model", None) or getattr(embeddings, "model_name", None)
+    usage.record("create_embeddings", model, usage.count_tokens([chunk.page_content for chunk in chunks]), latency=time.perf_counter() - start)
+    layout.save(db_name)
+    return vectorstores
+
+# Encode with sentence-transformers in large batches, across several CPU processes or torch threads
+@tracing.traced
+def encode_locally(texts, model_name=LOCAL_EMBEDDING_MODEL, processes=1, threads=None, batch_size=ENCODE_BATCH_SIZE):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if threads:
+        torch.set_num_threads(threads)
+    model = SentenceTransformer(model_name, device="cpu")
+    if processes > 1:
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * processes)
+        try:
+            return model.encode(texts, batch_size=batch_size, pool=pool)
+        finally:
+            model.stop_multi_process_pool(pool)
+    return model.encode(texts, batch_size=batch_size)
+
+# Embed locally and write to Chroma in bounded add batches, reporting throughput in chunks per second
+@tracing.traced
+def create_vector_store_locally(
+    chunks,
+    model_name=LOCAL_EMBEDDING_MODEL,
+    db_name=LOCAL_DB_NAME,
+    processes=1,
+    threads=None,
+    batch_size=ENCODE_BATCH_SIZE,
+    add_batch_size=ADD_BATCH_SIZE,
+):
+    from chromadb import PersistentClient
+
+    texts = [chunk.page_content for chunk in chunks]
+    start = time.perf_counter()
+    vectors = encode_locally(texts, model_name, processes, threads, batch_size)
+    encoded = time.perf_counter()
+    usage.record("create_embeddings", model_name, 0, latency=encoded - start)
+
+    chroma = PersistentClient(path=db_name)
+    if COLLECTION_NAME in [c.name for c in chroma.list_collections()]:
+        chroma.delete_collection(COLLECTION_NAME)
+    collection = chroma.create_collection(COLLECTION_NAME)
+    step = min(add_batch_size, chroma.get_max_batch_size())
+    for i in range(0, len(chunks), step):
+        collection.add(
+            ids=[str(uuid.uuid4()) for _ in chunks[i : i + step]],
+            embeddings=vectors[i : i + step],
+            documents=texts[i : i + step],
+            metadatas=[chunk.metadata for chunk in chunks[i : i + step]],
+        )
+    written = time.perf_counter()
+
+    print(f"Encoded {len(chunks):,} chunks in {encoded - start:.1f}s ({len(chunks) / (encoded - start):,.0f} chunks/s)")
+    print(f"Wrote {len(chunks):,} vectors in {written - encoded:.1f}s ({len(chunks) / (written - encoded):,.0f} chunks/s, batches of {step:,})")
+    print(f"Total {len(chunks) / (written - start):,.0f} chunks/s; {collection.count():,} vectors with {vectors.shape[1]:,} dimensions in {db_name}")
+    return collection
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest the knowledge base into Chroma")
+    parser.add_argument("--local", action="store_true", help="Embed with a local sentence-transformers model instead of OpenAI")
+    parser.add_argument("--model", default=LOCAL_EMBEDDING_MODEL, help="Local embedding model (with --local)")
+    parser.add_argument("--processes", type=int, default=1, help="CPU processes to encode with (with --local)")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads per process (with --local)")
+    parser.add_argument("--batch-size", type=int, default=ENCODE_BATCH_SIZE, help="Encode batch size (with --local)")
+    parser.add_argument("--shards", type=int, default=1, help="Number of collections to hash documents across (OpenAI embeddings)")
+    parser.add_argument("--shard-by", choices=["hash", "type"], default="hash", help="Split by hash of the source, or one collection per document type")
+    parser.add_argument("--small-to-big", action="store_true", help=f"Index sentence passages into {Path(SMALL_TO_BIG_DB_NAME).name} (OpenAI embeddings)")
+    args = parser.parse_args()
+    if args.local and (args.small_to_big or args.shards > 1 or args.shard_by == "type"):
+        parser.error("--local writes a single collection; it can't be combined with --small-to-big, --shards or --shard-by type")
+
     print("Ingesting data...")
     documents: list[Document] = fetch_documents()
     print(f"Found {len(documents)} documents")
 
-    chunks: list[Document] = create_chunks(documents)
+    if args.small_to_big:
+        chunks: list[Document] = create_small_chunks(documents)
+    else:
+        chunks: list[Document] = create_chunks(documents)
     print(f"Created {len(chunks)} chunks")
     print(chunks[0])
+
+    # Recorded next to the index so answer.py and snapshots can check the embedding model
+    manifest = IngestManifest(
+        embedding_model=EMBEDDING_MODEL,
+        chunking=f"sentences:{SMALL_CHUNK_SIZE}" if args.small_to_big else f"recursive:{CHUNK_SIZE}/{CHUNK_OVERLAP}",
+        documents=len(documents),
+        chunks=len(chunks),
+        created_at=time.time(),
+    )
+    if args.small_to_big:
+        vectorstore:Chroma = create_vector_store_with_embeddings(chunks, make_embeddings(), SMALL_TO_BIG_DB_NAME)
+        write_ingest_manifest(SMALL_TO_BIG_DB_NAME, manifest)
+        write_document_store(documents, SMALL_TO_BIG_DB_NAME)
+    elif args.shards > 1 or args.shard_by == "type":
+        layout = ShardLayout(base=COLLECTION_NAME, by=args.shard_by, count=args.shards, type_field="doc_type")
+        create_sharded_vector_store(chunks, make_embeddings(), layout)
+        write_ingest_manifest(DB_NAME, manifest)
+    elif args.local:
+        create_vector_store_locally(chunks, args.model, processes=args.processes, threads=args.threads, batch_size=args.batch_size)
+        write_ingest_manifest(LOCAL_DB_NAME, manifest.model_copy(update={"embedding_model": args.model}))
+    else:
+        embeddings = make_embeddings()
+        vectorstore:Chroma = create_vector_store_with_embeddings(chunks, embeddings)
+        print(f"Vector store created with {vectorstore._collection.count()} documents")
+        write_ingest_manifest(DB_NAME, manifest)
     
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-    vectorstore:Chroma = create_vector_store_with_embeddings(chunks, embeddings)
-    print(f"Vector store created with {vectorstore._collection.count()} documents")
-    
-    print("Ingestion complete")
\ No newline at end of file
+    print("Ingestion complete")
+    usage.print_summary()
\ No newline at end of file
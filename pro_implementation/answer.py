@@ -1,31 +1,204 @@
-from openai import OpenAI
+import os
+import json
+import time
+import hashlib
+import uuid
+import threading
+from collections import Counter
 from dotenv import load_dotenv
-from chromadb import PersistentClient
-from litellm import completion
 from pydantic import BaseModel, Field
 from pathlib import Path
-from tenacity import retry, wait_exponential
+from functools import cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from common import usage, resilience, tracing
+from common.history import HistoryManager, SUMMARY_PROMPT, format_messages
+from common.packing import pack_context
+from common.batching import EmbeddingBatcher
+from common.entities import get_entity_index
+from common.routing import get_router
+from common.documents import DocumentStore, docstore_path, expand_to_parents
+from common.sharding import ShardLayout, query_shards, query_shards_many
+from common import snapshot
+from common.singleflight import SingleFlight, question_key
+from common.sharedcache import get_shared_cache
+from common.resultset import ResultSet
 
 
 load_dotenv(override=True)
 
 # MODEL = "openai/gpt-4.1-nano"
 MODEL = "groq/openai/gpt-oss-120b"
+FALLBACK_MODEL = "openai/gpt-4.1-nano"  # used when MODEL fails or its circuit breaker is open
 DB_NAME = str(Path(__file__).parent.parent / "preprocessed_db")
 KNOWLEDGE_BASE_PATH = Path(__file__).parent.parent / "knowledge-base"
 SUMMARIES_PATH = Path(__file__).parent.parent / "summaries"
+# Serve from a memory-mapped snapshot (python -m common.snapshot export) instead of DB_NAME;
+# pointed at a publish root (ingest.py --watch --publish ROOT), each newly published version is picked up
+SNAPSHOT_PATH = os.getenv("INDEX_SNAPSHOT")
+# Reindex knowledge-base edits from a background thread of this process (see start_watcher)
+WATCH_KNOWLEDGE_BASE = os.getenv("WATCH_KNOWLEDGE_BASE", "").lower() in ("1", "true")
 
 collection_name = "docs"
 embedding_model = "text-embedding-3-large"
-wait = wait_exponential(multiplier=1, min=10, max=240)
 
-openai = OpenAI()
-
-chroma = PersistentClient(path=DB_NAME)
-collection = chroma.get_or_create_collection(collection_name)
 
 RETRIEVAL_K = 20
 FINAL_K = 10
+SUMMARIZE_HISTORY = True
+CONTEXT_TOKEN_BUDGET = 4000
+EMBED_BATCHING = True  # share query-embedding calls between concurrent requests
+# Seconds for the whole request and for each stage; rewrite and rerank are skipped (and history
+# isn't summarized) when they fail or when less than ANSWER_RESERVE would be left for the answer
+REQUEST_DEADLINE = 60
+STAGE_TIMEOUTS = {"rewrite_query": 10, "rerank": 20, "summarize_history": 15, "answer": 45}
+EMBEDDING_TIMEOUT = 10
+ANSWER_RESERVE = 20
+ENTITY_K = 10  # most chunks added from documents whose entities are named in the question
+ROUTE_QUERIES = True  # search only the document types the question is about, when the router is confident
+SMALL_TO_BIG = True  # answer with the source sections of the reranked chunks instead of the chunk blobs
+INDEX_CHECK_INTERVAL = 2.0  # seconds between checks for a newer index version
+BULK_CONCURRENCY = 8  # questions rewritten, reranked and answered at once by answer_questions
+BULK_WINDOW = 128  # questions embedded and retrieved together in each step of answer_questions
+EMBED_BATCH_SIZE = 1024  # inputs per embeddings call in bulk jobs (the API accepts up to 2048)
+# Rewrite the question only when it can help: always with history (to resolve references), otherwise
+# when the question is short and names no known entity, or when the first-pass search finds nothing close
+ADAPTIVE_REWRITE = True  # False rewrites every question, as before
+REWRITE_MIN_WORDS = 6
+REWRITE_MAX_DISTANCE = 1.0  # squared L2 between unit vectors, 2 - 2 * cosine similarity
+COALESCE_REQUESTS = True  # identical questions asked concurrently (with the same history) share one pipeline run
+
+
+# The OpenAI client and the Chroma collections are created on first use, so importing this module stays cheap
+@cache
+def get_openai():
+    from openai import OpenAI
+
+    return OpenAI(timeout=EMBEDDING_TIMEOUT, max_retries=2)
+
+
+@cache
+def get_chroma():
+    from chromadb import PersistentClient
+
+    return PersistentClient(path=DB_NAME)
+
+
+class Index:
+    """The layout, collections and document store of one index version, swapped as a whole when a newer one appears."""
+
+    def __init__(self, version):
+        self.version = version
+        if SNAPSHOT_PATH:
+            manifest, self.collections = snapshot.open_snapshot(SNAPSHOT_PATH, embedding_model)
+            self.layout = manifest.layout
+            store = snapshot.resolve(SNAPSHOT_PATH) / "docstore"
+        else:
+            snapshot.check_embedding_model(snapshot.read_ingest_manifest(DB_NAME), embedding_model, DB_NAME)
+            self.layout = ShardLayout.load(DB_NAME, collection_name)
+            self.collections = {name: get_chroma().get_or_create_collection(name) for name in self.layout.names()}
+            store = docstore_path(DB_NAME)
+        self.document_store = DocumentStore(store) if store.exists() else None
+
+
+_index = None
+_index_checked = 0.0
+_index_lock = threading.Lock()
+
+
+def index_version():
+    """The published snapshot version being pointed at, or the version in the Chroma directory's ingest manifest."""
+    if SNAPSHOT_PATH:
+        return snapshot.resolve(SNAPSHOT_PATH).name
+    manifest = snapshot.read_ingest_manifest(DB_NAME)
+    return manifest.version if manifest else 0
+
+
+def get_index():
+    """
+    The current index, checked for a newer version every INDEX_CHECK_INTERVAL seconds. A newer version is
+    opened in full before it replaces the old one; requests already holding the old one finish with it.
+    """
+    global _index, _index_checked
+    if _index is not None and time.monotonic() - _index_checked < INDEX_CHECK_INTERVAL:
+        return _index
+    with _index_lock:
+        if _index is None or time.monotonic() - _index_checked >= INDEX_CHECK_INTERVAL:
+            version = index_version()
+            if _index is None or version != _index.version:
+                if _index is not None:
+                    print(f"Index version {_index.version} -> {version}")
+                    # Entities and routing keywords come from the documents, which may have changed
+                    get_entity_index.cache_clear()
+                    get_router.cache_clear()
+                _index = Index(version)
+            _index_checked = time.monotonic()
+    return _index
+
+
+def get_layout():
+    return get_index().layout
+
+
+def get_collections():
+    """One collection per shard, as laid out by ingest (a single "docs" collection by default)."""
+    return get_index().collections
+
+
+def get_document_store():
+    return get_index().document_store
+
+
+def embedding_key(text):
+    return f"embedding:{embedding_model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+
+def embed_queries(texts):
+    """
+    Query embeddings, reusing any that another process already put in the shared cache (SHARED_CACHE),
+    where they are kept as float32 bytes.
+    """
+    import numpy as np
+
+    shared = get_shared_cache()
+    cached = shared.get_many([embedding_key(text) for text in texts]) if shared else {}
+    vectors = {key: np.frombuffer(value, dtype=np.float32).tolist() for key, value in cached.items() if isinstance(value, bytes)}
+    missing = [text for text in dict.fromkeys(texts) if embedding_key(text) not in vectors]
+    if missing:
+        response = usage.embeddings("embed_query", get_openai(), model=embedding_model, input=missing)
+        fresh = {embedding_key(text): e.embedding for text, e in zip(missing, response.data)}
+        if shared:
+            shared.set_many({key: np.asarray(vector, dtype=np.float32).tobytes() for key, vector in fresh.items()})
+        vectors.update(fresh)
+    return [vectors[embedding_key(text)] for text in texts]
+
+
+@cache
+def get_batcher():
+    return EmbeddingBatcher(embed_queries)
+
+
+def warmup():
+    """Create the clients and open the collection up front, e.g. before a server starts taking requests."""
+    get_openai()
+    collections = get_collections()
+    print(f"{len(collections)} collection(s) ready with {sum(c.count() for c in collections.values())} documents")
+    if WATCH_KNOWLEDGE_BASE:
+        start_watcher()
+
+
+@cache
+def start_watcher():
+    """
+    Run ingest's watcher on a daemon thread, writing through this process's Chroma client so the
+    collections being served see every reindexed file; get_index() then picks up the new version.
+    A watcher in another process should publish snapshots instead (ingest.py --watch --publish).
+    """
+    from pro_implementation import ingest
+
+    thread = threading.Thread(target=ingest.watch, name="knowledge-base-watcher", daemon=True)
+    thread.start()
+    return thread
+
 
 SYSTEM_PROMPT = """
 You are a knowledgeable, friendly assistant representing the company Insurellm.
@@ -39,6 +212,22 @@ With this context, please answer the user's question. Be accurate, relevant and
 """
 
 
+def stage_timeout(stage):
+    """The stage's limit, cut so that optional stages never eat into the time kept for the answer."""
+    if stage == "answer":
+        return STAGE_TIMEOUTS[stage]
+    return min(STAGE_TIMEOUTS[stage], resilience.remaining() - ANSWER_RESERVE)
+
+
+def optional_stage(stage, fn, *args, fallback):
+    """Run an optional stage, degrading to fallback if it fails or runs out of time."""
+    try:
+        return fn(*args)
+    except Exception as e:
+        resilience.note(f"{stage} skipped: {type(e).__name__}")
+        return fallback
+
+
 class Result(BaseModel):
     page_content: str
     metadata: dict
@@ -50,8 +239,9 @@ class RankOrder(BaseModel):
     )
 
 
-@retry(wait=wait)
+@tracing.traced
 def rerank(question, chunks):
+    tracing.annotate(candidates=len(chunks))
     system_prompt = """
 You are a document re-ranker.
 You are provided with a question and a list of relevant chunks of text from a query of a knowledge base.
@@ -61,32 +251,48 @@ Reply only with the list of ranked chunk ids, nothing else. Include all the chun
 """
     user_prompt = f"The user has asked the following question:\n\n{question}\n\nOrder all the chunks of text by relevance to the question, from most relevant to least relevant. Include all the chunk ids you are provided with, reranked.\n\n"
     user_prompt += "Here are the chunks:\n\n"
-    for index, chunk in enumerate(chunks):
-        user_prompt += f"# CHUNK ID: {index + 1}:\n\n{chunk.page_content}\n\n"
+    for index, text in enumerate(chunks.texts):
+        user_prompt += f"# CHUNK ID: {index + 1}:\n\n{text}\n\n"
     user_prompt += "Reply only with the list of ranked chunk ids, nothing else."
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
     ]
-    response = completion(model=MODEL, messages=messages, response_format=RankOrder)
+    response = resilience.completion(
+        "rerank", [MODEL, FALLBACK_MODEL], stage_timeout("rerank"), messages=messages, response_format=RankOrder
+    )
     reply = response.choices[0].message.content
     order = RankOrder.model_validate_json(reply).order
-    return [chunks[i - 1] for i in order]
+    return chunks.take(i - 1 for i in order)
 
 
-def make_rag_messages(question, history, chunks):
-    context = "\n\n".join(
-        f"Extract from {chunk.metadata['source']}:\n{chunk.page_content}" for chunk in chunks
+def summarize_history(summary, messages):
+    """Fold messages that dropped out of the history window into the running conversation summary."""
+    prompt = SUMMARY_PROMPT.format(summary=summary or "(none yet)", messages=format_messages(messages))
+    response = resilience.completion(
+        "summarize_history", [MODEL, FALLBACK_MODEL], stage_timeout("summarize_history"), messages=[{"role": "user", "content": prompt}]
     )
+    return response.choices[0].message.content
+
+
+history_manager = HistoryManager(summarize=summarize_history if SUMMARIZE_HISTORY else None, shared=get_shared_cache())
+flights = SingleFlight()
+
+
+@tracing.traced
+def make_rag_messages(question, history, chunks):
+    blocks, stats = pack_context(chunks, CONTEXT_TOKEN_BUDGET)
+    tracing.annotate(context_tokens=stats.tokens_after, blocks=stats.blocks)
+    context = "\n\n".join(f"Extract from {block.source}:\n{block.text}" for block in blocks)
     system_prompt = SYSTEM_PROMPT.format(context=context)
     return (
         [{"role": "system", "content": system_prompt}]
-        + history
+        + history_manager.window(history)
         + [{"role": "user", "content": question}]
     )
 
 
-@retry(wait=wait)
+@tracing.traced
 def rewrite_query(question, history=[]):
     """Rewrite the user's question to be a more specific question that is more likely to surface relevant content in the Knowledge Base."""
     message = f"""
@@ -94,7 +300,7 @@ You are in a conversation with a user, answering questions about the company Ins
 You are about to look up information in a Knowledge Base to answer the user's question.
 
 This is the history of your conversation so far with the user:
-{history}
+{format_messages(history) or "(none)"}
 
 And this is the user's current question:
 {question}
@@ -103,43 +309,264 @@ Respond only with a short, refined question that you will use to search the Know
 It should be a VERY short specific question most likely to surface content. Focus on the question details.
 IMPORTANT: Respond ONLY with the precise knowledgebase query, nothing else.
 """
-    response = completion(model=MODEL, messages=[{"role": "system", "content": message}])
+    response = resilience.completion(
+        "rewrite_query", [MODEL], stage_timeout("rewrite_query"), messages=[{"role": "system", "content": message}]
+    )
     return response.choices[0].message.content
 
 
+class Plan(BaseModel):
+    """Whether a request pays for a query rewrite, and why."""
+    name: str
+    rewrite: bool
+
+
+_plans = Counter()
+_plans_lock = threading.Lock()
+
+
+def plan_query(question, history, results):
+    """Choose the retrieval plan from the history, the question itself, and the first-pass results for it."""
+    if not ADAPTIVE_REWRITE:
+        plan = Plan(name="always_rewrite", rewrite=True)
+    elif history:
+        plan = Plan(name="rewrite_with_history", rewrite=True)
+    elif not results or results[0][0] > REWRITE_MAX_DISTANCE:
+        plan = Plan(name="rewrite_low_confidence", rewrite=True)
+    elif len(question.split()) < REWRITE_MIN_WORDS and not get_entity_index(KNOWLEDGE_BASE_PATH).sources(question):
+        plan = Plan(name="rewrite_vague", rewrite=True)
+    else:
+        plan = Plan(name="direct", rewrite=False)
+    with _plans_lock:
+        _plans[plan.name] += 1
+    tracing.annotate(plan=plan.name, nearest=results[0][0] if results else None)
+    return plan
+
+
+def plan_counts() -> dict[str, int]:
+    """How often each retrieval plan has run in this process."""
+    with _plans_lock:
+        return dict(_plans)
+
+
+def route(text):
+    return get_router(KNOWLEDGE_BASE_PATH).route(text).where("type") if ROUTE_QUERIES else None
+
+
+@tracing.traced
 def merge_chunks(chunks, reranked):
-    merged = chunks[:]
-    existing = [chunk.page_content for chunk in chunks]
-    for chunk in reranked:
-        if chunk.page_content not in existing:
-            merged.append(chunk)
-    return merged
-
-
-def fetch_context_unranked(question):
-    query = openai.embeddings.create(model=embedding_model, input=[question]).data[0].embedding
-    results = collection.query(query_embeddings=[query], n_results=RETRIEVAL_K)
-    chunks = []
-    for result in zip(results["documents"][0], results["metadatas"][0]):
-        chunks.append(Result(page_content=result[0], metadata=result[1]))
+    return chunks.merge(reranked)
+
+
+def to_chunks(results):
+    return ResultSet.from_hits(results)
+
+
+@tracing.traced
+def search(question, where=None):
+    """The RETRIEVAL_K nearest (distance, document, metadata) for a question."""
+    query = get_batcher().embed(question) if EMBED_BATCHING else embed_queries([question])[0]
+    shards = [get_collections()[name] for name in get_layout().select(where)]
+    results = query_shards(shards, query, RETRIEVAL_K, where)
+    tracing.annotate(results=len(results), filtered=where is not None, shards=len(shards))
+    return results
+
+
+def fetch_context_unranked(question, where=None):
+    return to_chunks(search(question, where))
+
+
+@tracing.traced
+def fetch_entity_chunks(question):
+    """Chunks from the documents of any employee, product, contract party or company topic named in the question."""
+    sources = get_entity_index(KNOWLEDGE_BASE_PATH).sources(question)
+    chunks = ResultSet()
+    if not sources:
+        return chunks
+    for collection in get_collections().values():
+        results = collection.get(where={"source": {"$in": sources}}, limit=ENTITY_K - len(chunks), include=["documents", "metadatas"])
+        chunks = chunks.merge(ResultSet(texts=results["documents"], metadatas=results["metadatas"]))
+        if len(chunks) >= ENTITY_K:
+            break
     return chunks
 
 
-def fetch_context(original_question):
-    rewritten_question = rewrite_query(original_question)
-    chunks1 = fetch_context_unranked(original_question)
-    chunks2 = fetch_context_unranked(rewritten_question)
-    chunks = merge_chunks(chunks1, chunks2)
-    reranked = rerank(original_question, chunks)
-    return reranked[:FINAL_K]
+@tracing.traced
+def fetch_context(original_question, history=[]):
+    """
+    Search with the question as asked, then rewrite it (with the conversation history) and search
+    again only if plan_query says the rewrite can help, then rerank and expand.
+    """
+    results = search(original_question, route(original_question))
+    chunks = to_chunks(results)
+    if plan_query(original_question, history, results).rewrite:
+        rewritten_question = optional_stage("rewrite_query", rewrite_query, original_question, history_manager.window(history), fallback=original_question)
+        if rewritten_question != original_question:
+            chunks = merge_chunks(chunks, fetch_context_unranked(rewritten_question, route(f"{original_question}\n{rewritten_question}")))
+    chunks = merge_chunks(chunks, fetch_entity_chunks(original_question))
+    reranked = optional_stage("rerank", rerank, original_question, chunks, fallback=chunks)[:FINAL_K].to_list(Result)
+    if SMALL_TO_BIG and (store := get_document_store()):
+        reranked = expand_to_parents(reranked, store)
+    return reranked
 
 
-@retry(wait=wait)
-def answer_question(question: str, history: list[dict] = []) -> tuple[str, list]:
+@tracing.traced
+def answer_question(question: str, history: list[dict] = [], chunks: list[Result] | None = None) -> tuple[str, list]:
     """
-    Answer a question using RAG and return the answer and the retrieved context
+    Answer a question using RAG and return the answer and the retrieved context.
+    Pass chunks to reuse context that was already fetched for this question.
+    The whole request is bounded by REQUEST_DEADLINE; if MODEL fails, the answer comes from FALLBACK_MODEL.
+    A question that is already being answered for the same history waits for that answer instead.
     """
-    chunks = fetch_context(question)
-    messages = make_rag_messages(question, history, chunks)
-    response = completion(model=MODEL, messages=messages)
+    if COALESCE_REQUESTS and chunks is None:
+        return flights.do(question_key(question, history), _answer_question, question, history)
+    return _answer_question(question, history, chunks)
+
+
+def _answer_question(question, history, chunks=None):
+    with usage.request() as request_id, resilience.deadline(REQUEST_DEADLINE):
+        tracing.annotate(request_id=request_id)
+        if chunks is None:
+            chunks = fetch_context(question, history)
+        messages = make_rag_messages(question, history, chunks)
+        response = resilience.completion("answer", [MODEL, FALLBACK_MODEL], stage_timeout("answer"), messages=messages)
     return response.choices[0].message.content, chunks
+
+
+class BulkAnswer(BaseModel):
+    """One result from answer_questions; error is set instead of answer when the question failed."""
+    index: int
+    question: str
+    answer: str | None = None
+    sources: list[str] = []
+    error: str | None = None
+
+
+def embed_many(texts):
+    """Embed any number of texts, EMBED_BATCH_SIZE per call."""
+    return [vector for start in range(0, len(texts), EMBED_BATCH_SIZE) for vector in embed_queries(texts[start:start + EMBED_BATCH_SIZE])]
+
+
+@tracing.traced
+def search_many(texts, wheres):
+    """
+    search for many texts at once: every text is embedded in one batch, and the texts with the same
+    filter share one multi-query call per shard.
+    """
+    unique = list(dict.fromkeys(texts))
+    vectors = dict(zip(unique, embed_many(unique)))
+    groups = {}
+    for i, where in enumerate(wheres):
+        groups.setdefault(json.dumps(where, sort_keys=True), (where, []))[1].append(i)
+    results = [None] * len(texts)
+    for where, indexes in groups.values():
+        group = list(dict.fromkeys(texts[i] for i in indexes))
+        shards = [get_collections()[name] for name in get_layout().select(where)]
+        hits = dict(zip(group, query_shards_many(shards, [vectors[text] for text in group], RETRIEVAL_K, where)))
+        for i in indexes:
+            results[i] = hits[texts[i]]
+    tracing.annotate(texts=len(texts), queries=len(unique), filters=len(groups))
+    return results
+
+
+def _rewrite(request_id, question, plan):
+    if not plan.rewrite:
+        return question
+    with usage.request(request_id), resilience.deadline(REQUEST_DEADLINE):
+        return optional_stage("rewrite_query", rewrite_query, question, fallback=question)
+
+
+@tracing.traced
+def retrieve_many(questions, request_ids, pool):
+    """
+    The merged candidates fetch_context would rerank, for many questions at once: a batched first
+    pass, rewrites on pool for the questions plan_query picks, and a batched pass for the rewrites.
+    """
+    first = search_many(questions, [route(question) for question in questions])
+    plans = [plan_query(question, [], results) for question, results in zip(questions, first)]
+    rewrites = list(pool.map(_rewrite, request_ids, questions, plans))
+    rewritten = [i for i, (question, rewrite) in enumerate(zip(questions, rewrites)) if rewrite != question]
+    second = search_many([rewrites[i] for i in rewritten], [route(f"{questions[i]}\n{rewrites[i]}") for i in rewritten])
+    candidates = [to_chunks(results) for results in first]
+    for i, results in zip(rewritten, second):
+        candidates[i] = merge_chunks(candidates[i], to_chunks(results))
+    return [merge_chunks(chunks, fetch_entity_chunks(question)) for question, chunks in zip(questions, candidates)]
+
+
+def _finish(request_id, index, question, chunks):
+    """Rerank, expand and answer one question of a bulk job; failures become a BulkAnswer with error set."""
+    try:
+        with usage.request(request_id), resilience.deadline(REQUEST_DEADLINE):
+            chunks = optional_stage("rerank", rerank, question, chunks, fallback=chunks)[:FINAL_K].to_list(Result)
+            if SMALL_TO_BIG and (store := get_document_store()):
+                chunks = expand_to_parents(chunks, store)
+            messages = make_rag_messages(question, [], chunks)
+            response = resilience.completion("answer", [MODEL, FALLBACK_MODEL], stage_timeout("answer"), messages=messages)
+        sources = list(dict.fromkeys(chunk.metadata["source"] for chunk in chunks))
+        return BulkAnswer(index=index, question=question, answer=response.choices[0].message.content, sources=sources)
+    except Exception as e:
+        return BulkAnswer(index=index, question=question, error=f"{type(e).__name__}: {e}")
+
+
+def load_checkpoint(path, questions):
+    """Answers already written to a checkpoint, by index; records that don't match questions are ignored."""
+    if not Path(path).exists():
+        return {}
+    done = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = BulkAnswer.model_validate_json(line)
+            if record.index < len(questions) and questions[record.index] == record.question and record.error is None:
+                done[record.index] = record
+    return done
+
+
+def answer_questions(questions: list[str], concurrency: int = BULK_CONCURRENCY, ordered: bool = True, checkpoint: str | None = None):
+    """
+    Answer many questions for an offline job, yielding a BulkAnswer for each (without history).
+    Questions go through in windows of BULK_WINDOW: each window is embedded in batches and retrieved with
+    one multi-query call per shard, then the rewrites that plan_query asks for run concurrency at a time and
+    are retrieved the same way, then reranks and answers run concurrency at a time. Results come in input order, or as they finish with ordered=False.
+    With a checkpoint path, each successful answer is appended to it as a JSON line and questions already
+    answered there are yielded from it without being asked again, so an interrupted job can be rerun as is.
+    A failed retrieval fails only the questions of its window; the job carries on with the next one.
+    """
+    done = load_checkpoint(checkpoint, questions) if checkpoint else {}
+    pending = [i for i in range(len(questions)) if i not in done]
+    if done:
+        print(f"Resuming from {checkpoint}: {len(done)} of {len(questions)} questions already answered")
+    job = uuid.uuid4().hex[:8]
+    buffered = done if ordered else {}
+    next_index = 0
+
+    def in_order():
+        nonlocal next_index
+        while next_index in buffered:
+            next_index += 1
+            yield buffered.pop(next_index - 1)
+
+    yield from in_order() if ordered else list(done.values())
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-answer") as pool:
+        for start in range(0, len(pending), BULK_WINDOW):
+            window = pending[start:start + BULK_WINDOW]
+            try:
+                candidates = retrieve_many([questions[i] for i in window], [f"{job}-{i}" for i in window], pool)
+            except Exception as e:
+                # Retrieval is shared by the whole window, so each of its questions fails; the checkpoint
+                # only keeps answers, so rerunning the job retries them
+                error = f"{type(e).__name__}: {e}"
+                results = [BulkAnswer(index=i, question=questions[i], error=error) for i in window]
+            else:
+                futures = [pool.submit(_finish, f"{job}-{i}", i, questions[i], chunks) for i, chunks in zip(window, candidates)]
+                results = (future.result() for future in as_completed(futures))
+            for result in results:
+                if checkpoint and result.error is None:
+                    with open(checkpoint, "a", encoding="utf-8") as f:
+                        f.write(result.model_dump_json() + "\n")
+                if ordered:
+                    buffered[result.index] = result
+                    yield from in_order()
+                else:
+                    yield result
@@ -1,12 +1,18 @@
+import time
+import argparse
 from pathlib import Path
 from openai import OpenAI
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 from chromadb import PersistentClient
 from tqdm import tqdm
-from litellm import completion
 from multiprocessing import Pool
-from tenacity import retry, wait_exponential
+from tenacity import retry, stop_after_attempt, wait_exponential
+from common import usage, tracing
+from common.documents import DocumentStore, docstore_path, locate
+from common.sharding import ShardLayout
+from common.snapshot import IngestManifest, publish, read_ingest_manifest, write_ingest_manifest
+from common.watcher import DEBOUNCE, POLL_INTERVAL, DirectoryWatcher
 
 
 load_dotenv(override=True)
@@ -19,6 +25,7 @@ embedding_model = "text-embedding-3-large"
 KNOWLEDGE_BASE_PATH = Path(__file__).parent.parent / "knowledge-base"
 AVERAGE_CHUNK_SIZE = 100
 wait = wait_exponential(multiplier=1, min=10, max=240)
+REINDEX_ATTEMPTS = 3  # a file that still fails is retried with the next change rather than blocking the watcher
 
 
 WORKERS = 3
@@ -43,7 +50,8 @@ class Chunk(BaseModel):
     )
 
     def as_result(self, document):
-        metadata = {"source": document["source"], "type": document["type"]}
+        # Offsets are only recorded when the original text was returned verbatim
+        metadata = {"source": document["source"], "type": document["type"], **locate(document["text"], self.original_text)}
         return Result(
             page_content=self.headline + "\n\n" + self.summary + "\n\n" + self.original_text,
             metadata=metadata,
@@ -54,16 +62,21 @@ class Chunks(BaseModel):
     chunks: list[Chunk]
 
 
+def load_document(file):
+    """One knowledge-base file; its type is the name of the top-level folder it is in."""
+    with open(file, "r", encoding="utf-8") as f:
+        return {"type": file.relative_to(KNOWLEDGE_BASE_PATH).parts[0], "source": file.as_posix(), "text": f.read()}
+
+
+@tracing.traced
 def fetch_documents():
     """A homemade version of the LangChain DirectoryLoader"""
 
     documents = []
 
     for folder in KNOWLEDGE_BASE_PATH.iterdir():
-        doc_type = folder.name
         for file in folder.rglob("*.md"):
-            with open(file, "r", encoding="utf-8") as f:
-                documents.append({"type": doc_type, "source": file.as_posix(), "text": f.read()})
+            documents.append(load_document(file))
 
     print(f"Loaded {len(documents)} documents")
     return documents
@@ -100,47 +113,197 @@ def make_messages(document):
     ]
 
 
+@tracing.traced
 @retry(wait=wait)
 def process_document(document):
+    tracing.annotate(source=document["source"], characters=len(document["text"]))
     messages = make_messages(document)
-    response = completion(model=MODEL, messages=messages, response_format=Chunks)
+    response = usage.completion("process_document", model=MODEL, messages=messages, response_format=Chunks)
     reply = response.choices[0].message.content
     doc_as_chunks = Chunks.model_validate_json(reply).chunks
     return [chunk.as_result(document) for chunk in doc_as_chunks]
 
 
+process_document_for_reindex = tracing.traced(
+    process_document.retry_with(stop=stop_after_attempt(REINDEX_ATTEMPTS), reraise=True), name="process_document"
+)
+
+
+parent_span = None  # in a worker, the parent process's create_chunks span
+
+
+def init_worker(span):
+    global parent_span
+    parent_span = span
+
+
+def process_document_with_usage(document):
+    """Run process_document in a worker and hand its token usage and trace spans back to the parent process."""
+    with tracing.continue_trace(parent_span):
+        chunks = process_document(document)
+    return chunks, usage.drain(), tracing.drain()
+
+
+@tracing.traced
 def create_chunks(documents):
     """
     Create chunks using a number of workers in parallel.
     If you get a rate limit error, set the WORKERS to 1.
     """
     chunks = []
-    with Pool(processes=WORKERS) as pool:
-        for result in tqdm(pool.imap_unordered(process_document, documents), total=len(documents)):
+    with Pool(processes=WORKERS, initializer=init_worker, initargs=(tracing.current_parent(),)) as pool:
+        for result, records, spans in tqdm(pool.imap_unordered(process_document_with_usage, documents), total=len(documents)):
             chunks.extend(result)
+            usage.extend(records)
+            tracing.extend(spans)
     return chunks
 
 
-def create_embeddings(chunks):
+@tracing.traced
+def create_embeddings(chunks, layout=None, shards=None):
+    """
+    Embed the chunks and write them to the collections of the shard layout (one "docs" collection by default).
+    Pass shards to rebuild only those collections; the chunks should then be the ones from their documents.
+    """
+    tracing.annotate(chunks=len(chunks))
+    layout = layout or ShardLayout(base=collection_name)
+    shards = shards or layout.names()
     chroma = PersistentClient(path=DB_NAME)
-    if collection_name in [c.name for c in chroma.list_collections()]:
-        chroma.delete_collection(collection_name)
+    existing = [c.name for c in chroma.list_collections()]
+    # A full rebuild also clears the collections of the previous layout
+    stale = shards if shards != layout.names() else set(shards) | set(ShardLayout.load(DB_NAME, collection_name).names())
+    for name in stale:
+        if name in existing:
+            chroma.delete_collection(name)
 
     texts = [chunk.page_content for chunk in chunks]
-    emb = openai.embeddings.create(model=embedding_model, input=texts).data
+    emb = usage.embeddings("create_embeddings", openai, model=embedding_model, input=texts).data
     vectors = [e.embedding for e in emb]
 
-    collection = chroma.get_or_create_collection(collection_name)
+    by_shard = {name: [] for name in shards}
+    for i, chunk in enumerate(chunks):
+        by_shard[layout.shard_of(chunk.metadata)].append(i)
+
+    for name, indexes in by_shard.items():
+        collection = chroma.get_or_create_collection(name)
+        if indexes:
+            collection.add(
+                ids=[str(i) for i in indexes],
+                embeddings=[vectors[i] for i in indexes],
+                documents=[texts[i] for i in indexes],
+                metadatas=[chunks[i].metadata for i in indexes],
+            )
+        print(f"Collection {name} created with {collection.count()} documents")
+    layout.save(DB_NAME)
+    return sum(chroma.get_collection(name).count() for name in layout.names())
+
+
+def create_document_store(documents):
+    """Keep a copy of the documents next to the vector store, for answer.py to read parent sections from."""
+    DocumentStore.write(docstore_path(DB_NAME), {document["source"]: document["text"] for document in documents})
+
+
+def write_manifest(documents, chunks):
+    """Record the build, with a version one above the previous, so running servers know to reload."""
+    previous = read_ingest_manifest(DB_NAME)
+    manifest = IngestManifest(
+        embedding_model=embedding_model,
+        chunking=f"llm:{MODEL}",
+        documents=documents,
+        chunks=chunks,
+        created_at=time.time(),
+        version=previous.version + 1 if previous else 1,
+    )
+    write_ingest_manifest(DB_NAME, manifest)
+    return manifest
+
 
-    ids = [str(i) for i in range(len(chunks))]
-    metas = [chunk.metadata for chunk in chunks]
+@tracing.traced
+def reindex(changed, deleted):
+    """
+    Re-chunk and re-embed only the changed files into the live collections, and drop the deleted ones.
+    The new chunks of a document are added before its old chunks are deleted, so queries running
+    meanwhile may briefly see both versions of it but never neither. Chunks carry a digest of their
+    document's text, and parent sections are only read from a docstore holding that same version, so
+    a chunk whose document store hasn't caught up (or has moved on) is used as it is.
+    Returns the new ingest manifest.
+    """
+    deleted = list(deleted) + [path for path in changed if not path.exists()]
+    documents = [load_document(path) for path in changed if path.exists()]
+    tracing.annotate(changed=len(documents), deleted=len(deleted))
+    chunks = [chunk for document in documents for chunk in process_document_for_reindex(document)]
+    texts = [chunk.page_content for chunk in chunks]
+    vectors = [e.embedding for e in usage.embeddings("create_embeddings", openai, model=embedding_model, input=texts).data] if texts else []
+
+    layout = ShardLayout.load(DB_NAME, collection_name)
+    chroma = PersistentClient(path=DB_NAME)
+    # Ids of incremental chunks can't collide with each other or with the 0..n-1 of a full ingest
+    prefix = f"{time.time_ns()}-"
+    by_shard = {}
+    for i, chunk in enumerate(chunks):
+        by_shard.setdefault(layout.shard_of(chunk.metadata), []).append(i)
+    for name, indexes in by_shard.items():
+        chroma.get_or_create_collection(name).add(
+            ids=[f"{prefix}{i}" for i in indexes],
+            embeddings=[vectors[i] for i in indexes],
+            documents=[texts[i] for i in indexes],
+            metadatas=[chunks[i].metadata for i in indexes],
+        )
 
-    collection.add(ids=ids, embeddings=vectors, documents=texts, metadatas=metas)
-    print(f"Vectorstore created with {collection.count()} documents")
+    sources = [document["source"] for document in documents] + [path.as_posix() for path in deleted]
+    for name in layout.names():
+        collection = chroma.get_or_create_collection(name)
+        old = [id for id in collection.get(where={"source": {"$in": sources}}, include=[])["ids"] if not id.startswith(prefix)]
+        if old:
+            collection.delete(ids=old)
+
+    documents = fetch_documents()
+    create_document_store(documents)
+    total = sum(chroma.get_collection(name).count() for name in layout.names())
+    return write_manifest(len(documents), total)
+
+
+def watch(interval=POLL_INTERVAL, debounce=DEBOUNCE, publish_root=None):
+    """
+    Reindex knowledge-base edits as they happen, one debounced burst at a time; runs until interrupted.
+    With publish_root, each new version is also published there as a snapshot for servers run with INDEX_SNAPSHOT.
+    """
+    watcher = DirectoryWatcher(KNOWLEDGE_BASE_PATH, "*.md")
+    print(f"Watching {KNOWLEDGE_BASE_PATH} for changes")
+    for changes in watcher.watch(interval, debounce):
+        print(f"{len(changes.changed)} changed, {len(changes.deleted)} deleted: reindexing")
+        try:
+            manifest = reindex(changes.changed, changes.deleted)
+            if publish_root:
+                publish(DB_NAME, collection_name, publish_root)
+        except Exception as e:
+            print(f"Reindexing failed, will retry with the next change: {type(e).__name__}: {e}")
+            watcher.forget(changes)
+            continue
+        print(f"Index version {manifest.version}: {manifest.chunks} chunks from {manifest.documents} documents")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunk the knowledge base with an LLM and embed it into Chroma")
+    parser.add_argument("--shards", type=int, default=1, help="Number of collections to hash documents across")
+    parser.add_argument("--shard-by", choices=["hash", "type"], default="hash", help="Split by hash of the source, or one collection per document type")
+    parser.add_argument("--rebuild", nargs="+", metavar="COLLECTION", help="Rebuild only these shard collections, keeping the saved layout")
+    parser.add_argument("--watch", action="store_true", help="Keep running and reindex files as they change (after an initial ingest)")
+    parser.add_argument("--publish", metavar="ROOT", help="With --watch, also publish each new version as a snapshot under ROOT")
+    args = parser.parse_args()
+
+    if args.watch:
+        watch(publish_root=args.publish)  # runs until interrupted
+
+    if args.rebuild:
+        layout = ShardLayout.load(DB_NAME, collection_name)
+    else:
+        layout = ShardLayout(base=collection_name, by=args.shard_by, count=args.shards)
     documents = fetch_documents()
-    chunks = create_chunks(documents)
-    create_embeddings(chunks)
+    selected = [d for d in documents if layout.shard_of(d) in args.rebuild] if args.rebuild else documents
+    chunks = create_chunks(selected)
+    total = create_embeddings(chunks, layout, args.rebuild)
+    create_document_store(documents)
+    write_manifest(len(documents), total)
     print("Ingestion complete")
+    usage.print_summary()
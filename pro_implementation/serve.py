@@ -0,0 +1,179 @@
+"""
+Pre-forked JSON API for answer_question, to use every core of one box.
+
+The parent loads what is read-only and expensive before forking: the tokenizer tables, the entity
+index and query router, and, when serving a snapshot (INDEX_SNAPSHOT), the memory-mapped index. The
+workers share those pages copy-on-write or through the page cache. It then binds one listening
+socket and forks the workers, which all accept from it. Connections to Chroma and the providers are
+opened in each worker after the fork, since SQLite handles and HTTP connection pools must not be
+shared across a fork. Query embeddings and conversation summaries go through a SQLite cache shared
+by all workers (SHARED_CACHE, by default serve_cache.sqlite in the repository root). The parent
+restarts any worker that dies, waiting longer after each worker that dies soon after starting, and
+gives up once MAX_QUICK_FAILURES of them have in a row, since those are usually startup errors.
+
+    python -m pro_implementation.serve --workers 4 --port 8000
+    curl -s localhost:8000/answer -d '{"question": "Who is Averi Lancaster?"}'
+
+Unix only (os.fork). With the Chroma backend each worker opens the store itself; serve a published
+snapshot to have newly indexed versions picked up by every worker.
+"""
+import os
+import sys
+import json
+import signal
+import time
+import socket
+import argparse
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pydantic import BaseModel, ValidationError
+
+BACKENDS = ["pro", "rag_app"]
+DEFAULT_SHARED_CACHE = str(Path(__file__).parent.parent / "serve_cache.sqlite")
+BACKLOG = 1024
+QUICK_FAILURE = 10.0  # seconds; a worker that exits sooner probably failed on startup
+MAX_QUICK_FAILURES = 5  # in a row, before the server stops
+RESPAWN_BACKOFF = 0.5  # seconds before restarting after a quick failure, doubled after each further one
+
+
+class AnswerRequest(BaseModel):
+    question: str
+    history: list[dict] = []
+
+
+class AnswerResponse(BaseModel):
+    answer: str
+    sources: list[str]
+    worker: int
+
+
+def load_backend(name: str):
+    """Import the answer module and load its read-only structures, in the parent before forking."""
+    from common import usage
+    from common.entities import get_entity_index
+    from common.routing import get_router
+
+    if name == "pro":
+        from pro_implementation import answer
+    else:
+        from labs.rag_app import answer
+    usage.get_encoding(usage.PROMPT_ENCODING)
+    usage.get_encoding(usage.EMBEDDING_ENCODING)
+    get_entity_index(answer.KNOWLEDGE_BASE_PATH)
+    get_router(answer.KNOWLEDGE_BASE_PATH)
+    if name == "pro" and answer.SNAPSHOT_PATH:
+        answer.get_index()
+    return answer
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "insurellm-rag"
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, {"status": "ok", "worker": os.getpid()})
+
+    def do_POST(self):
+        if self.path != "/answer":
+            return self._reply(404, {"error": "not found"})
+        try:
+            request = AnswerRequest.model_validate_json(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValidationError as e:
+            return self._reply(400, {"error": str(e)})
+        try:
+            answer, context = self.server.answer_question(request.question, request.history)
+        except Exception as e:
+            return self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+        sources = list(dict.fromkeys(item.metadata["source"] for item in context))
+        self._reply(200, AnswerResponse(answer=answer, sources=sources, worker=os.getpid()).model_dump())
+
+    def log_message(self, format, *args):
+        if self.server.access_log:
+            super().log_message(format, *args)
+
+
+def run_worker(listener: socket.socket, answer, access_log: bool):
+    """Serve requests from the shared listening socket until terminated."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles Ctrl-C and stops the workers
+    signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+    server = ThreadingHTTPServer(listener.getsockname()[:2], Handler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+    server.answer_question = answer.answer_question
+    server.access_log = access_log
+    server.serve_forever()
+
+
+def serve(backend: str, host: str, port: int, workers: int, access_log: bool = False):
+    os.environ.setdefault("SHARED_CACHE", DEFAULT_SHARED_CACHE)
+    answer = load_backend(backend)
+    listener = socket.create_server((host, port), backlog=BACKLOG)
+    print(f"Serving {backend} on http://{host}:{port} with {workers} workers")
+
+    children = {}  # pid -> start time
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(listener, answer, access_log)
+            finally:
+                os._exit(1)
+        children[pid] = time.monotonic()
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(workers):
+        spawn()
+    quick_failures = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        if time.monotonic() - started < QUICK_FAILURE:
+            quick_failures += 1
+        else:
+            quick_failures = 0
+        if quick_failures >= MAX_QUICK_FAILURES:
+            print(f"Worker {pid} exited with status {status}; {quick_failures} workers in a row failed on startup, stopping", file=sys.stderr)
+            stop()
+            continue
+        delay = RESPAWN_BACKOFF * 2 ** (quick_failures - 1) if quick_failures else 0.0
+        print(f"Worker {pid} exited with status {status}; starting another" + (f" in {delay:.1f}s" if delay else ""), file=sys.stderr)
+        time.sleep(delay)
+        if not stopping:
+            spawn()
+    listener.close()
+    if quick_failures >= MAX_QUICK_FAILURES:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve answer_question from pre-forked worker processes")
+    parser.add_argument("--backend", choices=BACKENDS, default="pro")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args()
+    serve(args.backend, args.host, args.port, args.workers, args.access_log)
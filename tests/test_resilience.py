@@ -0,0 +1,52 @@
+"""
+Circuit breaker recovery in common.resilience.
+Run from the repository root: python -m pytest tests
+"""
+import time
+import pytest
+from common import resilience
+
+
+@pytest.fixture
+def half_open(monkeypatch):
+    """A breaker for "model" that has opened and is now letting one trial call through."""
+    breaker = resilience.CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.failure()
+    time.sleep(0.02)
+    assert breaker.state == "half-open"
+    monkeypatch.setitem(resilience._breakers, "model", breaker)
+    return breaker
+
+
+def test_deadline_does_not_hold_the_trial(half_open, monkeypatch):
+    calls = []
+    monkeypatch.setattr(resilience.usage, "completion", lambda stage, **kwargs: calls.append(kwargs) or "ok")
+
+    with pytest.raises(resilience.DeadlineExceeded):
+        resilience.completion("answer", ["model"], timeout=-1.0)
+    assert calls == []
+
+    assert resilience.completion("answer", ["model"], timeout=5.0) == "ok"
+    assert half_open.state == "closed"
+
+
+def test_interrupted_trial_is_released(half_open, monkeypatch):
+    def interrupted(stage, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(resilience.usage, "completion", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        resilience.completion("answer", ["model"], timeout=5.0)
+    assert half_open.allow()
+
+
+def test_failed_trial_reopens(half_open, monkeypatch):
+    def failing(stage, **kwargs):
+        raise TimeoutError
+
+    monkeypatch.setattr(resilience.usage, "completion", failing)
+    with pytest.raises(TimeoutError):
+        resilience.completion("answer", ["model"], timeout=5.0)
+    assert half_open.state == "open"
+    with pytest.raises(resilience.CircuitOpen):
+        resilience.completion("answer", ["model"], timeout=5.0)